@@ -11,14 +11,16 @@ class EnvironmentManager:
 
         Args:
             env_vars (list): List of environment variable names to load.
+            optional_env_vars (dict): Environment variable names mapped to the default values used when unset.
     """
 
-    def __init__(self, env_vars):
+    def __init__(self, env_vars, optional_env_vars=None):
         """
             Initialize and load environment variables.
 
             Args:
                 env_vars (list): List of environment variable names to load.
+                optional_env_vars (dict): Environment variable names mapped to the default values used when unset.
         """
         env_vars.append('LOGGER_LEVEL')
         load_dotenv()
@@ -30,6 +32,9 @@ class EnvironmentManager:
                 raise EnvironmentError(f'{var} is not set in .env file')
             self.env_vars[var] = value
 
+        for var, default_value in (optional_env_vars or {}).items():
+            self.env_vars[var] = os.getenv(var, default_value)
+
         self.logger_level = None
         self.setup_logger_level()
 
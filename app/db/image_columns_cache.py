@@ -0,0 +1,273 @@
+import logging
+import threading
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from app.services.image_hash_service import ImageHashService, DEFAULT_HASH_TYPES, FILTER_HASH_TYPES
+from app.services.image_similarity_service import ImageSimilarityService
+
+# Fields of the stored images that compares read
+COMPARE_PROJECTION = ['recognized_text', 'term_frequencies', *FILTER_HASH_TYPES, 'phash16', 'dhash16',
+                      'hash_variants', 'hash_version', 'sequence', 'updated']
+
+
+class GrowableArray:
+    """
+        Numpy array that is appended to in place, its capacity doubles when it is full.
+    """
+
+    def __init__(self, dtype, shape=()):
+        """
+            Initialize an empty array.
+
+            Args:
+                dtype: Numpy dtype of the values.
+                shape (tuple): Shape of every row.
+        """
+        self.array = np.zeros((0, *shape), dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        """
+            Append rows.
+
+            Args:
+                values (array_like): Rows to append.
+        """
+        values = np.asarray(values)
+        if values.dtype.kind == 'S' and values.dtype.itemsize > self.array.dtype.itemsize:
+            # Longer byte strings than stored so far widen the whole column
+            self.array = self.array.astype(values.dtype)
+        size = self.size + len(values)
+        if size > len(self.array):
+            grown = np.zeros((max(size, 2 * len(self.array)), *self.array.shape[1:]), dtype=self.array.dtype)
+            grown[:self.size] = self.array[:self.size]
+            self.array = grown
+        self.array[self.size:size] = values
+        self.size = size
+
+    def view(self):
+        """
+            Returns:
+                ndarray: The appended rows, without a copy.
+        """
+        return self.array[:self.size]
+
+
+class ImageColumnsCache:
+    """
+        In-process columnar copy of the compare fields of all stored images.
+
+        Every field is one array for all images instead of a dict per image: ids as fixed-width byte strings, the hash
+        arrays of get_hash_arrays, term counts as one sparse matrix over a shared vocabulary and, for metrics that
+        need them, the texts as one UTF-8 buffer with offsets. Only images saved since the last refresh are read.
+        Images whose compare fields were recomputed get a new sequence as well, their old rows are removed by
+        clearing their ids, and the columns are reloaded once most rows are removed or the collections were cleared.
+    """
+
+    def __init__(self, db_connection, store_texts, logger_level=logging.INFO, hash_types=DEFAULT_HASH_TYPES):
+        """
+            Initialize an empty cache.
+
+            Args:
+                db_connection (RecognizedImagesRepository): Repository of the stored images.
+                store_texts (bool): Whether to keep the texts, only the term counts are kept otherwise.
+                logger_level: Logger level.
+                hash_types (list[str]): The 64-bit hash types kept, the enabled hash_types of the hash service.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+        self.db_connection = db_connection
+        self.store_texts = store_texts
+        self.hash_types = hash_types
+        self.lock = threading.Lock()
+        # Generation of the last clear of the collections when the cache was refreshed
+        self.cleared_generation = None
+        self.clear()
+
+    def clear(self):
+        """
+            Drop all cached images.
+        """
+        self.ids = GrowableArray('S1')
+        self.hash_arrays = None
+        self.vocabulary = {}
+        self.term_ids = GrowableArray(np.int32)
+        self.term_counts = GrowableArray(np.float32)
+        self.term_offsets = GrowableArray(np.int64)
+        self.term_offsets.extend([0])
+        self.text_buffer = GrowableArray(np.uint8)
+        self.text_offsets = GrowableArray(np.int64)
+        self.text_offsets.extend([0])
+        # Highest insertion sequence cached, and images that were read before their sequence was set
+        self.sequence = -1
+        self.pending_image_ids = []
+        # Rows of images that were recomputed, their ids are empty
+        self.removed_count = 0
+
+    @property
+    def size(self):
+        """
+            Returns:
+                int: Number of cached rows, removed rows included.
+        """
+        return self.ids.size
+
+    def refresh(self, batch_size=10000):
+        """
+            Read the images saved since the last refresh.
+
+            The cache is reloaded when the collections were cleared since the last refresh, by any worker, or when
+            most rows are removed. Images whose insert has not set their sequence yet are not cached but returned, so
+            that a compare still sees them.
+
+            Args:
+                batch_size (int): Documents read at once.
+
+            Returns:
+                list[StoredImage]: Images without a sequence yet, with the compare fields.
+        """
+        with self.lock:
+            # Read before the images, so that a clear during the read is found by the next refresh
+            cleared_generation = self.db_connection.get_cleared_generation()
+            if cleared_generation is not None and cleared_generation != self.cleared_generation:
+                if self.size:
+                    self.logger.info("Stored images were cleared, reloading the image columns cache")
+                    self.clear()
+                self.cleared_generation = cleared_generation
+            pending_images = self.read_new_images(batch_size)
+            if self.removed_count > self.size // 2:
+                self.logger.info(f"Compacting the image columns cache, {self.removed_count} of {self.size} rows "
+                                 f"were removed")
+                self.clear()
+                pending_images = self.read_new_images(batch_size)
+            return pending_images
+
+    def read_new_images(self, batch_size):
+        """
+            Append the images saved since the last read.
+
+            Args:
+                batch_size (int): Documents read at once.
+
+            Returns:
+                list[StoredImage]: Images without a sequence yet, they are read again next time.
+        """
+        pending_images = []
+        # Nothing to remove when the columns are loaded from scratch
+        is_reload = not self.size
+        for images in self.db_connection.iterate_images_since(self.sequence, self.pending_image_ids,
+                                                              COMPARE_PROJECTION, batch_size):
+            if not is_reload:
+                self.remove([image.id for image in images if image.updated])
+            pending_images.extend(image for image in images if image.sequence is None)
+            self.append([image for image in images if image.sequence is not None])
+        self.pending_image_ids = [image.id for image in pending_images]
+        return pending_images
+
+    def remove(self, image_ids):
+        """
+            Remove the rows of images, their ids are cleared and the rows are skipped by compares.
+
+            Args:
+                image_ids (list[str]): IDs of the images, ids that are not cached are ignored.
+        """
+        if not image_ids or not self.size:
+            return
+        ids = self.ids.view()
+        removed = np.isin(ids, np.array([image_id.encode() for image_id in image_ids]))
+        ids[removed] = b''
+        self.removed_count += int(np.count_nonzero(removed))
+
+    def append(self, images):
+        """
+            Append images to the columns.
+
+            Args:
+                images (list[StoredImage]): Images with the compare fields and a sequence.
+        """
+        if not images:
+            return
+        missing_term_frequencies = {}
+        term_ids, term_counts, row_lengths = [], [], []
+        for image in images:
+            frequencies = image.term_frequencies
+            if frequencies is None:
+                frequencies = ImageSimilarityService.get_term_frequencies(image.recognized_text)
+                missing_term_frequencies[image.id] = frequencies
+            term_ids.extend(self.vocabulary.setdefault(term, len(self.vocabulary)) for term in frequencies)
+            term_counts.extend(frequencies.values())
+            row_lengths.append(len(frequencies))
+        if missing_term_frequencies:
+            self.db_connection.update_term_frequencies(missing_term_frequencies)
+
+        self.ids.extend([image.id.encode() for image in images])
+        self.term_ids.extend(np.array(term_ids, dtype=np.int32))
+        self.term_counts.extend(np.array(term_counts, dtype=np.float32))
+        self.term_offsets.extend(self.term_offsets.view()[-1] + np.cumsum(row_lengths))
+        if self.store_texts:
+            texts = [(image.recognized_text or '').encode() for image in images]
+            self.text_buffer.extend(np.frombuffer(b''.join(texts), dtype=np.uint8))
+            self.text_offsets.extend(self.text_offsets.view()[-1] + np.cumsum([len(text) for text in texts]))
+
+        hash_arrays = ImageHashService.get_hash_arrays(images, self.hash_types)
+        if self.hash_arrays is None:
+            self.hash_arrays = {key: GrowableArray(array.dtype, array.shape[1:]) for key, array in hash_arrays.items()}
+        for key, array in hash_arrays.items():
+            self.hash_arrays[key].extend(array)
+        self.sequence = max(self.sequence, max(image.sequence for image in images))
+        self.logger.debug(f"Cached {len(images)} images, {self.size} in total")
+
+    def get_term_matrix(self, frequencies_list):
+        """
+            Build a term count matrix over the cached vocabulary. Terms the cache does not know get further columns.
+
+            Args:
+                frequencies_list (list[dict]): Term frequencies of the texts.
+
+            Returns:
+                csr_matrix: Term counts, texts x terms.
+        """
+        extra_terms = {}
+        indptr, indices, counts = [0], [], []
+        for frequencies in frequencies_list:
+            for term, count in (frequencies or {}).items():
+                index = self.vocabulary.get(term)
+                if index is None:
+                    index = len(self.vocabulary) + extra_terms.setdefault(term, len(extra_terms))
+                indices.append(index)
+                counts.append(count)
+            indptr.append(len(indices))
+        return csr_matrix((np.array(counts, dtype=np.float64), np.array(indices, dtype=np.int32), indptr),
+                          shape=(len(frequencies_list), len(self.vocabulary) + len(extra_terms)))
+
+    def iterate_chunks(self, chunk_size, terms_count):
+        """
+            Iterate the cached images in chunks of rows. Only the term counts, term ids and texts of a chunk are copied.
+
+            Args:
+                chunk_size (int): Images per chunk.
+                terms_count (int): Columns of the term count matrices, at least the cached vocabulary size.
+
+            Yields:
+                tuple: Start row, ids as byte strings, empty for removed rows, hash arrays, term count matrix and
+                texts, None if not stored.
+        """
+        ids = self.ids.view()
+        hash_arrays = {key: array.view() for key, array in self.hash_arrays.items()} if self.hash_arrays else {}
+        term_offsets, term_ids, term_counts = self.term_offsets.view(), self.term_ids.view(), self.term_counts.view()
+        text_offsets, text_buffer = self.text_offsets.view(), self.text_buffer.view()
+        for start in range(0, len(ids), chunk_size):
+            end = min(start + chunk_size, len(ids))
+            first, last = term_offsets[start], term_offsets[end]
+            # Sparse products sort the indices of a matrix in place, which must not reorder the cached term ids
+            chunk_term_counts = csr_matrix(
+                (term_counts[first:last].astype(np.float64), term_ids[first:last].copy(),
+                 term_offsets[start:end + 1] - first), shape=(end - start, terms_count))
+            texts = None
+            if self.store_texts:
+                texts = [text_buffer[text_offsets[row]:text_offsets[row + 1]].tobytes().decode()
+                         for row in range(start, end)]
+            yield start, ids[start:end], {key: array[start:end] for key, array in hash_arrays.items()}, \
+                chunk_term_counts, texts
@@ -0,0 +1,146 @@
+class ImageHashes:
+    """
+        Hashes of an image, a slotted record instead of a dict per image.
+
+        Attributes:
+            xxhash (str): Content hash.
+            xxhash_version (int): Version of the content hash, None for version 1.
+            ahash (str): Hex average hash.
+            dhash (str): Hex difference hash.
+            phash (str): Hex perceptual hash.
+            whash_haar (str): Hex Haar wavelet hash.
+            whash_db4 (str): Hex Daubechies 4 wavelet hash.
+            colorhash (str): Hex color hash.
+            The 64-bit hashes are None for images stored while their hash type was not enabled.
+            phash16 (bytes): Packed 16x16 perceptual hash, None for images stored before it was added.
+            dhash16 (bytes): Packed 16x16 difference hash, None for images stored before it was added.
+            hash_variants (dict): Hash types mapped to the packed hashes of the rotated and flipped variants.
+            hash_version (int): Version of the image hashes, None for images stored before versions were saved.
+    """
+
+    __slots__ = ('xxhash', 'xxhash_version', 'ahash', 'dhash', 'phash', 'whash_haar', 'whash_db4', 'colorhash',
+                 'phash16', 'dhash16', 'hash_variants', 'hash_version')
+
+    # Document fields of the record
+    FIELDS = __slots__
+
+    def __init__(self, ahash=None, dhash=None, whash_haar=None, colorhash=None, phash16=None, dhash16=None,
+                 hash_variants=None, xxhash=None, xxhash_version=None, hash_version=None, phash=None, whash_db4=None):
+        self.xxhash = xxhash
+        self.xxhash_version = xxhash_version
+        self.ahash = ahash
+        self.dhash = dhash
+        self.phash = phash
+        self.whash_haar = whash_haar
+        self.whash_db4 = whash_db4
+        self.colorhash = colorhash
+        self.phash16 = phash16
+        self.dhash16 = dhash16
+        self.hash_variants = hash_variants
+        self.hash_version = hash_version
+
+    @classmethod
+    def from_document(cls, document):
+        """
+            Create a record from a MongoDB document, missing fields are None.
+
+            Args:
+                document (dict): The document.
+
+            Returns:
+                The record.
+        """
+        return cls(**{field: document.get(field) for field in ImageHashes.FIELDS})
+
+    def to_document(self):
+        """
+            Returns:
+                dict: The hash fields of a MongoDB document.
+        """
+        return {field: getattr(self, field) for field in ImageHashes.FIELDS}
+
+
+class StoredImage(ImageHashes):
+    """
+        Image document of the main collection with the fields that compares use.
+
+        Attributes:
+            id (str): Document ID, or a batch position for images of a batch that are not saved yet.
+            image_id (str): Image ID of the request.
+            image_path (str): Path of the image file.
+            recognized_text (str): The text recognized from the image.
+            term_frequencies (dict): Terms of the text mapped to their counts, None if not stored yet.
+            sequence (int): Insertion sequence, None until the insert sets it.
+            ocr_version (str): Version of the OCR models that recognized the text, None for images stored before
+                versions were saved.
+            template (str): Document template of the OCR task.
+            updated (bool): Whether the compare fields were recomputed after the insert.
+    """
+
+    __slots__ = ('id', 'image_id', 'image_path', 'recognized_text', 'term_frequencies', 'sequence', 'ocr_version',
+                 'template', 'updated')
+
+    def __init__(self, id=None, image_id=None, image_path=None, recognized_text=None, term_frequencies=None,
+                 sequence=None, ocr_version=None, template=None, updated=None, **hashes):
+        super().__init__(**hashes)
+        self.id = id
+        self.image_id = image_id
+        self.image_path = image_path
+        self.recognized_text = recognized_text
+        self.term_frequencies = term_frequencies
+        self.sequence = sequence
+        self.ocr_version = ocr_version
+        self.template = template
+        self.updated = updated
+
+    @classmethod
+    def from_document(cls, document):
+        """
+            Create a record from a MongoDB document, missing fields are None.
+
+            Args:
+                document (dict): The image document.
+
+            Returns:
+                StoredImage: The record.
+        """
+        return cls(document['_id'], document.get('image_id'), document.get('image_path'),
+                   document.get('recognized_text'), document.get('term_frequencies'), document.get('sequence'),
+                   document.get('ocr_version'), document.get('template'), document.get('updated'),
+                   **{field: document.get(field) for field in ImageHashes.FIELDS})
+
+
+class SimilarImage:
+    """
+        Match result of a compare.
+
+        Attributes:
+            id: ID of the similar image, or its batch position.
+            similarity: Text similarity percentage, or the label of the matched hash.
+    """
+
+    __slots__ = ('id', 'similarity')
+
+    def __init__(self, id, similarity):
+        self.id = id
+        self.similarity = similarity
+
+    @classmethod
+    def from_document(cls, document):
+        """
+            Create a record from a cached compare result entry.
+
+            Args:
+                document (dict): Entry with id and similarity.
+
+            Returns:
+                SimilarImage: The record.
+        """
+        return cls(document['id'], document['similarity'])
+
+    def to_document(self):
+        """
+            Returns:
+                dict: Entry with id and similarity for the compare cache.
+        """
+        return {"id": self.id, "similarity": self.similarity}
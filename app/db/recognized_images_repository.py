@@ -1,7 +1,9 @@
+import time
 import uuid
 import logging
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from app.config.environment_manager import EnvironmentManager
+from app.db.image_records import StoredImage
 
 
 class RecognizedImagesRepository(EnvironmentManager):
@@ -16,8 +18,15 @@ class RecognizedImagesRepository(EnvironmentManager):
             mongodb_database (str): Name of the database to connect to.
             mongodb_collection (str): Name of the main collection.
             mongodb_similar_images_collection (str): Name of the collection for similar images.
+            mongodb_compare_cache_collection (str): Name of the collection for cached compare results.
+            mongodb_counters_collection (str): Name of the collection for counters.
     """
 
+    # Counter bumped after every change of the main collection
+    GENERATION_COUNTER = 'images_generation'
+    # Generation of the main collection when it was last cleared
+    CLEARED_GENERATION_COUNTER = 'images_cleared_generation'
+
     def __init__(self):
         """
             Initialize MongoDB connection, its collections, and load environment variables.
@@ -26,7 +35,10 @@ class RecognizedImagesRepository(EnvironmentManager):
             'MONGODB_HOST', 'MONGODB_PORT', 'MONGODB_USERNAME',
             'MONGODB_PASSWORD', 'MONGODB_DATABASE', 'MONGODB_COLLECTION',
             'MONGODB_SIMILAR_IMAGES_COLLECTION'
-        ])
+        ], {
+            'MONGODB_COMPARE_CACHE_COLLECTION': 'compare_cache',
+            'MONGODB_COUNTERS_COLLECTION': 'counters'
+        })
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing Recognized Images repository...')
@@ -48,6 +60,8 @@ class RecognizedImagesRepository(EnvironmentManager):
         self.mongodb_database = self.env_vars['MONGODB_DATABASE']
         self.mongodb_collection = self.env_vars['MONGODB_COLLECTION']
         self.mongodb_similar_images_collection = self.env_vars['MONGODB_SIMILAR_IMAGES_COLLECTION']
+        self.mongodb_compare_cache_collection = self.env_vars['MONGODB_COMPARE_CACHE_COLLECTION']
+        self.mongodb_counters_collection = self.env_vars['MONGODB_COUNTERS_COLLECTION']
 
     def _initialize_mongodb(self):
         """
@@ -61,6 +75,8 @@ class RecognizedImagesRepository(EnvironmentManager):
             self.db = self.mongo_client[self.mongodb_database]
             self.collection = self.db[self.mongodb_collection]
             self.similar_images_collection = self.db[self.mongodb_similar_images_collection]
+            self.compare_cache_collection = self.db[self.mongodb_compare_cache_collection]
+            self.counters_collection = self.db[self.mongodb_counters_collection]
             self.logger.info("MongoDB client initialized successfully")
         except Exception as e:
             self.logger.exception("Failed to initialize MongoDB client", exc_info=e)
@@ -79,31 +95,93 @@ class RecognizedImagesRepository(EnvironmentManager):
             if self.mongodb_similar_images_collection not in existing_collections:
                 self.db.create_collection(self.mongodb_similar_images_collection)
                 self.logger.info(f"Created MongoDB similar images collection: {self.mongodb_similar_images_collection}")
+
+            self.create_indexes()
+            # Images saved before sequences were stored are older than any cached compare result
+            self.collection.update_many({"sequence": {"$exists": False}}, {"$set": {"sequence": 0}})
         except Exception as e:
             self.logger.exception("Failed to create MongoDB collections", exc_info=e)
 
+    def create_indexes(self):
+        """
+            Create the indexes of the cache lookups, the incremental reads and the migration queries. Dropping a
+            collection drops its indexes as well.
+        """
+        self.collection.create_index("xxhash")
+        self.collection.create_index("xxhash_version")
+        self.collection.create_index("sequence")
+        self.collection.create_index("ocr_version")
+        self.collection.create_index("hash_version")
+        self.similar_images_collection.create_index([("source_image_id", 1), ("similar_image_id", 1)])
+
     def insert_image_details(self, doc):
         """
             Insert a single image document into the main collection.
 
+            The collection generation is bumped after the insert and saved as the insertion sequence of the
+            document. A reader that saw the old generation either found the document or finds it by its sequence
+            later. Until the sequence is set it is null, and such documents are returned as new as well.
+
             Args:
                 doc (dict): Image document to be inserted.
         """
         try:
-            self.collection.insert_one(doc)
+            self.collection.insert_one({**doc, "sequence": None})
+            sequence = self.increment_generation()
+            self.collection.update_one({"_id": doc["_id"]}, {"$set": {"sequence": sequence}})
             self.logger.debug("Inserted image details into MongoDB")
         except Exception as e:
             self.logger.exception("Failed to insert image details into MongoDB", exc_info=e)
 
+    def get_generation(self):
+        """
+            Get the generation of the main collection.
+
+            Returns:
+                int: The number of changes of the main collection, 0 if it never changed.
+        """
+        try:
+            counter = self.counters_collection.find_one({"_id": self.GENERATION_COUNTER})
+            return counter["value"] if counter else 0
+        except Exception as e:
+            self.logger.exception("Failed to get the collection generation from MongoDB", exc_info=e)
+            return None
+
+    def get_cleared_generation(self):
+        """
+            Get the generation of the main collection when it was last cleared.
+
+            Returns:
+                int: The generation of the last clear, 0 if it was never cleared, None if it cannot be read.
+        """
+        try:
+            counter = self.counters_collection.find_one({"_id": self.CLEARED_GENERATION_COUNTER})
+            return counter["value"] if counter else 0
+        except Exception as e:
+            self.logger.exception("Failed to get the cleared generation from MongoDB", exc_info=e)
+            return None
+
+    def increment_generation(self):
+        """
+            Bump the generation of the main collection.
+
+            Returns:
+                int: The new generation.
+        """
+        counter = self.counters_collection.find_one_and_update(
+            {"_id": self.GENERATION_COUNTER}, {"$inc": {"value": 1}}, upsert=True,
+            return_document=ReturnDocument.AFTER)
+        return counter["value"]
+
     def get_all_images(self):
         """
             Retrieve all image documents from the main collection.
 
             Returns:
-                list[dict]: List of all image documents.
+                list[StoredImage]: List of all images.
         """
         try:
-            images = list(self.collection.find())
+            images = [StoredImage.from_document(document) for document in self.collection.find()]
             self.logger.debug("Retrieved all images from MongoDB")
             return images
         except Exception as e:
@@ -111,6 +189,94 @@ class RecognizedImagesRepository(EnvironmentManager):
             return []
 
 
+    def get_images_since(self, generation):
+        """
+            Retrieve the image documents saved after a collection generation.
+
+            Args:
+                generation (int): The collection generation.
+
+            Returns:
+                list[StoredImage]: List of images with a higher insertion sequence, or still without one.
+        """
+        try:
+            images = [StoredImage.from_document(document) for document in self.collection.find(
+                {"$or": [{"sequence": {"$gt": generation}}, {"sequence": None}]})]
+            self.logger.debug(f"Retrieved {len(images)} images saved after generation {generation}")
+            return images
+        except Exception as e:
+            self.logger.exception(f"Failed to retrieve images saved after generation {generation}", exc_info=e)
+            return []
+
+    def count_images(self):
+        """
+            Count the image documents of the main collection.
+
+            Returns:
+                int: Number of image documents.
+        """
+        try:
+            return self.collection.estimated_document_count()
+        except Exception as e:
+            self.logger.exception("Failed to count images in MongoDB", exc_info=e)
+            return 0
+
+    def iterate_images(self, projection=None, batch_size=10000):
+        """
+            Stream all image documents of the main collection in insertion order, a batch at a time.
+
+            Args:
+                projection (dict): Fields to retrieve, None for whole documents.
+                batch_size (int): Documents per yielded batch.
+
+            Yields:
+                list[StoredImage]: The next batch of images.
+        """
+        try:
+            yield from self._iterate_batches(self.collection.find({}, projection).sort("sequence", 1), batch_size)
+        except Exception as e:
+            self.logger.exception("Failed to stream images from MongoDB", exc_info=e)
+
+    def iterate_images_since(self, sequence, image_ids, projection=None, batch_size=10000):
+        """
+            Stream the image documents saved after an insertion sequence, a batch at a time.
+
+            Args:
+                sequence (int): The insertion sequence.
+                image_ids (list[str]): IDs of further documents to retrieve, like documents that had no sequence yet.
+                projection (dict): Fields to retrieve, None for whole documents.
+                batch_size (int): Documents per yielded batch.
+
+            Yields:
+                list[StoredImage]: The next batch of images with a higher sequence, still without one, or listed.
+        """
+        try:
+            query = {"$or": [{"sequence": {"$gt": sequence}}, {"sequence": None}, {"_id": {"$in": image_ids}}]}
+            yield from self._iterate_batches(self.collection.find(query, projection), batch_size)
+        except Exception as e:
+            self.logger.exception(f"Failed to stream images saved after sequence {sequence}", exc_info=e)
+
+    @staticmethod
+    def _iterate_batches(cursor, batch_size):
+        """
+            Group the image documents of a cursor into lists of records.
+
+            Args:
+                cursor: MongoDB cursor.
+                batch_size (int): Documents per yielded list.
+
+            Yields:
+                list[StoredImage]: The next images of the cursor.
+        """
+        batch = []
+        for document in cursor.batch_size(batch_size):
+            batch.append(StoredImage.from_document(document))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
     def get_images_by_ids(self, image_ids):
         """
             Retrieve multiple image documents by their IDs.
@@ -119,10 +285,11 @@ class RecognizedImagesRepository(EnvironmentManager):
                 image_ids (list[str]): List of image document IDs.
 
             Returns:
-                list[dict]: List of image documents matching the IDs.
+                list[StoredImage]: List of images matching the IDs.
         """
         try:
-            images = list(self.collection.find({"_id": {"$in": image_ids}}))
+            images = [StoredImage.from_document(document)
+                      for document in self.collection.find({"_id": {"$in": image_ids}})]
             self.logger.debug("Retrieved images by specific IDs from MongoDB")
             return images
         except Exception as e:
@@ -137,16 +304,209 @@ class RecognizedImagesRepository(EnvironmentManager):
                 image_xxhash (str): The hash value to look for in image documents.
 
             Returns:
-                list[dict]: List of image documents with the specified xxhash.
+                list[StoredImage]: List of images with the specified xxhash.
         """
         try:
-            images = list(self.collection.find({"xxhash": image_xxhash}))
+            images = [StoredImage.from_document(document)
+                      for document in self.collection.find({"xxhash": image_xxhash})]
             self.logger.debug(f"Retrieved images by xxhash: {image_xxhash}")
             return images
         except Exception as e:
             self.logger.exception(f"Failed to retrieve images by xxhash: {image_xxhash}", exc_info=e)
             return []
 
+    def has_legacy_xxhash_images(self):
+        """
+            Check whether any image is still stored with a version 1 content hash.
+
+            Returns:
+                bool: True if an image without xxhash_version is stored.
+        """
+        try:
+            return self.collection.find_one({"xxhash_version": None}, {"_id": 1}) is not None
+        except Exception as e:
+            self.logger.exception("Failed to check for legacy xxhash images in MongoDB", exc_info=e)
+            return False
+
+    def get_legacy_images_by_xxhash(self, legacy_xxhash):
+        """
+            Retrieve image documents stored with a version 1 xxhash value.
+
+            Args:
+                legacy_xxhash (str): The version 1 hash value.
+
+            Returns:
+                list[StoredImage]: List of images with the specified legacy xxhash.
+        """
+        try:
+            return [StoredImage.from_document(document)
+                    for document in self.collection.find({"xxhash": legacy_xxhash, "xxhash_version": None})]
+        except Exception as e:
+            self.logger.exception(f"Failed to retrieve images by legacy xxhash: {legacy_xxhash}", exc_info=e)
+            return []
+
+    def update_xxhash(self, image_ids, image_xxhash, xxhash_version):
+        """
+            Replace the stored content hash of images.
+
+            Args:
+                image_ids (list[str]): List of image document IDs.
+                image_xxhash (str): The new hash value.
+                xxhash_version (int): Version of the new hash.
+        """
+        try:
+            self.collection.update_many({"_id": {"$in": image_ids}},
+                                        {"$set": {"xxhash": image_xxhash, "xxhash_version": xxhash_version}})
+            self.logger.debug(f"Updated xxhash of {len(image_ids)} images to version {xxhash_version}")
+        except Exception as e:
+            self.logger.exception("Failed to update xxhash in MongoDB", exc_info=e)
+
+    @staticmethod
+    def _stale_images_query(ocr_version, hash_version, hash_types):
+        """
+            Args:
+                ocr_version (str): Current version of the OCR models.
+                hash_version (int): Current version of the image hashes.
+                hash_types (list[str]): Enabled 64-bit hash types.
+
+            Returns:
+                dict: Query of the images with text or hashes of other versions, stored without versions, or without
+                an enabled hash type.
+        """
+        return {"$or": [{"ocr_version": {"$ne": ocr_version}}, {"hash_version": {"$ne": hash_version}},
+                        *({hash_type: None} for hash_type in hash_types)]}
+
+    def claim_stale_images(self, ocr_version, hash_version, hash_types, owner, lease_seconds, limit):
+        """
+            Lease images with features of other versions to a migration worker.
+
+            Images leased to another worker are skipped until their lease expires, so the images of a worker that
+            stopped without releasing them are taken over later. Images that failed to migrate to these versions
+            are skipped as well.
+
+            Args:
+                ocr_version (str): Current version of the OCR models.
+                hash_version (int): Current version of the image hashes.
+                hash_types (list[str]): Enabled 64-bit hash types.
+                owner (str): ID of the migration worker.
+                lease_seconds (float): Time the worker has to migrate the images.
+                limit (int): Maximum number of images to lease.
+
+            Returns:
+                list[StoredImage]: The leased images.
+        """
+        try:
+            now = time.time()
+            query = {"$and": [
+                self._stale_images_query(ocr_version, hash_version, hash_types),
+                {"migration_failed": {"$ne": f"{ocr_version}:{hash_version}"}},
+                {"$or": [{"migration_lease": None}, {"migration_lease": {"$lt": now}}]}
+            ]}
+            image_ids = [document["_id"] for document in self.collection.find(query, {"_id": 1}).limit(limit)]
+            if not image_ids:
+                return []
+            # Only images nobody leased in between are taken, the lease check and the update are atomic per image
+            self.collection.update_many({"$and": [{"_id": {"$in": image_ids}}, query]},
+                                        {"$set": {"migration_lease": now + lease_seconds, "migration_owner": owner}})
+            return [StoredImage.from_document(document) for document in self.collection.find(
+                {"_id": {"$in": image_ids}, "migration_owner": owner, "migration_lease": now + lease_seconds})]
+        except Exception as e:
+            self.logger.exception("Failed to claim stale images in MongoDB", exc_info=e)
+            return []
+
+    def update_image_features(self, features_by_id):
+        """
+            Save recomputed compare fields of images and release their leases.
+
+            The images get a new insertion sequence like inserted images, so that readers of the collection since
+            an older generation read them again. Until the sequence is set it is null, and they are marked as
+            updated so that readers which cached them replace their copies.
+
+            Args:
+                features_by_id (dict): Image document IDs mapped to the fields to set.
+        """
+        if not features_by_id:
+            return
+        try:
+            self.collection.bulk_write([
+                UpdateOne({"_id": image_id}, {
+                    "$set": {**features, "sequence": None, "updated": True},
+                    "$unset": {"migration_lease": "", "migration_owner": "", "migration_failed": ""}
+                }) for image_id, features in features_by_id.items()
+            ], ordered=False)
+            sequence = self.increment_generation()
+            self.collection.update_many({"_id": {"$in": list(features_by_id)}}, {"$set": {"sequence": sequence}})
+            self.logger.debug(f"Updated compare fields of {len(features_by_id)} images")
+        except Exception as e:
+            self.logger.exception("Failed to update compare fields in MongoDB", exc_info=e)
+
+    def release_migration_claims(self, image_ids, owner):
+        """
+            Release leased images that were not migrated, so that other workers can take them.
+
+            Args:
+                image_ids (list[str]): List of image document IDs.
+                owner (str): ID of the migration worker that leased them.
+        """
+        try:
+            self.collection.update_many({"_id": {"$in": image_ids}, "migration_owner": owner},
+                                        {"$unset": {"migration_lease": "", "migration_owner": ""}})
+        except Exception as e:
+            self.logger.exception("Failed to release migration claims in MongoDB", exc_info=e)
+
+    def mark_migration_failed(self, image_ids, ocr_version, hash_version):
+        """
+            Mark images that cannot be migrated to the current versions, they are not leased again for them.
+
+            Args:
+                image_ids (list[str]): List of image document IDs.
+                ocr_version (str): Current version of the OCR models.
+                hash_version (int): Current version of the image hashes.
+        """
+        try:
+            self.collection.update_many({"_id": {"$in": image_ids}}, {
+                "$set": {"migration_failed": f"{ocr_version}:{hash_version}"},
+                "$unset": {"migration_lease": "", "migration_owner": ""}
+            })
+        except Exception as e:
+            self.logger.exception("Failed to mark failed migrations in MongoDB", exc_info=e)
+
+    def count_stale_images(self, ocr_version, hash_version, hash_types):
+        """
+            Count the images with features of other versions or without an enabled hash type.
+
+            Args:
+                ocr_version (str): Current version of the OCR models.
+                hash_version (int): Current version of the image hashes.
+                hash_types (list[str]): Enabled 64-bit hash types.
+
+            Returns:
+                tuple: Number of stale images, and how many of them failed to migrate. None, None on errors.
+        """
+        try:
+            query = self._stale_images_query(ocr_version, hash_version, hash_types)
+            return self.collection.count_documents(query), self.collection.count_documents(
+                {"$and": [query, {"migration_failed": f"{ocr_version}:{hash_version}"}]})
+        except Exception as e:
+            self.logger.exception("Failed to count stale images in MongoDB", exc_info=e)
+            return None, None
+
+    def update_term_frequencies(self, term_frequencies_by_id):
+        """
+            Save term frequencies of images stored without them.
+
+            Args:
+                term_frequencies_by_id (dict): Image document IDs mapped to their term frequencies.
+        """
+        try:
+            self.collection.bulk_write([
+                UpdateOne({"_id": image_id}, {"$set": {"term_frequencies": term_frequencies}})
+                for image_id, term_frequencies in term_frequencies_by_id.items()
+            ], ordered=False)
+            self.logger.debug(f"Updated term frequencies of {len(term_frequencies_by_id)} images")
+        except Exception as e:
+            self.logger.exception("Failed to update term frequencies in MongoDB", exc_info=e)
+
     def insert_similar_images(self, image_id, similar_images_ids):
         """
             Insert records of similar images into a separate collection.
@@ -163,6 +523,71 @@ class RecognizedImagesRepository(EnvironmentManager):
         except Exception as e:
             self.logger.exception("Failed to insert similar images into MongoDB", exc_info=e)
 
+    def upsert_similar_images(self, links):
+        """
+            Save similar image links with one bulk write, links that are already saved are updated.
+
+            Args:
+                links (list[dict]): Links with source_image_id, similar_image_id and the fields to set.
+
+            Returns:
+                int: Number of inserted links.
+        """
+        try:
+            result = self.similar_images_collection.bulk_write([
+                UpdateOne({"source_image_id": link["source_image_id"], "similar_image_id": link["similar_image_id"]},
+                          {"$set": link, "$setOnInsert": {"_id": str(uuid.uuid4())}}, upsert=True)
+                for link in links
+            ], ordered=False)
+            self.logger.debug(f"Upserted {len(links)} similar images links")
+            return result.upserted_count
+        except Exception as e:
+            self.logger.exception("Failed to upsert similar images into MongoDB", exc_info=e)
+            return 0
+
+    def get_compare_cache(self, key):
+        """
+            Retrieve a cached compare result.
+
+            Args:
+                key (str): Key of the cached result.
+
+            Returns:
+                dict: The cached result, or None if there is none.
+        """
+        try:
+            return self.compare_cache_collection.find_one({"_id": key})
+        except Exception as e:
+            self.logger.exception(f"Failed to retrieve compare cache entry: {key}", exc_info=e)
+            return None
+
+    def save_compare_cache(self, entry):
+        """
+            Insert or replace a cached compare result.
+
+            Args:
+                entry (dict): The cached result, its _id is the cache key.
+        """
+        try:
+            self.compare_cache_collection.replace_one({"_id": entry["_id"]}, entry, upsert=True)
+            self.logger.debug(f"Saved compare cache entry: {entry['_id']}")
+        except Exception as e:
+            self.logger.exception(f"Failed to save compare cache entry: {entry['_id']}", exc_info=e)
+
+    def delete_compare_cache_by_settings(self, settings_key):
+        """
+            Delete cached compare results of other compare settings.
+
+            Args:
+                settings_key (str): Key of the current compare settings, its results are kept.
+        """
+        try:
+            result = self.compare_cache_collection.delete_many({"settings": {"$ne": settings_key}})
+            if result.deleted_count:
+                self.logger.info(f"Deleted {result.deleted_count} compare cache entries of other settings")
+        except Exception as e:
+            self.logger.exception("Failed to delete compare cache entries of other settings", exc_info=e)
+
     def clear_all_collections(self):
         """
             Clear all collections in database.
@@ -170,6 +595,21 @@ class RecognizedImagesRepository(EnvironmentManager):
         try:
             self.collection.drop()
             self.similar_images_collection.drop()
+            self.compare_cache_collection.drop()
+            self.create_indexes()
+            # Caches of other workers find the clear by this marker, the image count may be back to what they hold
+            self.counters_collection.update_one({"_id": self.CLEARED_GENERATION_COUNTER},
+                                                {"$set": {"value": self.increment_generation()}}, upsert=True)
             self.logger.debug("All collections cleared successfully in MongoDB")
         except Exception as e:
             self.logger.exception("Failed to clear collections in MongoDB", exc_info=e)
+
+    def close(self):
+        """
+            Close the MongoDB client. Writes are acknowledged synchronously, so nothing is left to flush.
+        """
+        try:
+            self.mongo_client.close()
+            self.logger.info("MongoDB client closed")
+        except Exception as e:
+            self.logger.exception("Failed to close MongoDB client", exc_info=e)
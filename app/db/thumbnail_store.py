@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+from PIL import Image
+
+# File extension of the stored thumbnails, PNG is lossless so hashes of a stored thumbnail never change
+THUMBNAIL_EXTENSION = '.png'
+
+
+class ThumbnailStore:
+    """
+        Local disk store of normalized, downscaled copies of images keyed by their content hash.
+
+        Hashes are computed from the thumbnail instead of the full-size original, so recomputing them reads a small
+        local file instead of the image volume. The least recently used thumbnails are deleted once the store is
+        larger than its size limit. Worker processes can share the directory: files are written to a temporary name
+        and renamed, and every process evicts by its own view of the directory.
+    """
+
+    def __init__(self, path, max_size_mb, thumbnail_size, logger_level=logging.INFO):
+        """
+            Open the store and index the thumbnails saved before, least recently used first.
+
+            Args:
+                path (str): Directory of the thumbnails.
+                max_size_mb (float): Size limit of the thumbnails on disk.
+                thumbnail_size (int): Longest side of the thumbnails in pixels.
+                logger_level: Logger level.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.thumbnail_size = thumbnail_size
+        self.lock = threading.Lock()
+        # Thumbnail file paths mapped to their sizes, least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.load_entries()
+
+    def load_entries(self):
+        """
+            Index the thumbnails on disk by their modification time, which is updated on every use.
+        """
+        entries = []
+        for directory, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if not file_name.endswith(THUMBNAIL_EXTENSION):
+                    continue
+                file_path = os.path.join(directory, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, file_path, stat.st_size))
+        for _, file_path, file_size in sorted(entries):
+            self.entries[file_path] = file_size
+            self.size += file_size
+        self.logger.info(f"Thumbnail store opened with {len(self.entries)} thumbnails, "
+                         f"{self.size / 1024 / 1024:.1f} MB")
+
+    def get_file_path(self, image_xxhash):
+        """
+            Args:
+                image_xxhash (str): Content hash of the image.
+
+            Returns:
+                str: Path of the thumbnail file, in a subdirectory per first two hash characters.
+        """
+        return os.path.join(self.path, image_xxhash[:2], image_xxhash + THUMBNAIL_EXTENSION)
+
+    def create_thumbnail(self, image):
+        """
+            Normalize and downscale an image.
+
+            Args:
+                image (Image): The full-size image.
+
+            Returns:
+                Image: RGB copy with the longest side at most thumbnail_size.
+        """
+        thumbnail = image.convert('RGB')
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.LANCZOS)
+        return thumbnail
+
+    def get(self, image_xxhash):
+        """
+            Load a stored thumbnail and mark it as recently used.
+
+            Args:
+                image_xxhash (str): Content hash of the image.
+
+            Returns:
+                Image: The thumbnail, or None if it is not stored.
+        """
+        file_path = self.get_file_path(image_xxhash)
+        try:
+            with Image.open(file_path) as stored_image:
+                thumbnail = stored_image.copy()
+            os.utime(file_path)
+            file_size = os.path.getsize(file_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.size -= self.entries.pop(file_path, 0)
+            return None
+        except OSError as e:
+            self.logger.warning(f"Failed to read thumbnail {file_path}: {e}")
+            return None
+        with self.lock:
+            if file_path in self.entries:
+                self.entries.move_to_end(file_path)
+            else:
+                # Saved by another worker process
+                self.entries[file_path] = file_size
+                self.size += file_size
+        return thumbnail
+
+    def put(self, image_xxhash, image):
+        """
+            Save the thumbnail of an image and evict the least recently used thumbnails above the size limit.
+
+            Args:
+                image_xxhash (str): Content hash of the image.
+                image (Image): The full-size image.
+
+            Returns:
+                Image: The thumbnail.
+        """
+        thumbnail = self.create_thumbnail(image)
+        file_path = self.get_file_path(image_xxhash)
+        temporary_path = f'{file_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            thumbnail.save(temporary_path, format='PNG')
+            os.replace(temporary_path, file_path)
+            file_size = os.path.getsize(file_path)
+        except OSError as e:
+            self.logger.warning(f"Failed to save thumbnail {file_path}: {e}")
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return thumbnail
+
+        with self.lock:
+            self.size += file_size - self.entries.pop(file_path, 0)
+            self.entries[file_path] = file_size
+            self.evict()
+        self.logger.debug(f"Saved thumbnail {file_path}")
+        return thumbnail
+
+    def get_or_create(self, image_xxhash, image_path):
+        """
+            Load the thumbnail of an image, creating it from the original image file the first time.
+
+            Args:
+                image_xxhash (str): Content hash of the image.
+                image_path: Path to the original image file, or a file object of its content.
+
+            Returns:
+                Image: The thumbnail.
+        """
+        thumbnail = self.get(image_xxhash)
+        if thumbnail is None:
+            with Image.open(image_path) as image:
+                thumbnail = self.put(image_xxhash, image)
+        return thumbnail
+
+    def evict(self):
+        """
+            Delete the least recently used thumbnails until the store fits its size limit. Called with the lock held.
+        """
+        evicted_count = 0
+        while self.size > self.max_size and len(self.entries) > 1:
+            file_path, file_size = self.entries.popitem(last=False)
+            self.size -= file_size
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            evicted_count += 1
+        if evicted_count:
+            self.logger.debug(f"Evicted {evicted_count} thumbnails, {self.size / 1024 / 1024:.1f} MB left")
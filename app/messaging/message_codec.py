@@ -0,0 +1,184 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+ZSTD_CONTENT_ENCODING = 'zstd'
+
+
+class JsonCodec:
+    """
+        JSON payload codec. Used for messages without a content_type.
+    """
+    name = 'json'
+    content_type = JSON_CONTENT_TYPE
+
+    @staticmethod
+    def encode(message):
+        """
+            Encode a message as JSON.
+
+            Args:
+                message (dict): The message payload.
+
+            Returns:
+                bytes: The UTF-8 encoded JSON body.
+        """
+        return json.dumps(message).encode()
+
+    @staticmethod
+    def decode(body):
+        """
+            Decode a JSON message body.
+
+            Args:
+                body (bytes): The UTF-8 encoded JSON body.
+
+            Returns:
+                dict: The decoded message.
+        """
+        return json.loads(body.decode())
+
+
+class MsgpackCodec:
+    """
+        MessagePack payload codec. Smaller and cheaper to encode than JSON for responses carrying many texts.
+    """
+    name = 'msgpack'
+    content_type = MSGPACK_CONTENT_TYPE
+
+    @staticmethod
+    def encode(message):
+        """
+            Encode a message as MessagePack.
+
+            Args:
+                message (dict): The message payload.
+
+            Returns:
+                bytes: The MessagePack body.
+        """
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(body):
+        """
+            Decode a MessagePack message body.
+
+            Args:
+                body (bytes): The MessagePack body.
+
+            Returns:
+                dict: The decoded message.
+        """
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, MsgpackCodec)}
+CODECS_BY_CONTENT_TYPE = {
+    JSON_CONTENT_TYPE: JsonCodec,
+    MSGPACK_CONTENT_TYPE: MsgpackCodec,
+    'application/x-msgpack': MsgpackCodec,
+}
+
+
+def get_codec_by_content_type(content_type):
+    """
+        Return the codec for an AMQP content_type.
+
+        Args:
+            content_type (str): The content_type property of a message. JSON is used if it is not set.
+
+        Returns:
+            The codec class.
+
+        Raises:
+            ValueError: If the content type is not supported or its codec is not installed.
+    """
+    if not content_type:
+        return JsonCodec
+    codec = CODECS_BY_CONTENT_TYPE.get(content_type.split(';')[0].strip().lower())
+    if codec is None:
+        raise ValueError(f'Unsupported message content type: {content_type}')
+    if codec is MsgpackCodec and msgpack is None:
+        raise ValueError(f'msgpack is required for message content type: {content_type}')
+    return codec
+
+
+def decode_message(body, content_type=None, content_encoding=None):
+    """
+        Decode a message body according to its AMQP content_type and content_encoding properties.
+
+        Args:
+            body (bytes): The message body.
+            content_type (str): The content_type property. Messages without it are JSON.
+            content_encoding (str): The content_encoding property. Only zstd compression is supported.
+
+        Returns:
+            dict: The decoded message.
+
+        Raises:
+            ValueError: If the content type or encoding is not supported or its package is not installed.
+    """
+    if content_encoding == ZSTD_CONTENT_ENCODING:
+        if zstandard is None:
+            raise ValueError(f'zstandard is required for message content encoding: {content_encoding}')
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif content_encoding:
+        raise ValueError(f'Unsupported message content encoding: {content_encoding}')
+    return get_codec_by_content_type(content_type).decode(body)
+
+
+class MessageCodec:
+    """
+        Encodes queue payloads with the configured codec.
+
+        Msgpack payloads larger than the compression threshold are zstd-compressed and marked with the zstd
+        content_encoding. JSON payloads are never compressed so that clients without zstd can still read them.
+    """
+
+    def __init__(self, codec_name='json', compression_threshold=0, compression_level=3):
+        """
+            Initialize the codec.
+
+            Args:
+                codec_name (str): Name of the default codec, 'json' or 'msgpack'.
+                compression_threshold (int): Minimal msgpack payload size in bytes to compress. 0 disables
+                    compression.
+                compression_level (int): zstd compression level.
+        """
+        if codec_name not in CODECS:
+            raise ValueError(f'Unknown message codec: {codec_name}')
+        if codec_name == MsgpackCodec.name and msgpack is None:
+            raise ImportError('msgpack is required for the msgpack message codec')
+        if compression_threshold and zstandard is None:
+            raise ImportError('zstandard is required for message compression')
+        self.codec = CODECS[codec_name]
+        self.compression_threshold = compression_threshold
+        self.compressor = zstandard.ZstdCompressor(level=compression_level) if compression_threshold else None
+
+    def encode(self, message, content_type=None):
+        """
+            Encode a message.
+
+            Args:
+                message (dict): The message payload.
+                content_type (str): Content type to encode with. Defaults to the configured codec.
+
+            Returns:
+                tuple: The body, its content_type and its content_encoding (None if not compressed).
+        """
+        codec = get_codec_by_content_type(content_type) if content_type else self.codec
+        body = codec.encode(message)
+        if codec is MsgpackCodec and self.compressor and len(body) >= self.compression_threshold:
+            return self.compressor.compress(body), codec.content_type, ZSTD_CONTENT_ENCODING
+        return body, codec.content_type, None
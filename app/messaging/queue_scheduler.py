@@ -0,0 +1,172 @@
+import time
+from collections import deque
+
+
+def get_percentile(values, percentile):
+    """
+        Get a percentile of values by the nearest rank.
+
+        Args:
+            values (Iterable[float]): The values.
+            percentile (float): The percentile, 0 to 100.
+
+        Returns:
+            float: The value at the percentile, None if there are no values.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+
+class QueueMetrics:
+    """
+        Queue-wait and service time statistics of a single queue over a window of recent messages.
+    """
+
+    def __init__(self, window=1000):
+        """
+            Initialize empty statistics.
+
+            Args:
+                window (int): Number of recent messages the percentiles are calculated over.
+        """
+        self.wait_times = deque(maxlen=window)
+        self.service_times = deque(maxlen=window)
+        self.count = 0
+        self.slo_violations = 0
+
+    def record(self, wait_time, service_time, latency_slo=None):
+        """
+            Record a processed message.
+
+            Args:
+                wait_time (float): Seconds the message spent in the queue, or None if unknown.
+                service_time (float): Seconds spent processing the message.
+                latency_slo (float): Latency SLO of the queue in seconds, if any.
+        """
+        self.count += 1
+        self.service_times.append(service_time)
+        if wait_time is not None:
+            self.wait_times.append(wait_time)
+            if latency_slo and wait_time + service_time > latency_slo:
+                self.slo_violations += 1
+
+    def summary(self):
+        """
+            Summarize the statistics.
+
+            Returns:
+                dict: Message count, queue-wait percentiles, average service time and SLO violations.
+        """
+        return {
+            "count": self.count,
+            "wait_p50": get_percentile(self.wait_times, 50),
+            "wait_p95": get_percentile(self.wait_times, 95),
+            "wait_max": max(self.wait_times) if self.wait_times else None,
+            "service_time_avg": sum(self.service_times) / len(self.service_times) if self.service_times else None,
+            "slo_violations": self.slo_violations,
+        }
+
+
+class WeightedFairQueueScheduler:
+    """
+        Start-time fair queuing between queues that are polled with basic_get.
+
+        Every queue gets a share of worker time proportional to its weight. A queue is charged the measured service
+        time of its messages divided by its weight, so a backlog of slow OCR tasks cannot starve cheap compare tasks,
+        and a queue that was empty does not bank credit for later.
+
+        Queues with a latency SLO are polled before all others while the observed queue wait approaches the SLO.
+        Processing is not preemptive, so a task that is already running always finishes first.
+    """
+
+    def __init__(self, weights, latency_slos=None, protect_ratio=0.5, release_ratio=0.25):
+        """
+            Initialize the scheduler.
+
+            Args:
+                weights (dict): Queue names mapped to their weights.
+                latency_slos (dict): Queue names mapped to their latency SLO in seconds.
+                protect_ratio (float): Share of the SLO a queue wait must reach to poll the queue first.
+                release_ratio (float): Share of the SLO a queue wait must drop below to stop polling the queue first.
+        """
+        self.weights = weights
+        self.latency_slos = latency_slos or {}
+        self.protect_ratio = protect_ratio
+        self.release_ratio = release_ratio
+        self.virtual_time = 0.0
+        self.finish_tags = {queue_name: 0.0 for queue_name in weights}
+        self.service_time_estimates = {queue_name: None for queue_name in weights}
+        self.metrics = {queue_name: QueueMetrics() for queue_name in weights}
+        self.protected_queues = set()
+
+    def _next_finish_tag(self, queue_name):
+        """
+            Finish tag the next message of the queue would get.
+        """
+        estimate = self.service_time_estimates[queue_name]
+        if estimate is None:
+            # Unknown cost: make sure the queue is tried soon
+            estimate = 0.0
+        return max(self.virtual_time, self.finish_tags[queue_name]) + estimate / self.weights[queue_name]
+
+    def queue_order(self):
+        """
+            Return the queues in the order they should be polled for the next message.
+
+            Returns:
+                list[str]: Queues with a protected SLO first, then by their next finish tag.
+        """
+        ordered = sorted(self.weights, key=self._next_finish_tag)
+        return sorted(ordered, key=lambda queue_name: queue_name not in self.protected_queues)
+
+    def on_served(self, queue_name, wait_time, service_time):
+        """
+            Charge a queue for a processed message and update its metrics.
+
+            Args:
+                queue_name (str): The queue the message was taken from.
+                wait_time (float): Seconds the message spent in the queue, or None if unknown.
+                service_time (float): Seconds spent processing the message.
+        """
+        start_tag = max(self.virtual_time, self.finish_tags[queue_name])
+        self.virtual_time = start_tag
+        self.finish_tags[queue_name] = start_tag + service_time / self.weights[queue_name]
+
+        estimate = self.service_time_estimates[queue_name]
+        self.service_time_estimates[queue_name] = service_time if estimate is None else \
+            0.8 * estimate + 0.2 * service_time
+
+        latency_slo = self.latency_slos.get(queue_name)
+        self.metrics[queue_name].record(wait_time, service_time, latency_slo)
+        if latency_slo and wait_time is not None:
+            if wait_time >= latency_slo * self.protect_ratio:
+                self.protected_queues.add(queue_name)
+            elif wait_time < latency_slo * self.release_ratio:
+                self.protected_queues.discard(queue_name)
+
+    def summary(self):
+        """
+            Summarize the metrics of all queues.
+
+            Returns:
+                dict: Queue names mapped to their metrics summary.
+        """
+        return {queue_name: metrics.summary() for queue_name, metrics in self.metrics.items()}
+
+    @staticmethod
+    def get_wait_time(properties):
+        """
+            Calculate how long a message waited in its queue from its AMQP timestamp property.
+
+            Args:
+                properties: Properties of the message.
+
+            Returns:
+                float: Seconds since the message was published, or None if it has no timestamp.
+        """
+        timestamp = getattr(properties, 'timestamp', None)
+        if not timestamp:
+            return None
+        return max(0.0, time.time() - timestamp)
@@ -6,6 +6,9 @@ import logging
 from pika.exceptions import AMQPConnectionError
 
 from app.config.environment_manager import EnvironmentManager
+from app.messaging.message_codec import JSON_CONTENT_TYPE, MessageCodec, decode_message
+from app.messaging.rabbitmq_publisher import RabbitMQPublisher
+from app.messaging.rabbitmq_rpc_client import RabbitMQRpcClient
 from app.services.image_service import OCR_IMAGE_QUEUE, COMPARE_IMAGES_QUEUE, RESPONSE_QUEUE, MAINTENANCE_QUEUE
 
 
@@ -26,7 +29,15 @@ class RabbitMQConnection(EnvironmentManager):
             'RABBITMQ_HOST', 'RABBITMQ_PORT', 'RABBITMQ_USERNAME',
             'RABBITMQ_PASSWORD', 'RABBITMQ_VHOST', 'RABBITMQ_HEARTBEAT',
             'RABBITMQ_BLOCKED_CONNECTION_TIMEOUT'
-        ])
+        ], {
+            'RABBITMQ_RPC_TIMEOUT': '300',
+            'RABBITMQ_PUBLISHER_CONFIRMS': 'True',
+            'RABBITMQ_PUBLISHER_CONFIRM_WINDOW': '256',
+            'RABBITMQ_PUBLISHER_FLUSH_TIMEOUT': '30',
+            'MESSAGE_CODEC': 'json',
+            'MESSAGE_COMPRESSION_THRESHOLD': '0',
+            'MESSAGE_COMPRESSION_LEVEL': '3'
+        })
 
         # Assign loaded environment variables to instance variables
         self._set_environment_vars()
@@ -34,6 +45,9 @@ class RabbitMQConnection(EnvironmentManager):
         # Setup connection attributes
         self.connection = None
         self.channel = None
+        self.publisher = None
+        self.rpc_client = None
+        self.awaited_replies = {}
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing RabbitMQConnection...')
@@ -52,6 +66,15 @@ class RabbitMQConnection(EnvironmentManager):
         self.rabbitmq_vhost = self.env_vars['RABBITMQ_VHOST']
         self.rabbitmq_heartbeat = int(self.env_vars['RABBITMQ_HEARTBEAT'])
         self.rabbitmq_blocked_connection_timeout = int(self.env_vars['RABBITMQ_BLOCKED_CONNECTION_TIMEOUT'])
+        self.rabbitmq_rpc_timeout = float(self.env_vars['RABBITMQ_RPC_TIMEOUT'])
+        self.rabbitmq_publisher_confirms = self.env_vars['RABBITMQ_PUBLISHER_CONFIRMS'].lower() == "true"
+        self.rabbitmq_publisher_confirm_window = int(self.env_vars['RABBITMQ_PUBLISHER_CONFIRM_WINDOW'])
+        self.rabbitmq_publisher_flush_timeout = float(self.env_vars['RABBITMQ_PUBLISHER_FLUSH_TIMEOUT'])
+        self.message_codec = MessageCodec(
+            self.env_vars['MESSAGE_CODEC'].lower(),
+            int(self.env_vars['MESSAGE_COMPRESSION_THRESHOLD']),
+            int(self.env_vars['MESSAGE_COMPRESSION_LEVEL'])
+        )
 
     def _setup_connection(self):
         """
@@ -116,73 +139,201 @@ class RabbitMQConnection(EnvironmentManager):
                 self.logger.error('Failed to connect to RabbitMQ, retrying...')
                 time.sleep(5)
 
+    def get_publisher(self):
+        """
+            Return the confirm-mode publisher, starting it on first use.
+
+            Returns:
+                RabbitMQPublisher: The publisher, or None if publisher confirms are disabled.
+        """
+        if self.rabbitmq_publisher_confirms and self.publisher is None:
+            self.publisher = RabbitMQPublisher(self.parameters, self.rabbitmq_publisher_confirm_window,
+                                               self.logger_level)
+            self.publisher.start(timeout=self.rabbitmq_blocked_connection_timeout)
+        return self.publisher
+
+    def publish(self, exchange, routing_key, body, properties):
+        """
+            Publish a message, with publisher confirms if they are enabled.
+
+            With confirms the call returns once the message is queued in the confirm window; use flush() to wait
+            for the broker to confirm it.
+
+            Args:
+                exchange (str): The exchange to publish to.
+                routing_key (str): The routing key of the message.
+                body (bytes): The message body.
+                properties (pika.BasicProperties): The message properties.
+        """
+        publisher = self.get_publisher()
+        if publisher:
+            publisher.publish(exchange, routing_key, body, properties)
+        else:
+            self.channel.basic_publish(exchange=exchange, routing_key=routing_key, properties=properties, body=body)
+
+    def publish_dead_letter(self, body):
+        """
+            Publish a rejected message to the Dead Letter Exchange.
+
+            Args:
+                body (bytes): The rejected message body.
+        """
+        self.publish(self.dlx_exchange, 'rejected', body, pika.BasicProperties(delivery_mode=2))
+
+    def flush(self, timeout=None):
+        """
+            Wait until the broker has confirmed every published message.
+
+            Args:
+                timeout (float): Number of seconds to wait. Defaults to RABBITMQ_PUBLISHER_FLUSH_TIMEOUT.
+
+            Returns:
+                bool: True if all messages were confirmed.
+        """
+        if self.publisher is None:
+            return True
+        return self.publisher.flush(self.rabbitmq_publisher_flush_timeout if timeout is None else timeout)
+
     def close(self):
         """
-            Close the RabbitMQ connection if it exists.
+            Flush pending publishes and close the RabbitMQ connection if it exists.
         """
+        if self.rpc_client:
+            self.rpc_client.close()
+            self.rpc_client = None
+            self.awaited_replies = {}
+        if self.publisher:
+            self.publisher.stop(self.rabbitmq_publisher_flush_timeout)
+            self.publisher = None
         if self.connection and not self.connection.is_closed:
             self.connection.close()
             self.logger.info('Closed RabbitMQ connection')
 
-    def send_message(self, queue_name, message):
+    def send_message(self, queue_name, message, reply_to=RESPONSE_QUEUE, correlation_id=None):
         """
             Send a message to a specified RabbitMQ queue.
 
+            The reply queue is not declared here: the shared response queue is declared on connect and RPC reply
+            queues are declared by their RabbitMQRpcClient. Use send_request for a reply awaited with
+            consume_response.
+
             Args:
                 queue_name (str): The name of the destination queue.
                 message (dict): The message payload.
+                reply_to (str): The queue the reply should be sent to.
+                correlation_id (str): The correlation id of the message. A new one is generated if not given.
 
             Returns:
                 tuple: The callback queue name and correlation id.
         """
-        callback_queue = 'response_queue'
-        self.channel.queue_declare(queue=callback_queue, durable=True)
-        correlation_id = str(uuid.uuid4())
-        self.channel.basic_publish(
-            exchange='',
-            routing_key=queue_name,
-            properties=pika.BasicProperties(
-                reply_to=callback_queue,
-                correlation_id=correlation_id,
-            ),
-            body=json.dumps(message)
-        )
+        correlation_id = correlation_id or str(uuid.uuid4())
+        body, content_type, content_encoding = self.message_codec.encode(message)
+        self.publish('', queue_name, body, pika.BasicProperties(
+            reply_to=reply_to,
+            correlation_id=correlation_id,
+            timestamp=int(time.time()),
+            content_type=content_type,
+            content_encoding=content_encoding,
+        ))
         self.logger.debug('Sent message to queue: %s', queue_name)
-        return callback_queue, correlation_id
+        return reply_to, correlation_id
 
-    def consume_response(self, callback_queue, correlation_id):
+    def send_reply(self, request_properties, message):
         """
-            Consume messages from the callback queue and filter them by correlation_id.
+            Send a reply to the queue requested in the reply_to property of a request.
+
+            The reply is encoded with the content type of the request, so clients that did not set one keep
+            receiving JSON.
 
             Args:
-                callback_queue (str): The name of the callback queue.
-                correlation_id (str): The correlation id to filter the messages by.
+                request_properties: Properties of the request message.
+                message (dict): The reply payload.
+        """
+        reply_to = getattr(request_properties, 'reply_to', None) or RESPONSE_QUEUE
+        request_content_type = getattr(request_properties, 'content_type', None) or JSON_CONTENT_TYPE
+        body, content_type, content_encoding = self.message_codec.encode(message, request_content_type)
+        self.publish('', reply_to, body, pika.BasicProperties(
+            correlation_id=getattr(request_properties, 'correlation_id', None),
+            content_type=content_type,
+            content_encoding=content_encoding,
+        ))
+        self.logger.debug('Sent reply to queue: %s', reply_to)
+
+    def get_rpc_client(self):
+        """
+            Return the RPC client of this connection, declaring its exclusive reply queue on first use.
 
             Returns:
-                str: The decoded message body that matches the given correlation_id.
+                RabbitMQRpcClient: The RPC client.
         """
-        while True:
-            try:
-                method_frame, properties, body = self.channel.basic_get(callback_queue)
-                if method_frame:
-                    self.channel.basic_ack(method_frame.delivery_tag)
-                    if properties.correlation_id == correlation_id:
-                        self.logger.debug('Received response message')
-                        self.logger.debug('Response message: %s', body.decode())
-                        return body.decode()
-            except AMQPConnectionError:
-                self.logger.error('Connection error to RabbitMQ, reconnecting...')
-                self.connect()
+        if self.rpc_client is None:
+            self.rpc_client = RabbitMQRpcClient(self, self.rabbitmq_rpc_timeout)
+        return self.rpc_client
+
+    def send_request(self, queue_name, message):
+        """
+            Send a message whose reply is awaited with consume_response.
+
+            The reply is sent to the exclusive reply queue of this connection, so it is never consumed by other
+            callers and never has to be requeued for them.
+
+            Args:
+                queue_name (str): The name of the destination queue.
+                message (dict): The message payload.
+
+            Returns:
+                tuple: The callback queue name and correlation id.
+        """
+        rpc_client = self.get_rpc_client()
+        future = rpc_client.call_async(queue_name, message)
+        self.awaited_replies[future.correlation_id] = future
+        return rpc_client.callback_queue, future.correlation_id
+
+    def consume_response(self, callback_queue, correlation_id, timeout=None):
+        """
+            Wait for the reply to a request sent with send_request.
+
+            Connection events are processed until the reply consumer routes the reply with the given correlation_id,
+            replies to other outstanding requests of this connection are kept for their own consume_response call.
+
+            Args:
+                callback_queue (str): The name of the callback queue returned by send_request.
+                correlation_id (str): The correlation id returned by send_request.
+                timeout (float): Number of seconds to wait. Defaults to RABBITMQ_RPC_TIMEOUT.
+
+            Returns:
+                str: The JSON message body that matches the given correlation_id.
+
+            Raises:
+                ValueError: If no request with the given correlation_id awaits a reply on the callback queue.
+                TimeoutError: If no matching message was received in time.
+        """
+        future = self.awaited_replies.get(correlation_id)
+        if future is None or callback_queue != self.rpc_client.callback_queue:
+            raise ValueError(f'No request {correlation_id} awaits a reply on {callback_queue}, '
+                             f'send it with send_request')
+        try:
+            response = self.rpc_client.wait(future, timeout)
+        finally:
+            self.awaited_replies.pop(correlation_id, None)
+        body = json.dumps(response)
+        self.logger.debug('Received response message')
+        self.logger.debug('Response message: %s', body)
+        return body
 
     @staticmethod
-    def parse_message(body):
+    def parse_message(body, properties=None):
         """
-            Parse the received RabbitMQ message body into a JSON object.
+            Parse the received RabbitMQ message body with the codec selected by its content_type.
+
+            Messages without a content_type are parsed as JSON.
 
             Args:
                 body (bytes): The message body.
+                properties: Properties of the message.
 
             Returns:
-                dict: The parsed JSON message.
+                dict: The parsed message.
         """
-        return json.loads(body.decode())
+        return decode_message(body, getattr(properties, 'content_type', None),
+                              getattr(properties, 'content_encoding', None))
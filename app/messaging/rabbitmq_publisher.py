@@ -0,0 +1,348 @@
+import time
+import logging
+import functools
+import threading
+from collections import OrderedDict, deque
+
+import pika
+from pika.adapters.select_connection import IOLoop
+
+
+class ConfirmWindow:
+    """
+        Bounded window of publishes that have not been confirmed by the broker yet.
+
+        A slot is reserved by the publishing thread before a message is handed to the I/O thread and released when
+        the broker acks the message, so at most `size` messages are unconfirmed at any time. Delivery tags are
+        assigned by the I/O thread in the order messages are written to the channel.
+    """
+
+    def __init__(self, size):
+        """
+            Initialize an empty window.
+
+            Args:
+                size (int): Maximum number of unconfirmed messages.
+        """
+        self.size = max(1, size)
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.unconfirmed = OrderedDict()
+        self.next_delivery_tag = 1
+        self.confirmed_count = 0
+        self.nacked_count = 0
+
+    def reserve(self, timeout=None):
+        """
+            Reserve a slot for a new message, blocking while the window is full.
+
+            Args:
+                timeout (float): Number of seconds to wait for a free slot. Waits forever if None.
+
+            Raises:
+                TimeoutError: If no slot was released in time.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_flight < self.size, timeout):
+                raise TimeoutError('Publisher confirm window is full')
+            self.in_flight += 1
+
+    def track(self, message):
+        """
+            Assign the next delivery tag to a message written to the channel.
+
+            Args:
+                message (tuple): The published message.
+
+            Returns:
+                int: The delivery tag of the message.
+        """
+        with self.condition:
+            delivery_tag = self.next_delivery_tag
+            self.next_delivery_tag += 1
+            self.unconfirmed[delivery_tag] = message
+            return delivery_tag
+
+    def confirm(self, delivery_tag, multiple, ack):
+        """
+            Resolve messages confirmed by the broker.
+
+            Acked messages free their slots. Nacked messages keep their slots and are returned for republishing.
+
+            Args:
+                delivery_tag (int): Delivery tag from the confirmation frame.
+                multiple (bool): Whether all messages up to and including the delivery tag are confirmed.
+                ack (bool): True for Basic.Ack, False for Basic.Nack.
+
+            Returns:
+                list[tuple]: The resolved messages.
+        """
+        with self.condition:
+            if multiple:
+                delivery_tags = []
+                for tag in self.unconfirmed:
+                    if tag > delivery_tag:
+                        break
+                    delivery_tags.append(tag)
+            else:
+                delivery_tags = [delivery_tag] if delivery_tag in self.unconfirmed else []
+            messages = [self.unconfirmed.pop(tag) for tag in delivery_tags]
+            if ack:
+                self.in_flight -= len(messages)
+                self.confirmed_count += len(messages)
+                self.condition.notify_all()
+            else:
+                self.nacked_count += len(messages)
+            return messages
+
+    def reset(self):
+        """
+            Forget the delivery tags of a closed channel.
+
+            Returns:
+                list[tuple]: Messages that were written to the channel but never confirmed, in publish order.
+        """
+        with self.condition:
+            messages = list(self.unconfirmed.values())
+            self.unconfirmed.clear()
+            self.next_delivery_tag = 1
+            return messages
+
+    def wait_until_empty(self, timeout=None):
+        """
+            Wait until every reserved message has been confirmed.
+
+            Args:
+                timeout (float): Number of seconds to wait. Waits forever if None.
+
+            Returns:
+                bool: True if all messages were confirmed.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_flight == 0, timeout)
+
+
+class RabbitMQPublisher:
+    """
+        Asynchronous publisher with publisher confirms.
+
+        Runs its own connection on a background I/O thread with the channel in confirm mode. `publish` returns as
+        soon as the message is queued for the I/O thread, confirmations are processed asynchronously and the number
+        of unconfirmed messages is bounded by a ConfirmWindow, which applies backpressure to publishing threads.
+        Messages that were nacked or left unconfirmed by a lost channel are republished.
+    """
+
+    def __init__(self, parameters, window_size, logger_level=logging.INFO, connection_factory=None, ioloop=None):
+        """
+            Initialize the publisher without connecting.
+
+            Args:
+                parameters (pika.ConnectionParameters): Connection parameters of the broker.
+                window_size (int): Maximum number of unconfirmed messages.
+                logger_level (int): Logger level.
+                connection_factory (callable): Factory with the pika.SelectConnection signature. Used to run the
+                    publisher against a broker stand-in.
+                ioloop: I/O loop shared by all connections of the publisher.
+        """
+        self.parameters = parameters
+        self.confirm_window = ConfirmWindow(window_size)
+        self.connection_factory = connection_factory or pika.SelectConnection
+        self.ioloop = ioloop or IOLoop()
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+
+        self._connection = None
+        self._channel = None
+        self._unsent = deque()
+        self._publish_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self, timeout=None):
+        """
+            Start the I/O thread and wait until the confirm-mode channel is open.
+
+            Args:
+                timeout (float): Number of seconds to wait for the channel. Waits forever if None.
+
+            Returns:
+                bool: True if the channel is ready.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='rabbitmq-publisher', daemon=True)
+            self._thread.start()
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        """
+            Run the I/O loop of the publisher until it is stopped.
+        """
+        self.ioloop.add_callback_threadsafe(self._connect)
+        self.ioloop.start()
+        self.logger.info('Publisher I/O loop stopped')
+
+    def _connect(self):
+        """
+            Open a new connection to the broker on the I/O thread.
+        """
+        self._connection = self.connection_factory(
+            self.parameters,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self.ioloop
+        )
+
+    def _reconnect_later(self):
+        """
+            Schedule a reconnect unless the publisher is stopping.
+        """
+        if self._stopping:
+            self.ioloop.stop()
+        else:
+            self.ioloop.call_later(5, self._connect)
+
+    def _on_connection_open(self, connection):
+        """
+            Open a channel on the new connection.
+        """
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        """
+            Retry after a failed connection attempt.
+        """
+        self.logger.error('Publisher failed to connect to RabbitMQ, retrying...')
+        self._reconnect_later()
+
+    def _on_connection_closed(self, connection, reason):
+        """
+            Stop publishing on the closed connection and reconnect unless the publisher is stopping.
+        """
+        self._channel = None
+        self._ready.clear()
+        if not self._stopping:
+            self.logger.error(f'Publisher connection closed: {reason}')
+        self._reconnect_later()
+
+    def _on_channel_open(self, channel):
+        """
+            Put the new channel in confirm mode.
+        """
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_delivery_confirmation,
+                                 callback=functools.partial(self._on_confirm_mode, channel))
+
+    def _on_channel_closed(self, channel, reason):
+        """
+            Close the connection of an unexpectedly closed channel so that the publisher reconnects.
+        """
+        self._channel = None
+        self._ready.clear()
+        if self._connection and self._connection.is_open and not self._stopping:
+            self.logger.error(f'Publisher channel closed: {reason}')
+            self._connection.close()
+
+    def _on_confirm_mode(self, channel, frame):
+        """
+            Start publishing on a channel that entered confirm mode.
+
+            Messages left unconfirmed by a previous channel are republished first, then messages queued while no
+            channel was open.
+        """
+        self._channel = channel
+        for message in self.confirm_window.reset():
+            self._write(message)
+        while self._unsent and self._channel:
+            self._write(self._unsent.popleft())
+        self._ready.set()
+        self.logger.info('Publisher channel is in confirm mode')
+
+    def _on_delivery_confirmation(self, frame):
+        """
+            Handle Basic.Ack and Basic.Nack frames of the confirm-mode channel.
+        """
+        ack = isinstance(frame.method, pika.spec.Basic.Ack)
+        messages = self.confirm_window.confirm(frame.method.delivery_tag, frame.method.multiple, ack)
+        if not ack:
+            self.logger.warning(f'Broker nacked {len(messages)} messages, republishing')
+            for message in messages:
+                self._send(message)
+
+    def _send(self, message):
+        """
+            Write a message to the channel, or queue it until a channel is open. Runs on the I/O thread.
+        """
+        if self._channel is None or not self._channel.is_open:
+            self._unsent.append(message)
+            return
+        self._write(message)
+
+    def _write(self, message):
+        """
+            Track and write a message to the open channel. Runs on the I/O thread.
+        """
+        exchange, routing_key, body, properties = message
+        self.confirm_window.track(message)
+        self._channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+
+    def publish(self, exchange, routing_key, body, properties=None, timeout=None):
+        """
+            Queue a message for publishing with confirms.
+
+            Blocks only while the confirm window is full.
+
+            Args:
+                exchange (str): The exchange to publish to.
+                routing_key (str): The routing key of the message.
+                body (bytes): The message body.
+                properties (pika.BasicProperties): The message properties.
+                timeout (float): Number of seconds to wait for a free slot in the window. Waits forever if None.
+        """
+        if self._thread is None:
+            self.start(timeout=0)
+        message = (exchange, routing_key, body, properties)
+        # Keep reservation and hand-off in one order so that delivery tags follow publish order
+        with self._publish_lock:
+            self.confirm_window.reserve(timeout)
+            self.ioloop.add_callback_threadsafe(functools.partial(self._send, message))
+
+    def flush(self, timeout=None):
+        """
+            Wait until every published message has been confirmed.
+
+            Args:
+                timeout (float): Number of seconds to wait. Waits forever if None.
+
+            Returns:
+                bool: True if all messages were confirmed.
+        """
+        confirmed = self.confirm_window.wait_until_empty(timeout)
+        if not confirmed:
+            self.logger.warning(f'{self.confirm_window.in_flight} messages are still unconfirmed')
+        return confirmed
+
+    def stop(self, timeout=None):
+        """
+            Flush outstanding messages and stop the I/O thread.
+
+            Args:
+                timeout (float): Number of seconds to wait for outstanding confirms.
+        """
+        if self._thread is None:
+            return
+        start_time = time.monotonic()
+        self.flush(timeout)
+        self._stopping = True
+
+        def close_connection():
+            if self._connection and self._connection.is_open:
+                self._connection.close()
+            else:
+                self.ioloop.stop()
+
+        self.ioloop.add_callback_threadsafe(close_connection)
+        remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start_time))
+        self._thread.join(remaining)
+        self._thread = None
@@ -0,0 +1,182 @@
+import time
+import uuid
+import logging
+from concurrent.futures import Future
+
+from pika.exceptions import AMQPConnectionError
+
+
+class RabbitMQRpcClient:
+    """
+        RPC client that pipelines requests over a single RabbitMQ connection.
+
+        Each client owns an exclusive, server-named reply queue consumed with basic_consume. Replies are routed to
+        futures by correlation id, so many requests can be outstanding at once and replies of other clients are
+        never consumed or discarded.
+    """
+
+    def __init__(self, messaging_connection, timeout=None):
+        """
+            Declare the exclusive reply queue and start consuming from it.
+
+            Args:
+                messaging_connection (RabbitMQConnection): Connection used to publish requests and receive replies.
+                timeout (float): Default number of seconds to wait for a reply. Defaults to RABBITMQ_RPC_TIMEOUT.
+        """
+        self.messaging_connection = messaging_connection
+        self.timeout = messaging_connection.rabbitmq_rpc_timeout if timeout is None else timeout
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(messaging_connection.logger_level)
+
+        self.pending_responses = {}
+        self.callback_queue = None
+        self.consumer_tag = None
+        self._declare_callback_queue()
+
+    def _declare_callback_queue(self):
+        """
+            Declare the exclusive reply queue of this client and register the reply consumer.
+        """
+        channel = self.messaging_connection.channel
+        result = channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+        self.callback_queue = result.method.queue
+        self.consumer_tag = channel.basic_consume(
+            queue=self.callback_queue, on_message_callback=self._on_response, auto_ack=True
+        )
+        self.logger.debug('Declared RPC reply queue: %s', self.callback_queue)
+
+    def _on_response(self, channel, method, properties, body):
+        """
+            Resolve the future waiting for the received reply.
+
+            Args:
+                channel: Channel the reply was received on.
+                method: Method frame of the reply.
+                properties: Properties of the reply.
+                body (bytes): The reply body.
+        """
+        future = self.pending_responses.pop(properties.correlation_id, None)
+        if future is None:
+            # The caller gave up waiting for this reply
+            self.logger.warning('Dropped reply with unknown correlation id: %s', properties.correlation_id)
+            return
+        try:
+            future.set_result(self.messaging_connection.parse_message(body, properties))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _fail_pending(self, exception):
+        """
+            Fail every outstanding request with the given exception.
+
+            Args:
+                exception (Exception): Exception set on the pending futures.
+        """
+        pending_responses, self.pending_responses = self.pending_responses, {}
+        for future in pending_responses.values():
+            future.set_exception(exception)
+
+    def _reconnect(self):
+        """
+            Reconnect to RabbitMQ and declare a new reply queue.
+
+            Replies to requests sent before the connection was lost are gone together with the old exclusive queue,
+            so their futures are failed.
+        """
+        self.logger.error('Connection error to RabbitMQ, reconnecting...')
+        self._fail_pending(ConnectionError('RabbitMQ connection lost before the reply was received'))
+        self.messaging_connection.connect()
+        self._declare_callback_queue()
+
+    def call_async(self, queue_name, message):
+        """
+            Send a request without waiting for its reply.
+
+            Args:
+                queue_name (str): The name of the destination queue.
+                message (dict): The request payload.
+
+            Returns:
+                Future: Future resolved with the parsed reply.
+        """
+        correlation_id = str(uuid.uuid4())
+        future = Future()
+        future.correlation_id = correlation_id
+        self.pending_responses[correlation_id] = future
+        try:
+            self.messaging_connection.send_message(
+                queue_name, message, reply_to=self.callback_queue, correlation_id=correlation_id
+            )
+        except Exception:
+            self.pending_responses.pop(correlation_id, None)
+            raise
+        return future
+
+    def wait(self, future, timeout=None):
+        """
+            Process connection events until the future is resolved or the timeout expires.
+
+            Args:
+                future (Future): Future returned by call_async.
+                timeout (float): Number of seconds to wait. Defaults to the client timeout.
+
+            Returns:
+                dict: The parsed reply.
+
+            Raises:
+                TimeoutError: If no reply was received in time.
+        """
+        self.wait_all([future], timeout)
+        return future.result()
+
+    def wait_all(self, futures, timeout=None):
+        """
+            Process connection events until all futures are resolved or the timeout expires.
+
+            Futures still pending at the deadline are failed with TimeoutError; late replies to them are dropped.
+
+            Args:
+                futures (list[Future]): Futures returned by call_async.
+                timeout (float): Number of seconds to wait for all replies. Defaults to the client timeout.
+
+            Returns:
+                list[Future]: The given futures, all of them done.
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while not all(future.done() for future in futures):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for future in futures:
+                    if not future.done():
+                        self.pending_responses.pop(future.correlation_id, None)
+                        future.set_exception(TimeoutError(f'No reply received for {future.correlation_id}'))
+                break
+            try:
+                self.messaging_connection.connection.process_data_events(time_limit=remaining)
+            except AMQPConnectionError:
+                self._reconnect()
+        return futures
+
+    def call(self, queue_name, message, timeout=None):
+        """
+            Send a request and wait for its reply.
+
+            Args:
+                queue_name (str): The name of the destination queue.
+                message (dict): The request payload.
+                timeout (float): Number of seconds to wait. Defaults to the client timeout.
+
+            Returns:
+                dict: The parsed reply.
+        """
+        return self.wait(self.call_async(queue_name, message), timeout)
+
+    def close(self):
+        """
+            Stop consuming replies and fail requests that are still outstanding.
+        """
+        self._fail_pending(ConnectionError('RPC client closed'))
+        channel = self.messaging_connection.channel
+        if self.consumer_tag and channel and channel.is_open:
+            channel.basic_cancel(self.consumer_tag)
+        self.consumer_tag = None
@@ -0,0 +1,425 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from app.config.environment_manager import EnvironmentManager
+from app.db.image_columns_cache import COMPARE_PROJECTION
+from app.db.recognized_images_repository import RecognizedImagesRepository
+from app.services.image_hash_service import ImageHashService
+from app.services.image_similarity_service import ImageSimilarityService
+
+# Images of an oversized bucket are sorted by average hash and paired with this many following neighbours
+OVERSIZED_BUCKET_NEIGHBORS = 4
+
+# Prime modulus of the MinHash permutations and the seed of their coefficients
+MINHASH_PRIME = (1 << 31) - 1
+MINHASH_SEED = 42
+
+# Multiplier combining the MinHash rows of a band into one key
+MINHASH_BAND_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# Minimal interval in seconds between progress log lines of a stage
+PROGRESS_LOG_INTERVAL = 10
+
+
+class DuplicateClusteringService(EnvironmentManager):
+    """
+        Offline job grouping all stored images into connected components of near-duplicates.
+
+        Comparing all pairs is quadratic, so candidate pairs are found by blocking: images sharing a band of one of the
+        64-bit hashes, or a band of MinHash rows of their terms, land in the same bucket. The candidates are scored in
+        chunks with the configured text metric and the exact hash comparison of is_similar, and the similar pairs are
+        saved as similar image links with the id of their component. Workers run it on a background thread with start,
+        so the consumer keeps serving tasks and heartbeats while a large collection is clustered.
+    """
+
+    def __init__(self, db_connection=None, image_hash_service=None, image_similarity_service=None):
+        """
+            Initialize the job, services that are not passed are created.
+
+            Args:
+                db_connection (RecognizedImagesRepository): Repository of the stored images.
+                image_hash_service (ImageHashService): Service comparing image hashes.
+                image_similarity_service (ImageSimilarityService): Service comparing texts.
+        """
+        super().__init__([], {
+            'DEDUP_HASH_BANDS': '0',
+            'DEDUP_MINHASH_BANDS': '20',
+            'DEDUP_MINHASH_ROWS': '3',
+            'DEDUP_MAX_BUCKET_SIZE': '1000',
+            'DEDUP_LOAD_BATCH_SIZE': '10000',
+            'DEDUP_PAIR_CHUNK_SIZE': '100000',
+            'DEDUP_WRITE_BATCH_SIZE': '1000'
+        })
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(self.logger_level)
+        self.db_connection = db_connection or RecognizedImagesRepository()
+        self.image_hash_service = image_hash_service or ImageHashService()
+        self.image_similarity_service = image_similarity_service or ImageSimilarityService()
+        self.hash_bands = int(self.env_vars['DEDUP_HASH_BANDS'])
+        self.minhash_bands = int(self.env_vars['DEDUP_MINHASH_BANDS'])
+        self.minhash_rows = int(self.env_vars['DEDUP_MINHASH_ROWS'])
+        self.max_bucket_size = int(self.env_vars['DEDUP_MAX_BUCKET_SIZE'])
+        self.load_batch_size = int(self.env_vars['DEDUP_LOAD_BATCH_SIZE'])
+        self.pair_chunk_size = int(self.env_vars['DEDUP_PAIR_CHUNK_SIZE'])
+        self.write_batch_size = int(self.env_vars['DEDUP_WRITE_BATCH_SIZE'])
+        random = np.random.default_rng(MINHASH_SEED)
+        permutations = self.minhash_bands * self.minhash_rows
+        self.minhash_a = random.integers(1, MINHASH_PRIME, permutations, dtype=np.int64)
+        self.minhash_b = random.integers(0, MINHASH_PRIME, permutations, dtype=np.int64)
+        self.progress_logged_at = 0
+        self.images_count = 0
+        self.thread = None
+        self.state = 'idle'
+        self.stage = None
+        self.last_summary = None
+
+    def start(self):
+        """
+            Start clustering on a background thread, unless it is running already.
+
+            Returns:
+                bool: True if it was started.
+        """
+        if self.is_running():
+            return False
+        self.thread = threading.Thread(target=self.run_in_background, name='duplicate-clustering', daemon=True)
+        self.thread.start()
+        return True
+
+    def is_running(self):
+        """
+            Returns:
+                bool: True while the background thread runs.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def status(self):
+        """
+            Returns:
+                dict: State, current stage and the summary of the last completed run.
+        """
+        return {
+            "state": self.state,
+            "stage": self.stage,
+            "summary": self.last_summary,
+        }
+
+    def run_in_background(self):
+        """
+            Run the clustering and keep its outcome for status. Target of the background thread.
+        """
+        self.state = 'running'
+        try:
+            self.last_summary = self.run()
+            self.state = 'completed'
+        except Exception as e:
+            self.logger.exception("Duplicate clustering failed", exc_info=e)
+            self.state = 'failed'
+        self.stage = None
+
+    def log_progress(self, stage, done, total, start_time):
+        """
+            Log the progress and throughput of a stage, at most every PROGRESS_LOG_INTERVAL seconds and when done.
+
+            Args:
+                stage (str): Name of the stage and its unit.
+                done (int): Items processed so far.
+                total (int): Items to process.
+                start_time (float): perf_counter value at the start of the stage.
+        """
+        now = time.perf_counter()
+        if done < total and now - self.progress_logged_at < PROGRESS_LOG_INTERVAL:
+            return
+        self.progress_logged_at = now
+        elapsed = now - start_time
+        self.logger.info(f"{stage}: {done}/{total} in {elapsed:.1f} s, {done / max(elapsed, 1e-9):.0f}/s")
+
+    def get_minhash_band_keys(self, term_counts):
+        """
+            Get the MinHash band keys of the term sets of images.
+
+            Args:
+                term_counts (csr_matrix): Term counts of the images, images x terms.
+
+            Returns:
+                tuple: Band keys shaped images x bands, and a mask of the images that have terms.
+        """
+        has_terms = np.diff(term_counts.indptr) > 0
+        keys = np.zeros((term_counts.shape[0], self.minhash_bands), dtype=np.uint64)
+        if not has_terms.any():
+            return keys, has_terms
+        term_ids = term_counts.indices.astype(np.int64)
+        starts = term_counts.indptr[:-1][has_terms]
+        for band in range(self.minhash_bands):
+            for row in range(band * self.minhash_rows, (band + 1) * self.minhash_rows):
+                # Empty rows have no terms between their start and the next one, so reduceat skips them
+                signature = np.minimum.reduceat((self.minhash_a[row] * term_ids + self.minhash_b[row]) % MINHASH_PRIME,
+                                                starts)
+                keys[has_terms, band] = keys[has_terms, band] * MINHASH_BAND_MULTIPLIER ^ signature.astype(np.uint64)
+        return keys, has_terms
+
+    def load_images(self):
+        """
+            Stream the stored images into arrays.
+
+            Returns:
+                dict: Image ids, hash arrays, term counts over one vocabulary, MinHash band keys, and the texts when
+                the text metric needs them.
+        """
+        total = self.db_connection.count_images()
+        uses_texts = self.image_similarity_service.text_similarity_metric.uses_texts
+        vocabulary = {}
+        image_ids, texts, hash_arrays, band_keys, has_terms = [], [], [], [], []
+        term_ids, counts, row_lengths = [], [], []
+        start_time = time.perf_counter()
+        for images in self.db_connection.iterate_images(COMPARE_PROJECTION, self.load_batch_size):
+            missing_term_frequencies = {}
+            batch_term_ids, batch_counts = [], []
+            for image in images:
+                frequencies = image.term_frequencies
+                if frequencies is None:
+                    frequencies = self.image_similarity_service.get_term_frequencies(image.recognized_text)
+                    missing_term_frequencies[image.id] = frequencies
+                batch_term_ids.extend(vocabulary.setdefault(term, len(vocabulary)) for term in frequencies)
+                batch_counts.extend(frequencies.values())
+                row_lengths.append(len(frequencies))
+                image_ids.append(image.id)
+                if uses_texts:
+                    texts.append(image.recognized_text)
+            if missing_term_frequencies:
+                self.db_connection.update_term_frequencies(missing_term_frequencies)
+
+            batch_lengths = np.array(row_lengths[-len(images):], dtype=np.int64)
+            batch_term_counts = csr_matrix((np.array(batch_counts, dtype=np.float32),
+                                            np.array(batch_term_ids, dtype=np.int32),
+                                            np.concatenate([[0], np.cumsum(batch_lengths)])),
+                                           shape=(len(images), max(1, len(vocabulary))))
+            keys, batch_has_terms = self.get_minhash_band_keys(batch_term_counts)
+            term_ids.append(batch_term_counts.indices)
+            counts.append(batch_term_counts.data)
+            band_keys.append(keys)
+            has_terms.append(batch_has_terms)
+            hash_arrays.append(self.image_hash_service.get_hash_arrays(images, self.image_hash_service.hash_types))
+            self.log_progress('Loaded images', len(image_ids), total, start_time)
+
+        count = len(image_ids)
+        if not count:
+            return None
+        term_counts = csr_matrix((np.concatenate(counts), np.concatenate(term_ids),
+                                  np.concatenate([[0], np.cumsum(row_lengths)])),
+                                 shape=(count, max(1, len(vocabulary))))
+        # Products of rows with sorted terms skip sorting them for every chunk of pairs
+        term_counts.sort_indices()
+        return {
+            'image_ids': image_ids,
+            'texts': texts if uses_texts else None,
+            'hash_arrays': self.image_hash_service.concatenate_hash_arrays(hash_arrays),
+            'term_counts': term_counts,
+            'minhash_band_keys': np.concatenate(band_keys),
+            'has_terms': np.concatenate(has_terms),
+        }
+
+    def get_bucket_pairs(self, keys, image_indexes, order_keys):
+        """
+            Get the pairs of images sharing a bucket key.
+
+            Buckets larger than DEDUP_MAX_BUCKET_SIZE, like the bucket of blank images, are sorted by order_keys and
+            every image is only paired with its next OVERSIZED_BUCKET_NEIGHBORS neighbours.
+
+            Args:
+                keys (ndarray): Bucket key of every entry.
+                image_indexes (ndarray): Image index of every entry, an image may have several entries.
+                order_keys (ndarray): Order of the entries within a bucket.
+
+            Returns:
+                ndarray: Pairs encoded as lower index * images count + higher index, unique.
+        """
+        if len(keys) < 2:
+            return np.zeros(0, dtype=np.int64)
+        order = np.lexsort((order_keys, keys))
+        keys, image_indexes = keys[order], image_indexes[order]
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+        sizes = np.diff(np.concatenate([starts, [len(keys)]]))
+        entry_sizes = np.repeat(sizes, sizes)
+        positions = np.arange(len(keys)) - np.repeat(starts, sizes)
+        reach = np.where(entry_sizes > self.max_bucket_size, OVERSIZED_BUCKET_NEIGHBORS, entry_sizes - 1)
+        reach = np.minimum(reach, entry_sizes - 1 - positions)
+
+        images_count = self.images_count
+        pairs = []
+        active = np.flatnonzero(reach > 0)
+        offset = 1
+        while len(active):
+            first, second = image_indexes[active], image_indexes[active + offset]
+            different = first != second
+            first, second = first[different], second[different]
+            pairs.append(np.minimum(first, second) * images_count + np.maximum(first, second))
+            offset += 1
+            active = active[reach[active] >= offset]
+        return np.unique(np.concatenate(pairs)) if pairs else np.zeros(0, dtype=np.int64)
+
+    def get_candidate_pairs(self, images):
+        """
+            Find candidate pairs by hash and MinHash bands.
+
+            A 64-bit hash is split into its threshold + 1 bands, or into DEDUP_HASH_BANDS when that is fewer. Pairs
+            within the threshold share at least one of threshold + 1 bands, fewer bands miss some of them, as do
+            buckets larger than DEDUP_MAX_BUCKET_SIZE. The average and difference hashes of the rotated and flipped
+            variants are banded into the same buckets as the upright hashes.
+
+            Args:
+                images (dict): Arrays from load_images.
+
+            Returns:
+                ndarray: Candidate pairs encoded as lower index * images count + higher index.
+        """
+        arrays = images['hash_arrays']
+        indexes = np.arange(self.images_count, dtype=np.int64)
+        hash_types = self.image_hash_service.hash_types
+        order_keys = arrays[hash_types[0]]
+        pairs = []
+        start_time = time.perf_counter()
+        for hash_type in hash_types:
+            max_distance = getattr(self.image_hash_service, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')
+            # Images stored before the hash type was enabled would all share the buckets of a zero hash
+            has_hash = arrays[f'has_{hash_type}']
+            hashes, hash_indexes, hash_order_keys = arrays[hash_type][has_hash], indexes[has_hash], order_keys[has_hash]
+            if self.image_hash_service.ENABLE_HASH_VARIANTS and f'{hash_type}_variants' in arrays:
+                has_variants = arrays[f'has_{hash_type}_variants']
+                variants = arrays[f'{hash_type}_variants'][has_variants]
+                hashes = np.concatenate([hashes, variants.ravel()])
+                hash_indexes = np.concatenate([hash_indexes, np.repeat(indexes[has_variants], variants.shape[1])])
+                hash_order_keys = np.concatenate([hash_order_keys,
+                                                  np.repeat(order_keys[has_variants], variants.shape[1])])
+
+            bands = int(max_distance) + 1
+            if self.hash_bands > 0:
+                bands = min(self.hash_bands, bands)
+            bands = max(1, min(bands, 64))
+            bounds = np.linspace(0, 64, bands + 1).astype(np.uint64)
+            for band_start, band_end in zip(bounds[:-1], bounds[1:]):
+                mask = np.uint64((1 << int(band_end - band_start)) - 1)
+                pairs.append(self.get_bucket_pairs((hashes >> band_start) & mask, hash_indexes, hash_order_keys))
+            self.logger.info(f"Blocked {hash_type} in {bands} bands: {sum(map(len, pairs))} pairs so far")
+
+        has_terms = images['has_terms']
+        for band in range(self.minhash_bands):
+            pairs.append(self.get_bucket_pairs(images['minhash_band_keys'][has_terms, band], indexes[has_terms],
+                                               order_keys[has_terms]))
+        candidate_pairs = np.unique(np.concatenate(pairs))
+        elapsed = time.perf_counter() - start_time
+        self.logger.info(f"Found {len(candidate_pairs)} candidate pairs in {elapsed:.1f} s")
+        return candidate_pairs
+
+    def score_pairs(self, images, candidate_pairs):
+        """
+            Score candidate pairs in chunks, like compare_image with the later stored image as the target.
+
+            Args:
+                images (dict): Arrays from load_images.
+                candidate_pairs (ndarray): Encoded candidate pairs.
+
+            Returns:
+                tuple: Earlier and later image indexes of the similar pairs.
+        """
+        metric = self.image_similarity_service.text_similarity_metric
+        similarity_percentage = self.image_similarity_service.similarity_percentage
+        term_counts, texts = images['term_counts'], images['texts']
+        earlier_indexes, later_indexes = [], []
+        start_time = time.perf_counter()
+        for start in range(0, len(candidate_pairs), self.pair_chunk_size):
+            chunk = candidate_pairs[start:start + self.pair_chunk_size]
+            earlier, later = chunk // self.images_count, chunk % self.images_count
+            text_similarities = metric.score_pairs(
+                [texts[index] for index in later] if texts is not None else None,
+                [texts[index] for index in earlier] if texts is not None else None,
+                term_counts[later], term_counts[earlier], score_cutoff=similarity_percentage)
+            similar = text_similarities >= similarity_percentage
+            unsure = np.flatnonzero(~similar)
+            similar[unsure] = self.image_hash_service.find_similar_pairs(images['hash_arrays'], later[unsure],
+                                                                         earlier[unsure])
+            earlier_indexes.append(earlier[similar])
+            later_indexes.append(later[similar])
+            self.log_progress('Scored candidate pairs', start + len(chunk), len(candidate_pairs), start_time)
+        if not earlier_indexes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(earlier_indexes), np.concatenate(later_indexes)
+
+    def save_clusters(self, image_ids, earlier, later, labels):
+        """
+            Save the similar pairs as similar image links with the id of the first stored image of their component.
+
+            Args:
+                image_ids (list[str]): Image ids.
+                earlier (ndarray): Earlier image index of every similar pair, the similar image of the link.
+                later (ndarray): Later image index of every similar pair, the source image of the link.
+                labels (ndarray): Component of every image.
+
+            Returns:
+                int: Number of inserted links, links saved before are updated.
+        """
+        # Images are loaded in insertion order, so the first index of a component is its first stored image
+        _, first_indexes = np.unique(labels, return_index=True)
+        inserted = 0
+        start_time = time.perf_counter()
+        for start in range(0, len(earlier), self.write_batch_size):
+            links = [{"source_image_id": image_ids[later_index],
+                      "similar_image_id": image_ids[earlier_index],
+                      "cluster_id": image_ids[first_indexes[labels[earlier_index]]]}
+                     for earlier_index, later_index in zip(earlier[start:start + self.write_batch_size],
+                                                           later[start:start + self.write_batch_size])]
+            inserted += self.db_connection.upsert_similar_images(links)
+            self.log_progress('Saved similar image links', start + len(links), len(earlier), start_time)
+        return inserted
+
+    def run(self):
+        """
+            Cluster all stored images into near-duplicate components and save them.
+
+            Returns:
+                dict: Counts of images, candidate and similar pairs, clusters and saved links, and the run time.
+        """
+        start_time = time.perf_counter()
+        self.logger.info("Clustering near-duplicate images...")
+        self.stage = 'loading images'
+        images = self.load_images()
+        if images is None:
+            return {"images": 0, "candidate_pairs": 0, "similar_pairs": 0, "clusters": 0, "clustered_images": 0,
+                    "inserted_links": 0, "seconds": time.perf_counter() - start_time}
+        self.images_count = len(images['image_ids'])
+
+        self.stage = 'finding candidate pairs'
+        candidate_pairs = self.get_candidate_pairs(images)
+        candidate_pairs_count = len(candidate_pairs)
+        self.stage = 'scoring candidate pairs'
+        earlier, later = self.score_pairs(images, candidate_pairs)
+        del candidate_pairs
+
+        graph = coo_matrix((np.ones(len(earlier), dtype=np.int8), (earlier, later)),
+                           shape=(self.images_count, self.images_count))
+        _, labels = connected_components(graph, directed=False)
+        cluster_sizes = np.bincount(labels)
+        self.stage = 'saving links'
+        inserted_links = self.save_clusters(images['image_ids'], earlier, later, labels)
+
+        summary = {
+            "images": self.images_count,
+            "candidate_pairs": candidate_pairs_count,
+            "similar_pairs": len(earlier),
+            "clusters": int((cluster_sizes > 1).sum()),
+            "clustered_images": int(cluster_sizes[cluster_sizes > 1].sum()),
+            "inserted_links": inserted_links,
+            "seconds": time.perf_counter() - start_time,
+        }
+        self.logger.info(f"Clustering completed: {summary}")
+        return summary
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    DuplicateClusteringService().run()
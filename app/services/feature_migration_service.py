@@ -0,0 +1,254 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import xxhash
+
+from app.config.environment_manager import EnvironmentManager
+from app.db.recognized_images_repository import RecognizedImagesRepository
+from app.services.image_hash_service import ImageHashService
+from app.services.image_ocr_service import ImageOCRService
+from app.services.image_prefetcher import PrefetchedImage
+from app.services.image_similarity_service import ImageSimilarityService
+
+# Minimal interval in seconds between progress log lines
+PROGRESS_LOG_INTERVAL = 10
+
+
+class FeatureMigrationService(EnvironmentManager):
+    """
+        Background job recomputing the texts and hashes of stored images made by other OCR models or hash versions,
+        or stored before a hash type was enabled.
+
+        Stale images are leased from the collection in batches, so several workers can migrate at once and a stopped
+        migration resumes where it was: migrated images have the current versions, and the leases of a worker that
+        died expire. The images of a batch are read and hashed on a thread pool at a throttled rate, OCR shares the
+        models of the worker and runs between its tasks. Compares keep working on the mixed versions meanwhile, hashes
+        of different versions are not compared and migrated images replace their old copies in the caches.
+    """
+
+    def __init__(self, db_connection=None, image_hash_service=None, image_ocr_service=None,
+                 image_similarity_service=None):
+        """
+            Initialize the job, services that are not passed are created.
+
+            Args:
+                db_connection (RecognizedImagesRepository): Repository of the stored images.
+                image_hash_service (ImageHashService): Service generating image hashes.
+                image_ocr_service (ImageOCRService): Service recognizing texts.
+                image_similarity_service (ImageSimilarityService): Service preprocessing and tokenizing texts.
+        """
+        super().__init__([], {
+            'MIGRATION_BATCH_SIZE': '50',
+            'MIGRATION_WORKERS': '2',
+            'MIGRATION_MAX_IMAGES_PER_SECOND': '2',
+            'MIGRATION_LEASE_SECONDS': '600'
+        })
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(self.logger_level)
+        self.db_connection = db_connection or RecognizedImagesRepository()
+        self.image_hash_service = image_hash_service or ImageHashService()
+        self.image_ocr_service = image_ocr_service or ImageOCRService()
+        self.image_similarity_service = image_similarity_service or ImageSimilarityService()
+        self.batch_size = int(self.env_vars['MIGRATION_BATCH_SIZE'])
+        self.workers = int(self.env_vars['MIGRATION_WORKERS'])
+        self.max_images_per_second = float(self.env_vars['MIGRATION_MAX_IMAGES_PER_SECOND'])
+        self.lease_seconds = float(self.env_vars['MIGRATION_LEASE_SECONDS'])
+        self.ocr_version = self.image_ocr_service.ocr_version
+        self.hash_version = self.image_hash_service.hash_version
+        self.owner = str(uuid.uuid4())
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.state = 'idle'
+        self.migrated_count = 0
+        self.failed_count = 0
+        self.started_at = None
+        self.finished_at = None
+        self.progress_logged_at = 0
+
+    def start(self):
+        """
+            Start the migration on a background thread, unless it is running already.
+
+            Returns:
+                bool: True if it was started.
+        """
+        if self.is_running():
+            return False
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='feature-migration', daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        """
+            Stop the migration after the images in progress, the images leased but not started are released.
+
+            Args:
+                timeout (float): Seconds to wait for the thread, None to wait until it stopped.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def is_running(self):
+        """
+            Returns:
+                bool: True while the background thread runs.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def status(self):
+        """
+            Returns:
+                dict: State, versions, counts of the last run and of the images left, and the migration rate.
+        """
+        stale_count, failed_count = self.db_connection.count_stale_images(self.ocr_version, self.hash_version,
+                                                                              self.image_hash_service.hash_types)
+        elapsed = 0
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.perf_counter()) - self.started_at
+        return {
+            "state": self.state,
+            "ocr_version": self.ocr_version,
+            "hash_version": self.hash_version,
+            "migrated": self.migrated_count,
+            "failed": self.failed_count,
+            "stale_images": stale_count,
+            "failed_images": failed_count,
+            "images_per_second": self.migrated_count / elapsed if elapsed else 0,
+        }
+
+    def log_progress(self, force=False):
+        """
+            Log the progress, at most every PROGRESS_LOG_INTERVAL seconds unless forced.
+
+            Args:
+                force (bool): Log regardless of the interval.
+        """
+        now = time.perf_counter()
+        if not force and now - self.progress_logged_at < PROGRESS_LOG_INTERVAL:
+            return
+        self.progress_logged_at = now
+        self.logger.info(f"Feature migration: {self.status()}")
+
+    def run(self):
+        """
+            Migrate stale images until none is left or the migration is stopped.
+
+            Returns:
+                dict: The status at the end.
+        """
+        self.state = 'running'
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.migrated_count = 0
+        self.failed_count = 0
+        self.logger.info(f"Feature migration started to OCR version {self.ocr_version}, "
+                         f"hash version {self.hash_version}")
+        interval = 1 / self.max_images_per_second if self.max_images_per_second > 0 else 0
+        next_submit_at = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='migration') as executor:
+                while not self.stop_event.is_set():
+                    images = self.db_connection.claim_stale_images(self.ocr_version, self.hash_version,
+                                                                   self.image_hash_service.hash_types, self.owner,
+                                                                   self.lease_seconds, self.batch_size)
+                    if not images:
+                        break
+                    futures = []
+                    for image in images:
+                        # Throttle before every image, so the migration does not starve the compare tasks
+                        if self.stop_event.wait(max(0.0, next_submit_at - time.monotonic())):
+                            break
+                        next_submit_at = max(next_submit_at + interval, time.monotonic())
+                        futures.append((image, executor.submit(self.migrate_image, image)))
+                    self.save_batch(futures)
+                    unstarted_image_ids = [image.id for image in images[len(futures):]]
+                    if unstarted_image_ids:
+                        self.db_connection.release_migration_claims(unstarted_image_ids, self.owner)
+                    self.log_progress()
+            self.state = 'stopped' if self.stop_event.is_set() else 'completed'
+        except Exception as e:
+            self.logger.exception("Feature migration failed", exc_info=e)
+            self.state = 'failed'
+        self.finished_at = time.perf_counter()
+        self.log_progress(force=True)
+        return self.status()
+
+    def save_batch(self, futures):
+        """
+            Wait for the images of a batch and save their features with one bulk write.
+
+            Args:
+                futures (list[tuple]): Images with the futures of their migrate_image calls.
+        """
+        features_by_id = {}
+        failed_image_ids = []
+        for image, future in futures:
+            try:
+                features = future.result()
+            except Exception as e:
+                self.logger.warning(f"Failed to migrate image {image.image_path}: {e}")
+                features = None
+            if features is None:
+                failed_image_ids.append(image.id)
+            else:
+                features_by_id[image.id] = features
+        self.db_connection.update_image_features(features_by_id)
+        if failed_image_ids:
+            self.db_connection.mark_migration_failed(failed_image_ids, self.ocr_version, self.hash_version)
+        self.migrated_count += len(features_by_id)
+        self.failed_count += len(failed_image_ids)
+
+    def migrate_image(self, image):
+        """
+            Recompute the stale features of an image. Runs on a migration thread.
+
+            The file is read once for its content hash, image hashes and OCR. An image whose file is missing or
+            changed since it was stored is not migrated, its features would describe another image.
+
+            Args:
+                image (StoredImage): The stored image.
+
+            Returns:
+                dict: The fields to set, None if the image cannot be migrated.
+        """
+        try:
+            with open(image.image_path, 'rb') as image_file:
+                data = image_file.read()
+        except OSError as e:
+            self.logger.warning(f"Image of {image.id} cannot be read for the migration: {e}")
+            return None
+        image_xxhash = xxhash.xxh3_128_hexdigest(data)
+        stored_xxhash = image_xxhash if image.xxhash_version is not None else \
+            self.image_hash_service.generate_legacy_image_xxhash(image.image_path)
+        if stored_xxhash != image.xxhash:
+            self.logger.warning(f"Image file of {image.id} changed since it was stored: {image.image_path}")
+            return None
+
+        features = {}
+        if image.hash_version != self.hash_version or image.xxhash_version is None or \
+                any(getattr(image, hash_type) is None for hash_type in self.image_hash_service.hash_types):
+            features.update(self.image_hash_service.generate_image_hashes(image.image_path, image_xxhash,
+                                                                          data).to_document())
+        if image.ocr_version != self.ocr_version:
+            recognized_text = self.image_ocr_service.get_text_from_image(
+                image.image_path, image.template, PrefetchedImage(image.image_path, data).get_image())
+            # Compares store preprocessed texts and OCR tasks the raw ones, preprocessing twice changes nothing
+            if image.recognized_text and \
+                    self.image_similarity_service.preprocess_text(image.recognized_text) == image.recognized_text:
+                recognized_text = self.image_similarity_service.preprocess_text(recognized_text)
+            features.update({
+                "recognized_text": recognized_text,
+                "term_frequencies": self.image_similarity_service.get_term_frequencies(recognized_text),
+                "ocr_version": self.ocr_version
+            })
+        return features
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    FeatureMigrationService().run()
@@ -1,10 +1,108 @@
+import io
+import mmap
 import os
 import logging
 import xxhash
 import imagehash
+import numpy as np
+import pywt
+import scipy.fftpack
 from PIL import Image, ImageFile
 
 from app.config.environment_manager import EnvironmentManager
+from app.db.image_records import ImageHashes
+from app.db.thumbnail_store import ThumbnailStore
+
+# Rotated and flipped variants as functions of a pixel array, and whether they swap width and height.
+# PIL ROTATE_90 turns counter-clockwise like numpy rot90.
+HASH_VARIANTS = [
+    ('rotate_90', np.rot90, True),
+    ('rotate_180', lambda pixels: np.rot90(pixels, 2), False),
+    ('rotate_270', lambda pixels: np.rot90(pixels, 3), True),
+    ('flip_left_right', np.fliplr, False),
+    ('flip_top_bottom', np.flipud, False),
+    ('transpose', np.transpose, True),
+    ('transverse', lambda pixels: np.rot90(pixels, 2).T, True),
+]
+
+# Version of the content hash stored in the xxhash field. Images stored without xxhash_version have version 1: two
+# xxh64 hashes over 4 KB chunks, the second one of the reversed chunks.
+XXHASH_VERSION = 2
+
+# Read buffer size for files that cannot be memory-mapped
+XXHASH_BUFFER_SIZE = 1024 * 1024
+
+# Packed size in bytes of the hashes stored for every variant
+HASH_VARIANT_SIZES = {'ahash': 8, 'dhash': 8, 'phash16': 32, 'dhash16': 32}
+
+def whash_db4(img, hash_size=8):
+    """
+        Calculate a Daubechies 4 wavelet hash of hash_size x hash_size bits.
+
+        Like imagehash.whash, but the wavelet transform is periodized. imagehash pads the signal for the db4 filter, so
+        its hash of size 8 has 14 x 14 bits and does not fit the 64-bit arrays.
+
+        Args:
+            img (Image): The image.
+            hash_size (int): Bits per side of the hash, a power of 2.
+
+        Returns:
+            ImageHash: The wavelet hash.
+    """
+    image_scale = max(2 ** int(np.log2(min(img.size))), hash_size)
+    ll_max_level = int(np.log2(image_scale))
+    pixels = np.asarray(img.convert('L').resize((image_scale, image_scale), Image.LANCZOS)) / 255.
+    # Remove the lowest frequency with the Haar wavelet, like imagehash
+    coeffs = pywt.wavedec2(pixels, 'haar', level=ll_max_level)
+    coeffs[0] *= 0
+    pixels = pywt.waverec2(coeffs, 'haar')
+    dwt_low = pywt.wavedec2(pixels, 'db4', mode='periodization', level=ll_max_level - int(np.log2(hash_size)))[0]
+    return imagehash.ImageHash(dwt_low > np.median(dwt_low))
+
+
+# 64-bit hashes compared by the first tier of is_similar, mapped to the functions computing their hex strings. Only the
+# types listed in HASH_TYPES are computed, stored and compared.
+HASH_FUNCTIONS = {
+    'ahash': lambda img: str(imagehash.average_hash(img)),
+    'dhash': lambda img: str(imagehash.dhash(img)),
+    'phash': lambda img: str(imagehash.phash(img)),
+    'whash_haar': lambda img: str(imagehash.whash(img)),
+    'whash_db4': lambda img: str(whash_db4(img)),
+    # The color hash is stored with one byte of 0 or 1 per bit
+    'colorhash': lambda img: ''.join('{:02x}'.format(bit) for bit in imagehash.colorhash(img).hash.flatten()),
+}
+FILTER_HASH_TYPES = list(HASH_FUNCTIONS)
+
+# Default Hamming distance thresholds of the 64-bit hashes. <TYPE>_MAX_SIMILARITY_PERCENT is only read for the enabled
+# types.
+DEFAULT_MAX_SIMILARITY_PERCENT = {
+    'ahash': 4,
+    'dhash': 8,
+    'phash': 10,
+    'whash_haar': 8,
+    'whash_db4': 8,
+    'colorhash': 0,
+}
+
+# Hash types enabled when HASH_TYPES is not set
+DEFAULT_HASH_TYPES = ['ahash', 'dhash', 'whash_haar', 'colorhash']
+
+# 64-bit hashes that are also stored for the rotated and flipped variants
+VARIANT_HASH_TYPES = ['ahash', 'dhash']
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+# Stored images compared at once by find_similar_hashes, bounds the size of the distance matrices
+HASH_MATRIX_CHUNK_SIZE = 4096
+
+# Version of the image hash functions, bump it when they change so that stored hashes are migrated
+HASH_VERSION = 1
+
+# Added to HASH_VERSION for hashes computed from thumbnails of the thumbnail store. They are not compared with the
+# hashes of the originals, colorhash of a thumbnail differs from the one of its original by a few bits, and turning
+# the store on or off makes the stored hashes stale so that they are migrated.
+THUMBNAIL_HASH_VERSION_OFFSET = 1000
 
 
 class ImageHashService(EnvironmentManager):
@@ -19,12 +117,19 @@ class ImageHashService(EnvironmentManager):
         """
             Initializes the ImageHashService with environment variables.
         """
-        super().__init__([
-            'AHASH_MAX_SIMILARITY_PERCENT',
-            'DHASH_MAX_SIMILARITY_PERCENT',
-            'WHASH_HAAR_MAX_SIMILARITY_PERCENT',
-            'COLORHASH_MAX_SIMILARITY_PERCENT',
-        ])
+        super().__init__([], {
+            'HASH_TYPES': ','.join(DEFAULT_HASH_TYPES),
+            **{f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT': str(max_distance)
+               for hash_type, max_distance in DEFAULT_MAX_SIMILARITY_PERCENT.items()},
+            'ENABLE_HASH_VERIFICATION': 'True',
+            'ENABLE_HASH_VARIANTS': 'True',
+            'PHASH16_MAX_DISTANCE': '40',
+            'DHASH16_MAX_DISTANCE': '32',
+            'ENABLE_THUMBNAIL_STORE': 'False',
+            'THUMBNAIL_STORE_PATH': 'thumbnails',
+            'THUMBNAIL_STORE_MAX_SIZE_MB': '1024',
+            'THUMBNAIL_SIZE': '256'
+        })
 
         ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -38,14 +143,64 @@ class ImageHashService(EnvironmentManager):
         """
             Map loaded environment variables to instance variables.
         """
-        self.AHASH_MAX_SIMILARITY_PERCENT = float(self.env_vars['AHASH_MAX_SIMILARITY_PERCENT'])
-        self.DHASH_MAX_SIMILARITY_PERCENT = float(self.env_vars['DHASH_MAX_SIMILARITY_PERCENT'])
-        self.WHASH_HAAR_MAX_SIMILARITY_PERCENT = float(self.env_vars['WHASH_HAAR_MAX_SIMILARITY_PERCENT'])
-        self.COLORHASH_MAX_SIMILARITY_PERCENT = float(self.env_vars['COLORHASH_MAX_SIMILARITY_PERCENT'])
+        self.hash_types = [hash_type.strip() for hash_type in self.env_vars['HASH_TYPES'].split(',')
+                           if hash_type.strip()]
+        unknown_hash_types = set(self.hash_types) - set(HASH_FUNCTIONS)
+        if unknown_hash_types:
+            raise ValueError(f'Unknown hash types: {", ".join(sorted(unknown_hash_types))}')
+        if not self.hash_types:
+            raise ValueError('HASH_TYPES enables no hash type')
+        # Thresholds are only read for the enabled hash types, the others keep their defaults
+        for hash_type, max_distance in DEFAULT_MAX_SIMILARITY_PERCENT.items():
+            var = f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT'
+            setattr(self, var, float(self.env_vars[var]) if hash_type in self.hash_types else float(max_distance))
+        # Upright hashes compared against the stored rotated and flipped variants
+        self.variant_hash_types = [hash_type for hash_type in VARIANT_HASH_TYPES if hash_type in self.hash_types]
+        self.logger.info(f'Hash types: {", ".join(self.hash_types)}')
+        self.ENABLE_HASH_VERIFICATION = self.env_vars['ENABLE_HASH_VERIFICATION'].lower() == "true"
+        self.ENABLE_HASH_VARIANTS = self.env_vars['ENABLE_HASH_VARIANTS'].lower() == "true"
+        self.PHASH16_MAX_DISTANCE = int(self.env_vars['PHASH16_MAX_DISTANCE'])
+        self.DHASH16_MAX_DISTANCE = int(self.env_vars['DHASH16_MAX_DISTANCE'])
+        self.thumbnail_store = None
+        if self.env_vars['ENABLE_THUMBNAIL_STORE'].lower() == "true":
+            self.thumbnail_store = ThumbnailStore(self.env_vars['THUMBNAIL_STORE_PATH'],
+                                                  float(self.env_vars['THUMBNAIL_STORE_MAX_SIZE_MB']),
+                                                  int(self.env_vars['THUMBNAIL_SIZE']), self.logger_level)
+        # Version of the hashes this service generates
+        self.hash_version = HASH_VERSION + (THUMBNAIL_HASH_VERSION_OFFSET if self.thumbnail_store is not None else 0)
 
     def _generate_image_xxhash(self, image_path):
         """
-            Generate a 128-bit xxHash for an image.
+            Generate a 128-bit xxHash (XXH3) of the image file content.
+
+            The file is memory-mapped and hashed in one native call, without copying it into Python objects.
+
+            Args:
+                image_path (str): Path to the image file.
+
+            Returns:
+                str: A 128-bit hash string representing the image or None if the file does not exist.
+        """
+        if not os.path.exists(image_path):
+            return None
+
+        self.logger.debug(f'Generating xxhash for image: {image_path}')
+        with open(image_path, 'rb') as afile:
+            try:
+                with mmap.mmap(afile.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    return xxhash.xxh3_128_hexdigest(mapped_file)
+            except (ValueError, OSError):
+                # Empty files and file systems without mmap support
+                hasher = xxhash.xxh3_128()
+                buffer = bytearray(XXHASH_BUFFER_SIZE)
+                view = memoryview(buffer)
+                while size := afile.readinto(buffer):
+                    hasher.update(view[:size])
+                return hasher.hexdigest()
+
+    def generate_legacy_image_xxhash(self, image_path):
+        """
+            Generate the version 1 xxHash of an image, to find images stored before XXHASH_VERSION 2.
 
             Args:
                 image_path (str): Path to the image file.
@@ -63,93 +218,450 @@ class ImageHashService(EnvironmentManager):
                 hasher1.update(chunk)
                 hasher2.update(chunk[::-1])  # Reverse the chunk to create a different hash
 
-        self.logger.debug(f'Generating xxhash for image: {image_path}')
+        self.logger.debug(f'Generating legacy xxhash for image: {image_path}')
         return hasher1.hexdigest() + hasher2.hexdigest()
 
-    def _generate_ahash(self, image_path):
+    def _generate_hash(self, hash_type, img):
         """
-            Calculate the average hash (aHash) for an image.
+            Calculate a 64-bit hash of HASH_FUNCTIONS for an image.
 
             Args:
-                image_path (str): Path to the image file.
+                hash_type (str): The hash type.
+                img (Image): The image.
 
             Returns:
-                str: The calculated aHash of the image.
+                str: The calculated hash of the image.
         """
-        img = Image.open(image_path)
-        self.logger.debug(f'Generating average hash (aHash) for image: {image_path}')
-        return str(imagehash.average_hash(img))
+        self.logger.debug(f'Generating {hash_type}')
+        return HASH_FUNCTIONS[hash_type](img)
 
-    def _generate_dhash(self, image_path):
+    def _generate_verification_hashes(self, img):
         """
-            Calculate the difference hash (dHash) for an image.
+            Calculate the 16x16 perceptual hash (pHash) and difference hash (dHash) for an image.
+
+            The 256-bit hashes verify candidates found with the 64-bit hashes. They are stored as 32 raw bytes instead
+            of hex strings.
 
             Args:
-                image_path (str): Path to the image file.
+                img (Image): The image.
 
             Returns:
-                str: The calculated dHash of the image.
+                dict: The phash16 and dhash16 bytes of the image.
         """
-        img = Image.open(image_path)
-        self.logger.debug(f'Generating difference hash (dHash) for image: {image_path}')
-        return str(imagehash.dhash(img))
+        self.logger.debug('Generating 16x16 pHash and dHash')
+        return {
+            'phash16': self.hash_to_bytes(imagehash.phash(img, hash_size=16)),
+            'dhash16': self.hash_to_bytes(imagehash.dhash(img, hash_size=16)),
+        }
 
-    def _generate_whash_haar(self, image_path):
+    def _generate_hash_variants(self, img):
         """
-            Calculate the wavelet hash (wHash) using Haar wavelets for an image.
+            Calculate the aHash and dHash of the rotated and flipped variants of an image, of the types enabled by
+            HASH_TYPES, and their 16x16 pHash and dHash when hash verification is enabled.
+
+            Resizing commutes with rotating and flipping, so every size the hashes need is resized from the image
+            once and the small pixel arrays are transformed, instead of hashing seven transformed full-size images.
 
             Args:
-                image_path (str): Path to the image file.
+                img (Image): The image.
 
             Returns:
-                str: The calculated wHash (Haar) of the image.
+                dict: Hash types mapped to the packed hashes of all variants in HASH_VARIANTS order.
         """
-        img = Image.open(image_path)
-        self.logger.debug(f'Generating wavelet hash (wHash) using Haar wavelets for image: {image_path}')
-        return str(imagehash.whash(img))
+        img = img.convert('L')
+        resized = {}
+
+        def get_pixels(width, height):
+            if (width, height) not in resized:
+                resized[width, height] = np.asarray(img.resize((width, height), Image.LANCZOS))
+            return resized[width, height]
+
+        hash_types = [*self.variant_hash_types, *(['phash16', 'dhash16'] if self.ENABLE_HASH_VERIFICATION else [])]
+        variants = {hash_type: [] for hash_type in hash_types}
+        for name, transform, swaps_axes in HASH_VARIANTS:
+            def get_variant_pixels(width, height):
+                return transform(get_pixels(height, width) if swaps_axes else get_pixels(width, height))
+
+            if 'ahash' in variants:
+                pixels = get_variant_pixels(8, 8)
+                variants['ahash'].append(np.packbits(pixels > pixels.mean()).tobytes())
+            if 'dhash' in variants:
+                pixels = get_variant_pixels(9, 8)
+                variants['dhash'].append(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes())
+            if 'phash16' in variants:
+                pixels = get_variant_pixels(64, 64)
+                dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=0), axis=1)[:16, :16]
+                variants['phash16'].append(np.packbits(dct > np.median(dct)).tobytes())
+                pixels = get_variant_pixels(17, 16)
+                variants['dhash16'].append(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes())
+        self.logger.debug('Generating rotated and flipped hash variants')
+        return {hash_type: b''.join(hashes) for hash_type, hashes in variants.items()}
+
+    @staticmethod
+    def get_variant_hashes(hash_variants, index):
+        """
+            Get the hashes of one variant from the packed hashes of all variants.
+
+            Args:
+                hash_variants (dict): Hash types mapped to the packed hashes of all variants.
+                index (int): Index of the variant in HASH_VARIANTS.
+
+            Returns:
+                ImageHashes: The packed hashes of the variant, the 64-bit hashes as bytes.
+        """
+        return ImageHashes(**{hash_type: hash_variants[hash_type][index * size:(index + 1) * size]
+                              for hash_type, size in HASH_VARIANT_SIZES.items() if hash_variants.get(hash_type)})
 
-    def _generate_colorhash(self, image_path):
+    @staticmethod
+    def hash_to_bytes(image_hash):
         """
-            Calculate the color hash for an image.
+            Pack an image hash into bytes, one bit per hash bit.
 
             Args:
-                image_path (str): Path to the image file.
+                image_hash (ImageHash): The image hash.
+
+            Returns:
+                bytes: The packed hash.
+        """
+        return np.packbits(image_hash.hash.flatten()).tobytes()
+
+    @staticmethod
+    def bytes_distance(hash1, hash2):
+        """
+            Calculate the Hamming distance of two packed hashes.
+
+            Args:
+                hash1 (bytes): First packed hash.
+                hash2 (bytes): Second packed hash.
+
+            Returns:
+                int: Number of differing bits.
+        """
+        return (int.from_bytes(hash1, 'big') ^ int.from_bytes(hash2, 'big')).bit_count()
+
+    @staticmethod
+    def hamming_distances(hashes1, hashes2):
+        """
+            Calculate the Hamming distances of all pairs of 64-bit hashes.
+
+            Parameters are broadcast against each other, the distances are counted with a byte popcount table.
+
+            Args:
+                hashes1 (ndarray): uint64 hashes.
+                hashes2 (ndarray): uint64 hashes.
+
+            Returns:
+                ndarray: Number of differing bits of every pair.
+        """
+        xor = np.ascontiguousarray(hashes1 ^ hashes2)
+        return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+    @staticmethod
+    def hash_to_int(hash_type, hex_hash):
+        """
+            Convert a stored 64-bit hash into an integer with the same Hamming distances.
+
+            Args:
+                hash_type (str): The hash type.
+                hex_hash (str): The stored hash.
+
+            Returns:
+                int: The hash bits as an integer.
+        """
+        if hash_type == 'colorhash':
+            # The color hash is stored with one byte of 0 or 1 per bit
+            return int.from_bytes(np.packbits(np.frombuffer(bytes.fromhex(hex_hash), dtype=np.uint8)).tobytes(), 'big')
+        return int(hex_hash, 16)
+
+    @staticmethod
+    def get_hash_arrays(hashes_list, hash_types=DEFAULT_HASH_TYPES):
+        """
+            Convert the hashes of images into arrays for find_similar_hashes.
+
+            Args:
+                hashes_list (list[ImageHashes]): Hashes of the images.
+                hash_types (list[str]): The 64-bit hash types to convert, the enabled hash_types of the service.
+
+            Returns:
+                dict: The 64-bit hashes as uint64 arrays with masks of the images that have them, the 16x16 hashes as
+                arrays of four uint64 words with masks of the images that have them, the hashes of the rotated and
+                flipped variants shaped images x variants with masks of the images that have variants and that have
+                them of every type, and the hash versions, 0 for images stored without one.
+        """
+        count = len(hashes_list)
+        arrays = {}
+        for hash_type in hash_types:
+            values = np.zeros(count, dtype=np.uint64)
+            has_hash = np.zeros(count, dtype=bool)
+            for index, hashes in enumerate(hashes_list):
+                # Images stored before the hash type was enabled do not have it
+                if getattr(hashes, hash_type):
+                    values[index] = ImageHashService.hash_to_int(hash_type, getattr(hashes, hash_type))
+                    has_hash[index] = True
+            arrays[hash_type], arrays[f'has_{hash_type}'] = values, has_hash
+        for hash_type in ['phash16', 'dhash16']:
+            words = np.zeros((count, 4), dtype=np.uint64)
+            has_hash = np.zeros(count, dtype=bool)
+            for index, hashes in enumerate(hashes_list):
+                if getattr(hashes, hash_type):
+                    words[index] = np.frombuffer(getattr(hashes, hash_type), dtype='>u8')
+                    has_hash[index] = True
+            arrays[hash_type], arrays[f'has_{hash_type}'] = words, has_hash
+
+        arrays['has_variants'] = np.array([bool(hashes.hash_variants) for hashes in hashes_list], dtype=bool)
+        for hash_type, size in HASH_VARIANT_SIZES.items():
+            words = np.zeros((count, len(HASH_VARIANTS), size // 8), dtype=np.uint64)
+            has_hash = np.zeros(count, dtype=bool)
+            for index, hashes in enumerate(hashes_list):
+                # Variants are only stored for the hash types enabled when the image was hashed
+                if hashes.hash_variants and hashes.hash_variants.get(hash_type):
+                    words[index] = np.frombuffer(hashes.hash_variants[hash_type], dtype='>u8').reshape(
+                        len(HASH_VARIANTS), size // 8)
+                    has_hash[index] = True
+            arrays[f'{hash_type}_variants'] = words[:, :, 0] if size == 8 else words
+            arrays[f'has_{hash_type}_variants'] = has_hash
+        arrays['hash_version'] = np.array([hashes.hash_version or 0 for hashes in hashes_list], dtype=np.uint16)
+        return arrays
+
+    @staticmethod
+    def are_comparable(first_versions, second_versions):
+        """
+            Check which hashes are of the same version. Hashes stored without a version are compared with all.
+
+            Args:
+                first_versions (ndarray): Hash versions from get_hash_arrays.
+                second_versions (ndarray): Hash versions broadcastable to the first ones.
 
             Returns:
-                str: The calculated color hash of the image.
+                ndarray: True where the hashes can be compared.
         """
-        img = Image.open(image_path)
-        color_hash = imagehash.colorhash(img)
+        return (first_versions == second_versions) | (first_versions == 0) | (second_versions == 0)
 
-        # Format each element in the hash array as a two-character hexadecimal string
-        formatted_hash = ''.join(['{:02x}'.format(pixel) for pixel in color_hash.hash.flatten()])
-        self.logger.debug(f'Generating colorhash for image: {image_path}')
-        return formatted_hash
+    def verify_pairs(self, upright_hashes, variant_hashes):
+        """
+            Verify candidate pairs with the 16x16 hashes, like verify_similar.
+
+            Args:
+                upright_hashes (dict): 16x16 hash words and masks of the first image of every pair.
+                variant_hashes (dict): 16x16 hash words and masks of the second image of every pair.
+
+            Returns:
+                ndarray: False for the pairs the 16x16 hashes show to be different.
+        """
+        verified = np.ones(len(upright_hashes['phash16']), dtype=bool)
+        if not self.ENABLE_HASH_VERIFICATION:
+            return verified
+        for hash_type in ['phash16', 'dhash16']:
+            distances = self.hamming_distances(upright_hashes[hash_type], variant_hashes[hash_type]).sum(axis=-1)
+            has_hashes = upright_hashes[f'has_{hash_type}'] & variant_hashes[f'has_{hash_type}']
+            verified &= ~has_hashes | (distances <= getattr(self, f'{hash_type.upper()}_MAX_DISTANCE'))
+        return verified
+
+    def find_similar_hashes(self, target_hashes_list, hashes_list):
+        """
+            Find the similar image pairs of a batch of targets and many images in matrix form.
+
+            The result matches is_similar for every pair: the 64-bit filter runs on all pairs at once with a byte
+            popcount table, and the 16x16 verification on the pairs that pass it.
+
+            Args:
+                target_hashes_list (list[ImageHashes]): Hashes of the target images.
+                hashes_list (list[ImageHashes]): Hashes of the images to compare.
+
+            Returns:
+                ndarray: Boolean similarity matrix shaped targets x images to compare.
+        """
+        similar = np.zeros((len(target_hashes_list), len(hashes_list)), dtype=bool)
+        if not target_hashes_list or not hashes_list:
+            return similar
+        targets = self.get_hash_arrays(target_hashes_list, self.hash_types)
+        for start in range(0, len(hashes_list), HASH_MATRIX_CHUNK_SIZE):
+            images = self.get_hash_arrays(hashes_list[start:start + HASH_MATRIX_CHUNK_SIZE], self.hash_types)
+            similar[:, start:start + HASH_MATRIX_CHUNK_SIZE] = self.find_similar_hash_arrays(targets, images)
+        return similar
+
+    def find_similar_hash_arrays(self, targets, images):
+        """
+            Find the similar image pairs of targets and images given as arrays from get_hash_arrays.
+
+            Args:
+                targets (dict): Hash arrays of the target images.
+                images (dict): Hash arrays of the images to compare.
+
+            Returns:
+                ndarray: Boolean similarity matrix shaped targets x images to compare.
+        """
+        similar = np.zeros((len(targets['hash_version']), len(images['hash_version'])), dtype=bool)
+        matches = np.zeros(similar.shape, dtype=bool)
+        for hash_type in self.hash_types:
+            matches |= (self.hamming_distances(targets[hash_type][:, None], images[hash_type][None, :]) <=
+                        getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')) & \
+                targets[f'has_{hash_type}'][:, None] & images[f'has_{hash_type}'][None, :]
+        comparable = self.are_comparable(targets['hash_version'][:, None], images['hash_version'][None, :])
+        matches &= comparable
+        rows, columns = np.nonzero(matches)
+        verified = self.verify_pairs(self.select_pairs(targets, rows), self.select_pairs(images, columns))
+        similar[rows[verified], columns[verified]] = True
+        if not self.ENABLE_HASH_VARIANTS:
+            return similar
+
+        # The target against the variants of the compared image when it has them, else the other way round
+        stored_variant_matches = np.zeros((*similar.shape, len(HASH_VARIANTS)), dtype=bool)
+        target_variant_matches = np.zeros((*similar.shape, len(HASH_VARIANTS)), dtype=bool)
+        for hash_type in self.variant_hash_types:
+            max_distance = getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')
+            stored_variant_matches |= (self.hamming_distances(
+                targets[hash_type][:, None, None], images[f'{hash_type}_variants'][None, :, :]) <= max_distance) & \
+                targets[f'has_{hash_type}'][:, None, None] & images[f'has_{hash_type}_variants'][None, :, None]
+            target_variant_matches |= (self.hamming_distances(
+                targets[f'{hash_type}_variants'][:, None, :], images[hash_type][None, :, None]) <= max_distance) & \
+                images[f'has_{hash_type}'][None, :, None] & targets[f'has_{hash_type}_variants'][:, None, None]
+        stored_variant_matches &= (comparable & images['has_variants'][None, :])[:, :, None]
+        target_variant_matches &= (comparable & targets['has_variants'][:, None] &
+                                   ~images['has_variants'][None, :])[:, :, None]
+
+        rows, columns, variants = np.nonzero(stored_variant_matches)
+        verified = self.verify_pairs(self.select_pairs(targets, rows),
+                                     self.select_pairs(images, columns, variants))
+        similar[rows[verified], columns[verified]] = True
+        rows, columns, variants = np.nonzero(target_variant_matches)
+        verified = self.verify_pairs(self.select_pairs(images, columns),
+                                     self.select_pairs(targets, rows, variants))
+        similar[rows[verified], columns[verified]] = True
+        return similar
+
+    def find_similar_pairs(self, arrays, first_indexes, second_indexes):
+        """
+            Compare listed image pairs, like is_similar with the first image of every pair as the target.
+
+            Args:
+                arrays (dict): Arrays of all images from get_hash_arrays.
+                first_indexes (ndarray): Index of the first image of every pair.
+                second_indexes (ndarray): Index of the second image of every pair.
+
+            Returns:
+                ndarray: True for the similar pairs.
+        """
+        matches = np.zeros(len(first_indexes), dtype=bool)
+        for hash_type in self.hash_types:
+            matches |= (self.hamming_distances(arrays[hash_type][first_indexes], arrays[hash_type][second_indexes]) <=
+                        getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')) & \
+                arrays[f'has_{hash_type}'][first_indexes] & arrays[f'has_{hash_type}'][second_indexes]
+        comparable = self.are_comparable(arrays['hash_version'][first_indexes], arrays['hash_version'][second_indexes])
+        matches &= comparable
+        similar = matches & self.verify_pairs(self.select_pairs(arrays, first_indexes),
+                                              self.select_pairs(arrays, second_indexes))
+        if not self.ENABLE_HASH_VARIANTS:
+            return similar
+
+        # The first image against the variants of the second when it has them, else the other way round
+        second_has_variants = arrays['has_variants'][second_indexes]
+        for upright_indexes, variant_indexes, pair_mask in (
+                (first_indexes, second_indexes, comparable & second_has_variants),
+                (second_indexes, first_indexes,
+                 comparable & ~second_has_variants & arrays['has_variants'][first_indexes])):
+            variant_matches = np.zeros((len(first_indexes), len(HASH_VARIANTS)), dtype=bool)
+            for hash_type in self.variant_hash_types:
+                variant_matches |= (self.hamming_distances(arrays[hash_type][upright_indexes][:, None],
+                                                           arrays[f'{hash_type}_variants'][variant_indexes]) <=
+                                    getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')) & \
+                    (arrays[f'has_{hash_type}'][upright_indexes] &
+                     arrays[f'has_{hash_type}_variants'][variant_indexes])[:, None]
+            pairs, variants = np.nonzero(variant_matches & pair_mask[:, None])
+            verified = self.verify_pairs(self.select_pairs(arrays, upright_indexes[pairs]),
+                                         self.select_pairs(arrays, variant_indexes[pairs], variants))
+            similar[pairs[verified]] = True
+        return similar
+
+    @staticmethod
+    def concatenate_hash_arrays(arrays_list):
+        """
+            Concatenate arrays from get_hash_arrays of consecutive chunks of images.
+
+            Args:
+                arrays_list (list[dict]): Arrays of the chunks.
+
+            Returns:
+                dict: Arrays of all images.
+        """
+        return {key: np.concatenate([arrays[key] for arrays in arrays_list]) for key in arrays_list[0]}
+
+    @staticmethod
+    def select_pairs(arrays, indexes, variant_indexes=None):
+        """
+            Select the 16x16 hashes of the images of candidate pairs.
+
+            Args:
+                arrays (dict): Arrays from get_hash_arrays.
+                indexes (ndarray): Image index of every pair.
+                variant_indexes (ndarray): Variant index of every pair, None for the upright hashes.
+
+            Returns:
+                dict: 16x16 hash words and masks of every pair.
+        """
+        if variant_indexes is None:
+            return {key: arrays[key][indexes] for key in ('phash16', 'dhash16', 'has_phash16', 'has_dhash16')}
+        return {'phash16': arrays['phash16_variants'][indexes, variant_indexes],
+                'dhash16': arrays['dhash16_variants'][indexes, variant_indexes],
+                'has_phash16': arrays['has_phash16_variants'][indexes],
+                'has_dhash16': arrays['has_dhash16_variants'][indexes]}
+
+    def load_hash_image(self, image_path, image_xxhash, image_data=None):
+        """
+            Open the image the hashes are computed from, the thumbnail of the image content with the thumbnail store.
 
-    def generate_image_hashes(self, image_path):
+            Args:
+                image_path (str): Path to the image file.
+                image_xxhash (str): The xxhash of the image.
+                image_data (bytes): Content of the image file if already read, the file is not read again then.
+
+            Returns:
+                Image: The full-size image or its thumbnail.
+        """
+        image_file = io.BytesIO(image_data) if image_data is not None else image_path
+        if self.thumbnail_store is None:
+            return Image.open(image_file)
+        return self.thumbnail_store.get_or_create(image_xxhash, image_file)
+
+    def generate_image_hashes(self, image_path, image_xxhash=None, image_data=None):
         """
             Generate various types of hashes for an image.
 
-            This method combines the generation of xxHash and various image hashes including aHash, dHash, wHash (Haar),
-            and colorHash.
+            This method combines the generation of xxHash and the image hashes enabled by HASH_TYPES, of aHash, dHash,
+            pHash, wHash (Haar and Daubechies 4) and colorHash, with the 16x16 hashes when hash verification is enabled
+            and the variants when hash variants are enabled. The image is decoded once for all of them. With the
+            thumbnail store the image hashes are computed from the stored thumbnail, and an image with a known xxhash
+            and a stored thumbnail is not read.
 
             Args:
                 image_path (str): Path to the image file.
+                image_xxhash (str): The current version xxhash of the image if it is known.
+                image_data (bytes): Content of the image file if already read, the file is not read again then.
 
             Returns:
-                dict: A dictionary containing generated hashes or None if the image path does not exist.
+                ImageHashes: The generated hashes or None if the image path does not exist.
         """
-        if not os.path.exists(image_path):
+        thumbnail = None
+        if image_xxhash is not None and self.thumbnail_store is not None:
+            thumbnail = self.thumbnail_store.get(image_xxhash)
+        if thumbnail is None and image_data is None and not os.path.exists(image_path):
             self.logger.warning(f'Image file does not exist: {image_path}')
             return None
 
-        hashes = {
-            'xxhash': self._generate_image_xxhash(image_path),
-            'ahash': self._generate_ahash(image_path),
-            'dhash': self._generate_dhash(image_path),
-            'whash_haar': self._generate_whash_haar(image_path),
-            'colorhash': self._generate_colorhash(image_path)
-        }
+        if image_xxhash is None:
+            image_xxhash = xxhash.xxh3_128_hexdigest(image_data) if image_data is not None else \
+                self._generate_image_xxhash(image_path)
+        with thumbnail or self.load_hash_image(image_path, image_xxhash, image_data) as img:
+            hashes = ImageHashes(
+                xxhash=image_xxhash,
+                xxhash_version=XXHASH_VERSION,
+                hash_version=self.hash_version,
+                **{hash_type: self._generate_hash(hash_type, img) for hash_type in self.hash_types},
+                **(self._generate_verification_hashes(img) if self.ENABLE_HASH_VERIFICATION else {})
+            )
+            # Variants are only compared by the enabled aHash and dHash
+            if self.ENABLE_HASH_VARIANTS and self.variant_hash_types:
+                hashes.hash_variants = self._generate_hash_variants(img)
         self.logger.debug(f'Generated hashes for image: {image_path}')
         return hashes
 
@@ -158,21 +670,100 @@ class ImageHashService(EnvironmentManager):
             Compare image hashes to determine if they are similar.
 
             This method compares various types of image hashes and determines if they are similar based on predefined
-            maximum similarity percentages.
+            maximum similarity percentages. The 64-bit hashes are a cheap filter, a match is then verified with the
+            16x16 hashes when both images have them. Images that do not match upright are compared against the
+            rotated and flipped variants. Hashes of different versions are not compared.
 
             Args:
-                target_hashes (dict): Hashes of the target image.
-                hashes_to_compare (dict): Hashes of the image to compare.
+                target_hashes (ImageHashes): Hashes of the target image.
+                hashes_to_compare (ImageHashes): Hashes of the image to compare.
 
             Returns:
                 tuple: A tuple containing a boolean indicating similarity and the corresponding similarity output value.
         """
-        for hash_type in ['ahash', 'dhash', 'whash_haar', 'colorhash']:
-            similarity = imagehash.hex_to_hash(target_hashes[hash_type]) - imagehash.hex_to_hash(
-                    hashes_to_compare[hash_type])
+        if target_hashes.hash_version and hashes_to_compare.hash_version and \
+                target_hashes.hash_version != hashes_to_compare.hash_version:
+            self.logger.debug('Images have hashes of different versions')
+            return False, 0
+
+        for hash_type in self.hash_types:
+            if not getattr(target_hashes, hash_type) or not getattr(hashes_to_compare, hash_type):
+                # One of the images was stored before the hash type was enabled
+                continue
+            similarity = imagehash.hex_to_hash(getattr(target_hashes, hash_type)) - imagehash.hex_to_hash(
+                    getattr(hashes_to_compare, hash_type))
             if similarity <= getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT'):
                 self.logger.debug(f'Images are similar based on {hash_type}: {similarity}')
+                if not self.verify_similar(target_hashes, hashes_to_compare):
+                    # The verification does not depend on the matched hash, other hashes would fail it as well
+                    break
                 return True, f'{hash_type.upper()}:{similarity}'
 
+        if self.ENABLE_HASH_VARIANTS:
+            return self.is_similar_variant(target_hashes, hashes_to_compare)
+
+        self.logger.debug('Images are not similar')
+        return False, 0
+
+    def is_similar_variant(self, target_hashes, hashes_to_compare):
+        """
+            Compare an image against the rotated and flipped variants of another image.
+
+            The variants stored with the compared image are used. For images stored without variants, the variants
+            of the target are compared against the compared image instead, which finds the same matches.
+
+            Args:
+                target_hashes (ImageHashes): Hashes of the target image.
+                hashes_to_compare (ImageHashes): Hashes of the image to compare.
+
+            Returns:
+                tuple: A tuple containing a boolean indicating similarity and the corresponding similarity output value.
+        """
+        if hashes_to_compare.hash_variants:
+            upright_hashes, hash_variants = target_hashes, hashes_to_compare.hash_variants
+        elif target_hashes.hash_variants:
+            upright_hashes, hash_variants = hashes_to_compare, target_hashes.hash_variants
+        else:
+            return False, 0
+
+        upright_hashes = ImageHashes(phash16=upright_hashes.phash16, dhash16=upright_hashes.dhash16,
+                                     **{hash_type: bytes.fromhex(getattr(upright_hashes, hash_type))
+                                        for hash_type in self.variant_hash_types if getattr(upright_hashes, hash_type)})
+        for index, (variant_name, _, _) in enumerate(HASH_VARIANTS):
+            variant_hashes = self.get_variant_hashes(hash_variants, index)
+            for hash_type in self.variant_hash_types:
+                if not getattr(upright_hashes, hash_type) or not getattr(variant_hashes, hash_type):
+                    continue
+                similarity = self.bytes_distance(getattr(upright_hashes, hash_type), getattr(variant_hashes, hash_type))
+                if similarity <= getattr(self, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT'):
+                    if not self.verify_similar(upright_hashes, variant_hashes):
+                        break
+                    self.logger.debug(f'Images are similar based on {hash_type} of {variant_name}: {similarity}')
+                    return True, f'{hash_type.upper()}_{variant_name.upper()}:{similarity}'
+
         self.logger.debug('Images are not similar')
         return False, 0
+
+    def verify_similar(self, target_hashes, hashes_to_compare):
+        """
+            Verify a candidate found with the 64-bit hashes using the 16x16 hashes.
+
+            Images stored before the 16x16 hashes were added are not verified.
+
+            Args:
+                target_hashes (ImageHashes): Hashes of the target image.
+                hashes_to_compare (ImageHashes): Hashes of the candidate image.
+
+            Returns:
+                bool: False if the 16x16 hashes show the images are different, True otherwise.
+        """
+        if not self.ENABLE_HASH_VERIFICATION:
+            return True
+        for hash_type in ['phash16', 'dhash16']:
+            if not getattr(target_hashes, hash_type) or not getattr(hashes_to_compare, hash_type):
+                continue
+            distance = self.bytes_distance(getattr(target_hashes, hash_type), getattr(hashes_to_compare, hash_type))
+            if distance > getattr(self, f'{hash_type.upper()}_MAX_DISTANCE'):
+                self.logger.debug(f'Candidate rejected by {hash_type}: {distance}')
+                return False
+        return True
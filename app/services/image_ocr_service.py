@@ -1,9 +1,21 @@
+import json
 import os.path
 import cv2
 import logging
+import threading
 import time
-from paddleocr import PaddleOCR
 from app.config.environment_manager import EnvironmentManager
+from app.services.ocr_backends import OnnxBackend, create_ocr_backend, get_models_version
+from app.services.worker_topology import DEFAULT_OCR_CPU_THREADS
+
+# Angle classifier modes
+ANGLE_CLS_ALWAYS = 'always'
+ANGLE_CLS_NEVER = 'never'
+ANGLE_CLS_ADAPTIVE = 'adaptive'
+ANGLE_CLS_MODES = (ANGLE_CLS_ALWAYS, ANGLE_CLS_NEVER, ANGLE_CLS_ADAPTIVE)
+
+# Height to width ratio of a text box that is read as vertical, same as the PaddleOCR crop rotation
+VERTICAL_BOX_RATIO = 1.5
 
 
 class ImageOCRService(EnvironmentManager):
@@ -18,66 +30,215 @@ class ImageOCRService(EnvironmentManager):
         """
             Initialize and load environment variables.
         """
-        super().__init__(['MIN_TEXT_LEN'])
+        super().__init__(['MIN_TEXT_LEN'], {
+            'OCR_ANGLE_CLS_MODE': ANGLE_CLS_ALWAYS,
+            'OCR_ORIENTATION_PROBE_SIDE': '480',
+            'OCR_ORIENTATION_SAMPLE_BOXES': '8',
+            'OCR_ROI_TEMPLATES_FILE': '',
+            'OCR_BACKEND': 'paddle',
+            'OCR_ENABLE_MKLDNN': 'False',
+            'OCR_CPU_THREADS': str(DEFAULT_OCR_CPU_THREADS),
+            'OCR_ONNX_MODEL_DIR': os.path.join('model', 'onnx'),
+            'OCR_ONNX_QUANTIZED': 'False'
+        })
         self.min_text_len = int(self.env_vars['MIN_TEXT_LEN'])
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing OCR service...')
 
-        self.infer = PaddleOCR(use_angle_cls=True, lang='en', show_log=False,
-                               det_model_dir=os.path.join('model', 'en_PP-OCRv3_det_infer'),
-                               rec_model_dir=os.path.join('model', 'en_PP-OCRv3_rec_infer'),
-                               cls_model_dir=os.path.join('model', 'ch_ppocr_mobile_v2.0_cls_infer'))
+        self.angle_cls_mode = self.env_vars['OCR_ANGLE_CLS_MODE'].lower()
+        if self.angle_cls_mode not in ANGLE_CLS_MODES:
+            raise ValueError(f'Unknown OCR_ANGLE_CLS_MODE: {self.angle_cls_mode}')
+        self.orientation_probe_side = int(self.env_vars['OCR_ORIENTATION_PROBE_SIDE'])
+        self.orientation_sample_boxes = int(self.env_vars['OCR_ORIENTATION_SAMPLE_BOXES'])
+        self.roi_templates = self.load_roi_templates(self.env_vars['OCR_ROI_TEMPLATES_FILE'])
+
+        self.backend = create_ocr_backend(self.env_vars['OCR_BACKEND'].lower(), 'model',
+                                          self.env_vars['OCR_ONNX_MODEL_DIR'],
+                                          use_angle_cls=self.angle_cls_mode != ANGLE_CLS_NEVER,
+                                          enable_mkldnn=self.env_vars['OCR_ENABLE_MKLDNN'].lower() == "true",
+                                          cpu_threads=int(self.env_vars['OCR_CPU_THREADS']),
+                                          quantized=self.env_vars['OCR_ONNX_QUANTIZED'].lower() == "true")
+        self.logger.info(f'OCR backend: {self.backend.name}')
+        # Texts recognized by other models are recomputed by the feature migration
+        self.ocr_version = get_models_version('model', quantized=self.backend.name == OnnxBackend.name and
+                                              self.env_vars['OCR_ONNX_QUANTIZED'].lower() == "true")
+        self.logger.info(f'OCR models version: {self.ocr_version}')
+        # The backends are not thread-safe, the feature migration recognizes images on its own threads
+        self.lock = threading.Lock()
+        self.last_timings = {}
+
+    def load_roi_templates(self, templates_file):
+        """
+            Load the regions of interest of known document templates.
+
+            The file is a JSON object mapping template names to lists of [left, top, right, bottom] regions given
+            as fractions of the image width and height.
 
-    def get_text_from_image(self, image_path):
+            Args:
+                templates_file (str): Path to the JSON file, empty to disable regions of interest.
+
+            Returns:
+                dict: Template names mapped to their regions.
+        """
+        if not templates_file:
+            return {}
+        with open(templates_file) as file:
+            templates = json.load(file)
+        for template, regions in templates.items():
+            for region in regions:
+                left, top, right, bottom = region
+                if not 0 <= left < right <= 1 or not 0 <= top < bottom <= 1:
+                    raise ValueError(f'Invalid region {region} of OCR template {template}')
+        self.logger.info(f'Loaded OCR regions of interest for templates: {", ".join(templates)}')
+        return templates
+
+    def get_text_from_image(self, image_path, template=None, image=None):
         """
             Extract text content from an image.
 
             Args:
                 image_path (str): Path to the image file.
+                template (str): Name of the document template. Only its regions of interest are recognized, the
+                    whole image is recognized for unknown templates.
+                image (ndarray): The image decoded like cv2.imread if already loaded, the file is not read then.
 
             Returns:
                 str: Extracted text as a string.
         """
         self.logger.info(f'Processing image: {image_path}')
-        img = cv2.imread(image_path)
+        img = image if image is not None else cv2.imread(image_path)
         if img is None:
             print('Wrong path:', image_path)
             return ""
 
-        start_time = time.time()
-        try:
-            result = self.get_ocr_text(img)
-        except (Exception,):
-            # Try OCR on upscaled image in case of exception
-            upscaled_image = self.upscale_image(img)
-            result = self.get_ocr_text(upscaled_image)
+        regions = self.roi_templates.get(template) if template else None
+        if regions:
+            img = self.crop_regions(img, regions)
+
+        with self.lock:
+            start_time = time.time()
+            timings = {'probe': 0, 'det': 0, 'cls': 0, 'rec': 0}
+            try:
+                result = self.get_ocr_text(img, self.use_angle_cls(img, timings), timings)
+            except (Exception,):
+                # Try OCR on upscaled image in case of exception
+                upscaled_image = self.upscale_image(img)
+                result = self.get_ocr_text(upscaled_image, self.use_angle_cls(upscaled_image, timings), timings)
 
-        self.logger.info(f'OCR time: {time.time() - start_time}')
+            timings['all'] = time.time() - start_time
+            self.last_timings = timings
+        self.logger.info('OCR time: ' + ', '.join(f'{stage} {elapsed:.3f}s' for stage, elapsed in timings.items()))
         if len(result) <= self.min_text_len:
             self.logger.warning(f'Extracted text too short: {result}')
             return ""
         return result
 
-    def get_ocr_text(self, image):
+    @staticmethod
+    def crop_regions(image, regions):
         """
-            Extract text from the given image using OCR Inferencer.
+            Crop regions of interest from an image.
 
             Args:
                 image: Image data.
+                regions (list): [left, top, right, bottom] regions as fractions of the image size.
+
+            Returns:
+                : Image data, or a list of image data if there are several regions.
+        """
+        height, width = image.shape[:2]
+        crops = [image[int(top * height):int(bottom * height), int(left * width):int(right * width)]
+                 for left, top, right, bottom in regions]
+        return crops[0] if len(crops) == 1 else crops
+
+    def use_angle_cls(self, image, timings=None):
+        """
+            Decide whether the angle classifier has to run on the text boxes of an image.
+
+            Args:
+                image: Image data, or a list of image data.
+                timings (dict): Stage timings the orientation probe time is added to.
+
+            Returns:
+                bool: True if the angle classifier should run.
+        """
+        if self.angle_cls_mode != ANGLE_CLS_ADAPTIVE:
+            return self.angle_cls_mode == ANGLE_CLS_ALWAYS
+        images = image if isinstance(image, list) else [image]
+        start_time = time.time()
+        try:
+            return any(self.is_rotated(img) for img in images)
+        finally:
+            if timings is not None:
+                timings['probe'] += time.time() - start_time
+
+    def is_rotated(self, image):
+        """
+            Check the text orientation of an image once, on a downscaled probe.
+
+            cv2.imread already applies the EXIF orientation, so this only has to catch content that is rotated in
+            the pixels. Text detection on the probe finds vertical text lines of images rotated by 90 or 270
+            degrees, and the angle classifier on a few of the largest lines finds upside-down images.
+
+            Args:
+                image: Image data.
+
+            Returns:
+                bool: True if the image is rotated or its orientation is unknown.
+        """
+        height, width = image.shape[:2]
+        scale = min(1.0, self.orientation_probe_side / max(height, width))
+        probe = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA) \
+            if scale < 1 else image
+        dt_boxes = self.backend.detect(probe)
+        if not dt_boxes:
+            # Nothing found on the probe, let the full pass decide per text box
+            return True
+
+        sizes = []
+        for box in dt_boxes:
+            x, y, box_width, box_height = cv2.boundingRect(box.astype('int32'))
+            sizes.append((x, y, box_width, box_height))
+        vertical_boxes = sum(box_height >= box_width * VERTICAL_BOX_RATIO for _, _, box_width, box_height in sizes)
+        if vertical_boxes * 2 > len(sizes):
+            self.logger.debug(f'Rotated image: {vertical_boxes} of {len(sizes)} text lines are vertical')
+            return True
+
+        # Classify crops of the largest text lines taken from the full resolution image
+        sizes.sort(key=lambda size: size[2] * size[3], reverse=True)
+        crops = []
+        for x, y, box_width, box_height in sizes[:self.orientation_sample_boxes]:
+            crop = image[int(y / scale):int((y + box_height) / scale), int(x / scale):int((x + box_width) / scale)]
+            if crop.size:
+                crops.append(crop)
+        if not crops:
+            return True
+        labels = self.backend.classify(crops)
+        upside_down = labels.count('180')
+        self.logger.debug(f'Orientation probe: {upside_down} of {len(labels)} text lines are upside down')
+        return upside_down * 2 >= len(labels)
+
+    def get_ocr_text(self, image, cls=True, timings=None):
+        """
+            Extract text from the given image using the OCR backend.
+
+            Args:
+                image: Image data, or a list of image data recognized in order.
+                cls (bool): Run the angle classifier on the text boxes.
+                timings (dict): Stage timings the detection, classification and recognition times are added to.
 
             Returns:
                 str: Extracted text as a string.
         """
-        result = self.infer.ocr(image, cls=True)
         recognized_text = ''
-        for idx in range(len(result)):
-            res = result[idx]
-            if res is None:
-                continue
-            for line in res:
-                recognized_text += f' {line[1][0]}'
+        for img in image if isinstance(image, list) else [image]:
+            texts, time_dict = self.backend.recognize(img, cls)
+            if timings is not None:
+                for stage in ('det', 'cls', 'rec'):
+                    timings[stage] += time_dict[stage]
+            for text in texts:
+                recognized_text += f' {text}'
         return recognized_text
 
     @staticmethod
@@ -86,10 +247,12 @@ class ImageOCRService(EnvironmentManager):
             Utility function to upscale image.
 
             Args:
-                image: Image data.
+                image: Image data, or a list of image data.
 
             Returns:
                 : Upscaled image data.
         """
+        if isinstance(image, list):
+            return [ImageOCRService.upscale_image(img) for img in image]
         height, width = image.shape[:2]
         return cv2.resize(image, (width * 2, height * 2), interpolation=cv2.INTER_LINEAR)
@@ -0,0 +1,164 @@
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import xxhash
+from PIL import Image
+
+
+class PrefetchedImage:
+    """
+        An image file loaded ahead of its task.
+
+        Attributes:
+            image_path (str): Path of the image file.
+            data (bytes): Content of the file, None if it could not be read.
+            xxhash (str): 128-bit xxHash (XXH3) of the content, the current version xxhash of the image.
+            size (tuple): Width and height from the image header, None if the header cannot be read.
+            image (ndarray): The image decoded the same way as cv2.imread, None if it was not decoded ahead.
+            memory_bytes (int): Memory held by the content and the decoded image.
+    """
+
+    __slots__ = ('image_path', 'data', 'xxhash', 'size', 'image', 'memory_bytes')
+
+    def __init__(self, image_path, data=None, xxhash=None, size=None, image=None):
+        self.image_path = image_path
+        self.data = data
+        self.xxhash = xxhash
+        self.size = size
+        self.image = image
+        self.memory_bytes = (len(data) if data is not None else 0) + (image.nbytes if image is not None else 0)
+
+    def get_image(self):
+        """
+            Returns:
+                ndarray: The decoded image, decoded from the content now if it was not decoded ahead.
+        """
+        if self.image is None:
+            return cv2.imdecode(np.frombuffer(self.data, np.uint8), cv2.IMREAD_COLOR)
+        return self.image
+
+
+class ImagePrefetcher:
+    """
+        Read-ahead of image files on background I/O threads.
+
+        The consumer submits the images of the messages it holds ahead of the current task. Their files are read,
+        hashed and decoded while the current task runs, so slow storage does not leave the CPU idle between tasks.
+        The memory of the loaded images is bounded: no new reads are admitted once the limit is reached, and an
+        image whose decoded size would exceed it is only read, it is decoded by its task.
+    """
+
+    def __init__(self, io_workers, max_memory_mb, logger_level=logging.INFO):
+        """
+            Start the I/O threads.
+
+            Args:
+                io_workers (int): Number of I/O threads.
+                max_memory_mb (float): Memory limit of the loaded images that were not taken yet.
+                logger_level: Logger level.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, io_workers), thread_name_prefix='image-prefetch')
+
+    def has_capacity(self):
+        """
+            Returns:
+                bool: True if the loaded images are below the memory limit.
+        """
+        with self.lock:
+            return self.memory_bytes < self.max_memory_bytes
+
+    def submit(self, image_path):
+        """
+            Start loading an image.
+
+            Args:
+                image_path (str): Path to the image file.
+
+            Returns:
+                Future: Future of the PrefetchedImage.
+        """
+        return self.executor.submit(self.load, image_path)
+
+    def load(self, image_path):
+        """
+            Read, hash and decode an image file. Runs on an I/O thread.
+
+            Args:
+                image_path (str): Path to the image file.
+
+            Returns:
+                PrefetchedImage: The loaded image, without data if the file cannot be read.
+        """
+        try:
+            with open(image_path, 'rb') as image_file:
+                data = image_file.read()
+        except OSError as e:
+            self.logger.debug(f'Failed to prefetch {image_path}: {e}')
+            return PrefetchedImage(image_path)
+
+        try:
+            with Image.open(io.BytesIO(data)) as header:
+                size = header.size
+            decoded_bytes = size[0] * size[1] * 3
+        except Exception as e:
+            self.logger.debug(f'Failed to read image header of {image_path}: {e}')
+            size = decoded_bytes = None
+
+        with self.lock:
+            self.memory_bytes += len(data)
+            can_decode = decoded_bytes is not None and self.memory_bytes + decoded_bytes <= self.max_memory_bytes
+            if can_decode:
+                self.memory_bytes += decoded_bytes
+        image = None
+        if can_decode:
+            image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            with self.lock:
+                # The decoded size differs from the header size for images cv2 cannot decode
+                self.memory_bytes += (image.nbytes if image is not None else 0) - decoded_bytes
+        prefetched_image = PrefetchedImage(image_path, data, xxhash.xxh3_128_hexdigest(data), size, image)
+        self.logger.debug(f'Prefetched {image_path}: {prefetched_image.memory_bytes / 1024 / 1024:.1f} MB')
+        return prefetched_image
+
+    def take(self, future):
+        """
+            Wait for a submitted image and hand its memory over to the task.
+
+            Args:
+                future (Future): Future returned by submit.
+
+            Returns:
+                PrefetchedImage: The loaded image, None if loading failed.
+        """
+        try:
+            prefetched_image = future.result()
+        except Exception as e:
+            self.logger.warning(f'Image prefetch failed: {e}')
+            return None
+        with self.lock:
+            self.memory_bytes -= prefetched_image.memory_bytes
+        return prefetched_image if prefetched_image.data is not None else None
+
+    def discard(self, future):
+        """
+            Drop a submitted image that will not be processed by this worker.
+
+            Args:
+                future (Future): Future returned by submit.
+        """
+        if not future.cancel():
+            self.take(future)
+
+    def close(self):
+        """
+            Stop the I/O threads, pending reads are cancelled.
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
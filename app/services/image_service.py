@@ -1,16 +1,30 @@
+import json
 import logging
 import os
+import time
 import traceback
 import uuid
-from threading import Thread, Lock
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
 
-from pika import BasicProperties
+import numpy as np
+import xxhash
 
 from app.config.environment_manager import EnvironmentManager
+from app.messaging.queue_scheduler import WeightedFairQueueScheduler
+from app.db.image_columns_cache import COMPARE_PROJECTION, ImageColumnsCache
+from app.db.image_records import SimilarImage, StoredImage
 from app.db.recognized_images_repository import RecognizedImagesRepository
-from app.services.image_hash_service import ImageHashService
+from app.services.duplicate_clustering_service import DuplicateClusteringService
+from app.services.feature_migration_service import FeatureMigrationService
+from app.services.image_hash_service import ImageHashService, XXHASH_VERSION
 from app.services.image_ocr_service import ImageOCRService
+from app.services.image_prefetcher import ImagePrefetcher
 from app.services.image_similarity_service import ImageSimilarityService
+from app.services.worker_profiler import WorkerProfiler, PROFILE_SAMPLING
+from app.services.worker_control import GracefulShutdown, TaskRequeueRequested, WorkerBackpressure
 
 # Constants for queue names
 OCR_IMAGE_QUEUE = 'ocr_image_queue'
@@ -33,47 +47,270 @@ class ImageService(EnvironmentManager):
         """
             Initializes with specified messaging_connection.
         """
-        super().__init__(['ENABLE_MAINTENANCE_QUEUE'])
+        super().__init__(['ENABLE_MAINTENANCE_QUEUE'], {
+            'QUEUE_WEIGHTS': f'{OCR_IMAGE_QUEUE}:1,{COMPARE_IMAGES_QUEUE}:8,{MAINTENANCE_QUEUE}:1',
+            'COMPARE_LATENCY_SLO_SECONDS': '10',
+            'QUEUE_IDLE_POLL_INTERVAL': '0.1',
+            'QUEUE_METRICS_LOG_INTERVAL': '60',
+            'SHUTDOWN_GRACE_SECONDS': '25',
+            'MAX_WORKER_MEMORY_MB': '0',
+            'MAX_BACKPRESSURE_PAUSE_SECONDS': '300',
+            'BACKPRESSURE_POLL_INTERVAL': '1',
+            'ENABLE_COMPARE_CACHE': 'True',
+            'DEDUPLICATE_IMAGES': 'False',
+            'BATCH_HASH_WORKERS': '4',
+            'ENABLE_IMAGE_COLUMNS_CACHE': 'True',
+            'COMPARE_STREAM_BATCH_SIZE': '10000',
+            'IMAGE_PREFETCH_WINDOW': '0',
+            'IMAGE_PREFETCH_WORKERS': '2',
+            'IMAGE_PREFETCH_MAX_MB': '256',
+            'PROFILE_OUTPUT_DIR': 'profiles',
+            'PROFILE_SAMPLE_INTERVAL': '0.01',
+            'PROFILE_MAX_SECONDS': '300'
+        })
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing Image service...')
         self.enable_maintenance_queue = self.env_vars['ENABLE_MAINTENANCE_QUEUE'].lower() == "true"
+        self.queue_idle_poll_interval = float(self.env_vars['QUEUE_IDLE_POLL_INTERVAL'])
+        self.queue_metrics_log_interval = float(self.env_vars['QUEUE_METRICS_LOG_INTERVAL'])
+        self.queue_scheduler = WeightedFairQueueScheduler(
+            self.parse_queue_weights(self.env_vars['QUEUE_WEIGHTS']),
+            {COMPARE_IMAGES_QUEUE: float(self.env_vars['COMPARE_LATENCY_SLO_SECONDS'])}
+        )
+        self.queue_metrics_logged_at = time.monotonic()
+        self.shutdown = GracefulShutdown(float(self.env_vars['SHUTDOWN_GRACE_SECONDS']), self.logger_level)
+        self.backpressure = WorkerBackpressure(int(self.env_vars['MAX_WORKER_MEMORY_MB']),
+                                               float(self.env_vars['MAX_BACKPRESSURE_PAUSE_SECONDS']),
+                                               self.logger_level)
+        self.backpressure_poll_interval = float(self.env_vars['BACKPRESSURE_POLL_INTERVAL'])
+        self.backpressure_logged_at = 0
+        self.restart_requested = False
         self.messaging_connection = messaging_connection
         self.db_connection = RecognizedImagesRepository()
         self.image_ocr_service = ImageOCRService()
         self.image_similarity_service = ImageSimilarityService()
         self.image_hash_service = ImageHashService()
-        self.ocr_queue_empty = False
-        self.lock = Lock()
+        # Whether images with a version 1 xxhash are stored, None until checked
+        self.legacy_xxhash_images = None
+        self.enable_compare_cache = self.env_vars['ENABLE_COMPARE_CACHE'].lower() == "true"
+        self.deduplicate_images = self.env_vars['DEDUPLICATE_IMAGES'].lower() == "true"
+        self.compare_settings_key = self.get_compare_settings_key()
+        self.batch_hash_workers = int(self.env_vars['BATCH_HASH_WORKERS'])
+        if self.enable_compare_cache:
+            # Results of other thresholds are never hit again
+            self.db_connection.delete_compare_cache_by_settings(self.compare_settings_key)
+        self.compare_stream_batch_size = int(self.env_vars['COMPARE_STREAM_BATCH_SIZE'])
+        self.image_columns_cache = None
+        if self.env_vars['ENABLE_IMAGE_COLUMNS_CACHE'].lower() == "true":
+            self.image_columns_cache = ImageColumnsCache(
+                self.db_connection, self.image_similarity_service.text_similarity_metric.uses_texts, self.logger_level,
+                self.image_hash_service.hash_types)
+        self.image_prefetch_window = int(self.env_vars['IMAGE_PREFETCH_WINDOW'])
+        self.image_prefetcher = None
+        if self.image_prefetch_window > 0:
+            self.image_prefetcher = ImagePrefetcher(int(self.env_vars['IMAGE_PREFETCH_WORKERS']),
+                                                    float(self.env_vars['IMAGE_PREFETCH_MAX_MB']), self.logger_level)
+        # Messages taken ahead of the current task with the futures of their images, per queue with image tasks
+        self.read_ahead_messages = {OCR_IMAGE_QUEUE: deque(), COMPARE_IMAGES_QUEUE: deque()}
+        # Started by the migrate_features maintenance action
+        self.feature_migration = None
+        # Started by the cluster_duplicates maintenance action
+        self.duplicate_clustering = None
+        # Started by the start_profiling maintenance action
+        # Properties of the start_profiling request that gets the profile summary once it finishes
+        self.profile_request_properties = None
+        self.worker_profiler = WorkerProfiler(self.env_vars['PROFILE_OUTPUT_DIR'],
+                                              float(self.env_vars['PROFILE_SAMPLE_INTERVAL']),
+                                              float(self.env_vars['PROFILE_MAX_SECONDS']), self.logger_level)
+
+    def get_compare_settings_key(self):
+        """
+            Get a key of the settings that decide which images are similar.
+
+            Returns:
+                str: Hash of the similarity thresholds, the enabled hash types with their thresholds and the versions
+                of the OCR models and hashes.
+        """
+        settings = {
+            'similarity_percentage': self.image_similarity_service.similarity_percentage,
+            'enable_preprocess_text': self.image_similarity_service.enable_preprocess_text,
+            'text_similarity_metric': self.image_similarity_service.text_similarity_metric.name,
+            # The thresholds of the enabled hash types only, so that the keys of the default types are unchanged
+            **{hash_type: getattr(self.image_hash_service, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')
+               for hash_type in self.image_hash_service.hash_types},
+            'enable_hash_verification': self.image_hash_service.ENABLE_HASH_VERIFICATION,
+            'enable_hash_variants': self.image_hash_service.ENABLE_HASH_VARIANTS,
+            'phash16': self.image_hash_service.PHASH16_MAX_DISTANCE,
+            'dhash16': self.image_hash_service.DHASH16_MAX_DISTANCE,
+            'ocr_version': self.image_ocr_service.ocr_version,
+            'hash_version': self.image_hash_service.hash_version,
+        }
+        return xxhash.xxh3_64_hexdigest(json.dumps(settings, sort_keys=True).encode())
+
+    @staticmethod
+    def parse_queue_weights(queue_weights):
+        """
+            Parse queue weights from a 'queue:weight,queue:weight' string.
+
+            Args:
+                queue_weights (str): The queue weights string.
+
+            Returns:
+                dict: Queue names mapped to their weights.
+        """
+        weights = {}
+        for item in queue_weights.split(','):
+            queue_name, weight = item.split(':')
+            weights[queue_name.strip()] = float(weight)
+        for queue_name in (OCR_IMAGE_QUEUE, COMPARE_IMAGES_QUEUE, MAINTENANCE_QUEUE):
+            if weights.get(queue_name, 0) <= 0:
+                raise ValueError(f'QUEUE_WEIGHTS must set a positive weight for {queue_name}')
+        return weights
 
     def consume_queues(self):
         """
-            Consumes messages from OCR and Compare queues continuously.
+            Consumes messages from OCR, Compare and Maintenance queues continuously.
+
+            The queue to take the next message from is chosen by the weighted fair queue scheduler, so a backlog in
+            one queue cannot starve the others. No new messages are taken while the worker is saturated or after a
+            shutdown was requested. A worker saturated for longer than MAX_BACKPRESSURE_PAUSE_SECONDS stops with
+            restart_requested set.
         """
         try:
-            while True:
-                queue_status = self.messaging_connection.channel.queue_declare(queue=OCR_IMAGE_QUEUE, passive=True)
-                while queue_status.method.message_count > 0:
-                    self.consume_single_message(OCR_IMAGE_QUEUE)
-                    queue_status = self.messaging_connection.channel.queue_declare(queue=OCR_IMAGE_QUEUE, passive=True)
-                self.consume_single_message(COMPARE_IMAGES_QUEUE)
-                self.consume_single_message(MAINTENANCE_QUEUE)
+            while not self.shutdown.is_requested:
+                if self.backpressure.is_saturated():
+                    if self.backpressure.is_pause_expired():
+                        # Nothing in flight can free the memory, restart the worker instead of pausing forever
+                        self.logger.error(f"Worker saturated for more than {self.backpressure.max_pause_seconds} "
+                                          f"seconds, stopping it to be restarted")
+                        self.restart_requested = True
+                        self.shutdown.request()
+                        break
+                    self.log_backpressure()
+                    self.messaging_connection.connection.sleep(self.backpressure_poll_interval)
+                    continue
+                if not any(self.consume_single_message(queue_name)
+                           for queue_name in self.queue_scheduler.queue_order()):
+                    self.messaging_connection.connection.sleep(self.queue_idle_poll_interval)
+                self.log_queue_metrics()
+                # The profile is finished on this thread, the cprofile trace belongs to it
+                self.reply_profile(self.worker_profiler.poll())
+            self.release_read_ahead_messages()
+            self.logger.info("Stopped consuming messages")
         except Exception as e:
             self.logger.exception("Exception while consuming messages", exc_info=e)
 
+    def log_backpressure(self):
+        """
+            Log that consumption is paused, at most once a minute.
+        """
+        if time.monotonic() - self.backpressure_logged_at < 60:
+            return
+        self.backpressure_logged_at = time.monotonic()
+        self.logger.warning(f"Worker saturated, pausing consumption: "
+                            f"{self.backpressure.get_memory_usage() // (1024 * 1024)} MB resident")
+
     def consume_single_message(self, queue_name):
         """
             Consumes a single message from a given queue.
 
+            With image prefetching, up to IMAGE_PREFETCH_WINDOW messages of the OCR and compare queues are taken
+            ahead of the current one and their images are loaded while it is processed.
+
             Args:
                 queue_name: Name of the queue to consume from.
+
+            Returns:
+                bool: True if a message was consumed.
+        """
+        prefetched_image = None
+        if self.image_prefetcher is not None and queue_name in self.read_ahead_messages:
+            self.read_ahead(queue_name)
+            if not self.read_ahead_messages[queue_name]:
+                return False
+            method_frame, properties, body, image_future = self.read_ahead_messages[queue_name].popleft()
+            # Take the next message before processing this one, so its image loads in the meantime
+            self.read_ahead(queue_name)
+            if image_future is not None:
+                prefetched_image = self.image_prefetcher.take(image_future)
+        else:
+            method_frame, properties, body = self.messaging_connection.channel.basic_get(queue=queue_name)
+            if not method_frame:
+                return False
+        self.logger.debug(f"Consuming single message from {queue_name}")
+        wait_time = self.queue_scheduler.get_wait_time(properties)
+        start_time = time.monotonic()
+        self.process_message(queue_name, self.messaging_connection.channel, method_frame, properties, body,
+                             prefetched_image)
+        self.queue_scheduler.on_served(queue_name, wait_time, time.monotonic() - start_time)
+        return True
+
+    def read_ahead(self, queue_name):
         """
-        method_frame, properties, body = self.messaging_connection.channel.basic_get(queue=queue_name)
-        if method_frame:
-            self.logger.debug(f"Consuming single message from {queue_name}")
-            self.process_message(queue_name, self.messaging_connection.channel, method_frame, properties, body)
+            Take messages from a queue until IMAGE_PREFETCH_WINDOW messages are held ahead, and start loading their
+            images. A queue without held messages always gets one, so a window filled by another queue does not
+            stop it. The messages stay unacknowledged and are redelivered if the worker stops.
 
-    def process_message(self, queue_name, channel, method, properties, body):
+            Args:
+                queue_name: Name of the queue to take messages from.
+        """
+        messages = self.read_ahead_messages[queue_name]
+        while not self.shutdown.is_requested and (not messages or (
+                sum(map(len, self.read_ahead_messages.values())) < self.image_prefetch_window and
+                self.image_prefetcher.has_capacity())):
+            method_frame, properties, body = self.messaging_connection.channel.basic_get(queue=queue_name)
+            if not method_frame:
+                return
+            messages.append((method_frame, properties, body, self.prefetch_image(body, properties)))
+
+    def prefetch_image(self, body, properties):
+        """
+            Start loading the image of a task message.
+
+            Args:
+                body: The message body.
+                properties: Properties of the message.
+
+            Returns:
+                Future: Future of the PrefetchedImage, None for messages without a single image.
+        """
+        try:
+            task = self.messaging_connection.parse_message(body, properties)
+        except Exception as e:
+            # The message fails again when processed, and is dead-lettered then
+            self.logger.debug(f"Not prefetching unparsable message: {e}")
+            return None
+        if not isinstance(task, dict) or not isinstance(task.get('image_path'), str) or 'images' in task:
+            return None
+        return self.image_prefetcher.submit(task['image_path'])
+
+    def release_read_ahead_messages(self):
+        """
+            Requeue the messages taken ahead that were not processed, so that other workers can take them.
+        """
+        for messages in self.read_ahead_messages.values():
+            while messages:
+                method_frame, _, _, image_future = messages.popleft()
+                if image_future is not None:
+                    self.image_prefetcher.discard(image_future)
+                self.messaging_connection.channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+
+    def log_queue_metrics(self, force=False):
+        """
+            Log queue-wait and service time metrics every QUEUE_METRICS_LOG_INTERVAL seconds.
+
+            Args:
+                force (bool): Log regardless of the interval.
+        """
+        if not force and time.monotonic() - self.queue_metrics_logged_at < self.queue_metrics_log_interval:
+            return
+        self.queue_metrics_logged_at = time.monotonic()
+        for queue_name, summary in self.queue_scheduler.summary().items():
+            if summary['count']:
+                self.logger.info(f"Queue metrics {queue_name}: {summary}")
+
+    def process_message(self, queue_name, channel, method, properties, body, prefetched_image=None):
         """
             Processes received message based on its queue.
 
@@ -83,59 +320,130 @@ class ImageService(EnvironmentManager):
                 method: Method frame received.
                 properties: Properties of the message.
                 body: The actual message body.
+                prefetched_image (PrefetchedImage): The image of the task if it was loaded ahead.
         """
         try:
-            task = self.messaging_connection.parse_message(body)
+            task = self.messaging_connection.parse_message(body, properties)
             if queue_name == OCR_IMAGE_QUEUE:
-                self.handle_ocr_task(task)
+                status = self.handle_ocr_task(task, prefetched_image)
+                self.reply(properties, {"image_id": task.get('image_id'), "status": status}, private_only=True)
+                self.worker_profiler.on_task_done()
             elif queue_name == COMPARE_IMAGES_QUEUE:
-                self.handle_compare_task(task)
+                self.handle_compare_task(task, properties, prefetched_image)
+                self.worker_profiler.on_task_done()
             elif queue_name == MAINTENANCE_QUEUE:
-                self.handle_maintenance_task(task)
+                status = self.handle_maintenance_task(task, properties)
+                if status is not None:
+                    self.reply(properties, {"action": task.get('action'), "status": status}, private_only=True)
             else:
                 self.logger.error(f"Unknown queue: {queue_name}")
                 raise ValueError(f"Unknown queue: {queue_name}")
-            channel.basic_ack(delivery_tag=method.delivery_tag)
+            # Acknowledge only once the broker confirmed the reply, a crash before that redelivers the task
+            if self.messaging_connection.flush():
+                channel.basic_ack(delivery_tag=method.delivery_tag)
+            else:
+                self.logger.error(f'Reply to a message from {queue_name} was not confirmed, requeuing the message')
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        except TaskRequeueRequested as e:
+            self.logger.warning(f'Requeuing message from {queue_name}: {e}')
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
         except Exception as e:
             self.logger.exception(f'Exception while processing message from {queue_name}', exc_info=e)
-            # Negative acknowledgment without requeuing
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-            # Publish the failed message to the Dead Letter Exchange
-            channel.basic_publish(
-                exchange='dlx_exchange',
-                routing_key='rejected',
-                properties=BasicProperties(delivery_mode=2),
-                body=body
-            )
-        finally:
-            if queue_name == OCR_IMAGE_QUEUE:
-                queue_status = channel.queue_declare(queue=OCR_IMAGE_QUEUE, passive=True)
-                with self.lock:
-                    self.ocr_queue_empty = queue_status.method.message_count == 0
+            # Publish the failed message to the Dead Letter Exchange before rejecting it
+            self.messaging_connection.publish_dead_letter(body)
+            # Negative acknowledgment without requeuing, unless the dead letter was not confirmed
+            requeue = not self.messaging_connection.flush()
+            if requeue:
+                self.logger.error(f'Dead letter of a message from {queue_name} was not confirmed, requeuing it')
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=requeue)
 
     def start_consuming(self):
         """
             Starts a thread to consume messages from queues.
+
+            On SIGTERM or SIGINT the consumer stops taking new messages and the in-flight task gets
+            SHUTDOWN_GRACE_SECONDS to finish. A task still running after the deadline is abandoned; its message
+            is unacknowledged and is redelivered by RabbitMQ once the connection is gone.
         """
+        consume_thread = None
         try:
+            if threading.current_thread() is threading.main_thread():
+                self.shutdown.install_signal_handlers()
             self.messaging_connection.connect()
             self.logger.info("Starting to consume messages...")
-            consume_thread = Thread(target=self.consume_queues)
+            consume_thread = Thread(target=self.consume_queues, daemon=True)
             consume_thread.start()
-            consume_thread.join()
+            # Join with a timeout so that signal handlers can run in the main thread
+            while consume_thread.is_alive() and not self.shutdown.is_requested:
+                consume_thread.join(0.5)
+            consume_thread.join(self.shutdown.remaining())
         except Exception as e:
             self.logger.exception("Exception while consuming messages", exc_info=e)
             traceback.print_exc()
         finally:
-            if self.messaging_connection.connection.is_open:
-                self.messaging_connection.connection.close()
+            self.close(consume_thread)
 
-    def handle_maintenance_task(self, task):
+    def close(self, consume_thread=None):
+        """
+            Flush pending publishes and close connections.
+
+            Args:
+                consume_thread (Thread): The consumer thread. Its connection is left to be dropped on exit if the
+                    thread is still running, as pika connections must not be used from two threads.
+        """
+        if consume_thread is not None and consume_thread.is_alive():
+            self.logger.warning("In-flight task did not finish before the shutdown deadline, it will be redelivered")
+            if self.messaging_connection.publisher:
+                self.messaging_connection.publisher.flush(self.messaging_connection.rabbitmq_publisher_flush_timeout)
+        else:
+            # Wait for publish confirms before closing the connection
+            self.messaging_connection.close()
+        if self.image_prefetcher is not None:
+            self.image_prefetcher.close()
+        if self.feature_migration is not None:
+            self.feature_migration.stop(self.shutdown.remaining())
+        # Write the profile that was running, it is cut short
+        self.worker_profiler.stop()
+        self.db_connection.close()
+        self.logger.info("Image service stopped")
+
+    def reply(self, properties, message, private_only=False):
+        """
+            Send a task reply to the queue named in the reply_to property of the request.
+
+            Args:
+                properties: Properties of the request message.
+                message (dict): The reply payload.
+                private_only (bool): Only reply when the requester asked for its own reply queue, so that clients
+                    reading the shared response queue keep receiving compare results only.
+        """
+        reply_to = getattr(properties, 'reply_to', None)
+        if private_only and reply_to in (None, RESPONSE_QUEUE):
+            return
+        self.messaging_connection.send_reply(properties, message)
+
+    def reply_profile(self, summary):
+        """
+            Send the summary of a finished profile to the start_profiling request waiting for it.
+
+            Args:
+                summary (dict): The profile summary, None if no profile finished.
+        """
+        if summary is None or self.profile_request_properties is None:
+            return
+        properties, self.profile_request_properties = self.profile_request_properties, None
+        self.reply(properties, {"action": 'start_profiling', "status": summary}, private_only=True)
+
+    def handle_maintenance_task(self, task, properties=None):
         """
             Handles maintenance tasks, such as clearing collections.
 
             Args:
                 task: The task containing details about the maintenance operation.
+                properties: Properties of the task message.
+
+            Returns:
+                The status to reply with, None if the reply is sent later.
         """
         action = task.get('action')
         if not self.enable_maintenance_queue:
@@ -144,36 +452,147 @@ class ImageService(EnvironmentManager):
 
         if action == 'clear_all_collections':
             self.db_connection.clear_all_collections()
+            if self.image_columns_cache is not None:
+                self.image_columns_cache.clear()
             self.logger.info("All collections cleared successfully.")
             return "All collections cleared successfully."
 
+        elif action == 'get_queue_metrics':
+            self.log_queue_metrics(force=True)
+            return self.queue_scheduler.summary()
+
+        elif action == 'cluster_duplicates':
+            # Runs on a background thread of this worker, so the consumer keeps its heartbeats and acks the task
+            if self.duplicate_clustering is None:
+                self.duplicate_clustering = DuplicateClusteringService(self.db_connection, self.image_hash_service,
+                                                                       self.image_similarity_service)
+            if not self.duplicate_clustering.start():
+                return "Duplicate clustering is already running."
+            return "Duplicate clustering started."
+
+        elif action == 'get_clustering_status':
+            if self.duplicate_clustering is None:
+                return "Duplicate clustering was not started."
+            return self.duplicate_clustering.status()
+
+        elif action == 'migrate_features':
+            # Runs on a background thread of this worker, tasks are processed meanwhile
+            if self.feature_migration is None:
+                self.feature_migration = FeatureMigrationService(self.db_connection, self.image_hash_service,
+                                                                 self.image_ocr_service, self.image_similarity_service)
+            if not self.feature_migration.start():
+                return "Feature migration is already running."
+            return "Feature migration started."
+
+        elif action == 'get_migration_status':
+            if self.feature_migration is None:
+                return "Feature migration was not started."
+            return self.feature_migration.status()
+
+        elif action == 'stop_migration':
+            if self.feature_migration is None or not self.feature_migration.is_running():
+                return "Feature migration is not running."
+            self.feature_migration.stop()
+            return self.feature_migration.status()
+
+        elif action == 'start_profiling':
+            # Profiles this worker for the given seconds or tasks. A requester with its own reply queue gets the
+            # summary as the reply once the profile finishes, get_profile returns it as well
+            if self.worker_profiler.is_running():
+                return "Profiling is already running."
+            try:
+                settings = self.worker_profiler.start(task.get('mode', PROFILE_SAMPLING), task.get('seconds'),
+                                                      task.get('tasks'), bool(task.get('all_threads')),
+                                                      task.get('top', 20))
+            except ValueError as e:
+                return str(e)
+            if ((task.get('seconds') or task.get('tasks')) and
+                    getattr(properties, 'reply_to', None) not in (None, RESPONSE_QUEUE)):
+                self.profile_request_properties = properties
+                return None
+            return settings
+
+        elif action == 'stop_profiling':
+            if not self.worker_profiler.is_running():
+                return "Profiling is not running."
+            summary = self.worker_profiler.stop()
+            self.reply_profile(summary)
+            return summary
+
+        elif action == 'get_profile':
+            if self.worker_profiler.is_running():
+                return "Profiling is running."
+            return self.worker_profiler.last_summary or "No profile was taken."
+
         else:
             return "Unknown maintenance action."
 
-    def get_recognized_text_or_none(self, task, image_xxhash):
+    def get_images_by_xxhash(self, image_path, image_xxhash):
+        """
+            Find stored images with the same content.
+
+            Images stored with a version 1 xxhash are looked up by it and migrated to the current version when found.
+
+            Args:
+                image_path (str): Path to the image file.
+                image_xxhash (str): The xxhash string of the image.
+
+            Returns:
+                list[StoredImage]: List of images with the same content.
+        """
+        existing_images = self.db_connection.get_images_by_xxhash(image_xxhash)
+        if existing_images:
+            return existing_images
+
+        if self.legacy_xxhash_images is None:
+            self.legacy_xxhash_images = self.db_connection.has_legacy_xxhash_images()
+        if not self.legacy_xxhash_images:
+            return existing_images
+
+        legacy_xxhash = self.image_hash_service.generate_legacy_image_xxhash(image_path)
+        legacy_images = self.db_connection.get_legacy_images_by_xxhash(legacy_xxhash)
+        if legacy_images:
+            self.db_connection.update_xxhash([image.id for image in legacy_images], image_xxhash, XXHASH_VERSION)
+            self.logger.info(f"Migrated xxhash of {len(legacy_images)} images to version {XXHASH_VERSION}")
+            # Check again on the next lookup whether legacy images are left
+            self.legacy_xxhash_images = None
+        return legacy_images
+
+    def get_recognized_text_or_none(self, task, image_xxhash, prefetched_image=None):
         """
             Check if the image is already in the database, and return recognized text if present.
 
             Args:
                 task (dict): Dictionary containing image details like path, id, etc.
                 image_xxhash (str): The xxhash string of the image.
+                prefetched_image (PrefetchedImage): The image of the task if it was loaded ahead.
 
             Returns:
                 tuple: A message string and the recognized text, if available.
         """
-        existing_images = self.db_connection.get_images_by_xxhash(image_xxhash)
+        existing_images = self.get_images_by_xxhash(task['image_path'], image_xxhash)
+        # Texts recognized by other OCR models are not reused, until the feature migration updates them
+        ocr_version = self.image_ocr_service.ocr_version
+        message = None
         for existing_image in existing_images:
-            if existing_image['image_path'] == task['image_path']:
+            if existing_image.image_path == task['image_path']:
                 self.logger.info("Image already recognized and saved")
-                return 'Image already recognized and saved', existing_image['recognized_text']
+                if existing_image.ocr_version == ocr_version:
+                    return 'Image already recognized and saved', existing_image.recognized_text
+                message = 'Image already recognized and saved'
 
-        recognized_text = existing_images[0]['recognized_text'] if existing_images else None
+        recognized_text = next((existing_image.recognized_text for existing_image in existing_images
+                                if existing_image.ocr_version == ocr_version), None)
         if recognized_text is None:
-            recognized_text = self.image_ocr_service.get_text_from_image(task['image_path'])
+            # Don't start OCR once the shutdown deadline has passed
+            self.shutdown.check_deadline()
+            recognized_text = self.image_ocr_service.get_text_from_image(
+                task['image_path'], task.get('template'),
+                prefetched_image.get_image() if prefetched_image is not None else None)
             if recognized_text == "":
                 self.logger.info("Text was not recognized or text length less than required")
                 return "Text was not recognized or text len less than required", None
-        return None, recognized_text
+        return message, recognized_text
 
     def insert_image_to_db(self, task, image_hashes, recognized_text):
         """
@@ -181,7 +600,7 @@ class ImageService(EnvironmentManager):
 
             Args:
                 task (dict): Dictionary containing image details like path, id, etc.
-                image_hashes (dict): The hashes dict of the image.
+                image_hashes (ImageHashes): The hashes of the image.
                 recognized_text (str): The text recognized from the image.
 
             Returns:
@@ -190,106 +609,176 @@ class ImageService(EnvironmentManager):
         current_image_id = str(uuid.uuid4())
         self.db_connection.insert_image_details({
             "_id": current_image_id,
-            "xxhash": image_hashes['xxhash'],
-            "ahash": image_hashes['ahash'],
-            "dhash": image_hashes['dhash'],
-            "whash_haar": image_hashes['whash_haar'],
-            "colorhash": image_hashes['colorhash'],
+            **image_hashes.to_document(),
             "image_id": task['image_id'],
             "image_path": task['image_path'],
-            "recognized_text": recognized_text
+            "recognized_text": recognized_text,
+            "term_frequencies": self.image_similarity_service.get_term_frequencies(recognized_text),
+            "ocr_version": self.image_ocr_service.ocr_version,
+            "template": task.get('template')
         })
         self.logger.debug(f"Image inserted into database with ID: {current_image_id}")
         return current_image_id
 
-    def handle_ocr_task(self, task):
+    def generate_image_hashes(self, image_path, prefetched_image=None):
+        """
+            Generate the hashes of an image, from its content if it was loaded ahead.
+
+            Args:
+                image_path (str): Path to the image file.
+                prefetched_image (PrefetchedImage): The image if it was loaded ahead.
+
+            Returns:
+                ImageHashes: The hashes of the image.
+        """
+        if prefetched_image is None:
+            return self.image_hash_service.generate_image_hashes(image_path)
+        return self.image_hash_service.generate_image_hashes(image_path, prefetched_image.xxhash,
+                                                             prefetched_image.data)
+
+    def handle_ocr_task(self, task, prefetched_image=None):
         """
             Handles OCR tasks and saves recognized text to the database.
 
             Args:
                 task (dict): The task dictionary containing details like image path.
+                prefetched_image (PrefetchedImage): The image of the task if it was loaded ahead.
 
             Returns:
                 str: A message indicating the outcome of the operation.
         """
         self.logger.info("Start ocr task")
         image_path = task['image_path']
-        if not os.path.exists(image_path):
+        if prefetched_image is None and not os.path.exists(image_path):
             self.logger.warning(f"No image found at path: {image_path}")
             return 'No image'
         if not any(image_path.lower().endswith(ext) for ext in ALLOWED_IMAGE_EXTENSIONS):
             self.logger.warning(f"Incorrect file extension for image at path: {image_path}")
             return 'Incorrect file extension'
 
-        image_hashes = self.image_hash_service.generate_image_hashes(image_path)
-        message, recognized_text = self.get_recognized_text_or_none(task, image_hashes['xxhash'])
+        image_hashes = self.generate_image_hashes(image_path, prefetched_image)
+        message, recognized_text = self.get_recognized_text_or_none(task, image_hashes.xxhash, prefetched_image)
         if message:
             return message
+        if self.deduplicate_images and self.db_connection.get_images_by_xxhash(image_hashes.xxhash):
+            self.logger.info("Image with the same content already saved")
+            return 'Image already recognized and saved'
         self.insert_image_to_db(task, image_hashes, recognized_text)
         self.logger.info("OCR task completed")
         return 'Recognition completed'
 
-    def handle_compare_task(self, task):
+    def handle_compare_task(self, task, properties=None, prefetched_image=None):
         """
-            Handles image comparison tasks and sends the result to a response queue.
+            Handles image comparison tasks and sends the result to the reply queue of the request.
+
+            Results without similar images are only sent to requesters with their own reply queue. A task with an
+            images list is a batch, compared with one scan and answered with one reply.
 
             Args:
                 task (dict): The task dictionary containing details like image path.
+                properties: Properties of the request message.
+                prefetched_image (PrefetchedImage): The image of the task if it was loaded ahead.
 
             Returns:
                 str: A message indicating the outcome of the operation.
         """
+        if 'images' in task:
+            return self.handle_batch_compare_task(task, properties)
+        message, result_message = self.compare_image(task, prefetched_image)
+        if result_message is None:
+            self.reply(properties, {"image_id": task.get('image_id'), "image_path": task.get('image_path'),
+                                    "status": message}, private_only=True)
+        else:
+            self.reply(properties, result_message, private_only=not result_message['similar_images'])
+        return message
+
+    def compare_image(self, task, prefetched_image=None):
+        """
+            Compare an image against all stored images and save it to the database.
+
+            Results are cached by the image content and the compare settings with the collection generation they
+            were computed at. Repeated compares of the same image skip OCR and the scan, and only score the images
+            saved after that generation.
+
+            Args:
+                task (dict): The task dictionary containing details like image path.
+                prefetched_image (PrefetchedImage): The image of the task if it was loaded ahead.
+
+            Returns:
+                tuple: A message indicating the outcome of the operation and the result message, or None if the
+                image could not be compared.
+        """
         self.logger.info("Start comparison task")
         image_path = task['image_path']
-        if not os.path.exists(image_path):
+        if prefetched_image is None and not os.path.exists(image_path):
             self.logger.warning(f"No image found at path: {image_path}")
-            return 'No image'
+            return 'No image', None
         if not any(image_path.lower().endswith(ext) for ext in ALLOWED_IMAGE_EXTENSIONS):
             self.logger.warning(f"Incorrect file extension for image at path: {image_path}")
-            return 'Incorrect file extension'
+            return 'Incorrect file extension', None
 
-        image_hashes = self.image_hash_service.generate_image_hashes(image_path)
+        image_hashes = self.generate_image_hashes(image_path, prefetched_image)
 
-        message, recognized_text = self.get_recognized_text_or_none(task, image_hashes['xxhash'])
-        if not recognized_text:
-            self.logger.warning(f"Image not recognized: {message}")
-            return message
-
-        recognized_text = self.image_similarity_service.preprocess_text(recognized_text)
-
-        all_images = self.db_connection.get_all_images()
-
-        similar_images_info = []
-        for image in all_images:
-            is_similar, similarity_percentage = self.image_similarity_service.is_similar(recognized_text,
-                                                                                         image.get('recognized_text'))
-            if not is_similar:
-                is_similar, similarity_percentage = self.image_hash_service.is_similar(image_hashes, image)
-            if is_similar:
-                similar_images_info.append({"id": image["_id"], "similarity": similarity_percentage})
+        cache_key = f"{image_hashes.xxhash}:{self.compare_settings_key}"
+        # Read before the cache and the scan, images saved later get a higher sequence
+        generation = self.db_connection.get_generation()
+        cached_result = self.db_connection.get_compare_cache(cache_key) if self.enable_compare_cache else None
+        if cached_result:
+            recognized_text = cached_result['recognized_text']
+            similar_images_info = [SimilarImage.from_document(info) for info in cached_result['similar_images']]
+            is_result_changed = cached_result['generation'] != generation
+            if is_result_changed:
+                similar_images_info = self.merge_new_similar_images(image_hashes, recognized_text,
+                                                                    similar_images_info, cached_result['generation'])
+            else:
+                self.logger.info("Using cached comparison result")
+        else:
+            message, recognized_text = self.get_recognized_text_or_none(task, image_hashes.xxhash, prefetched_image)
+            if not recognized_text:
+                self.logger.warning(f"Image not recognized: {message}")
+                return message, None
 
-        similar_images_data = self.db_connection.get_images_by_ids([info['id'] for info in similar_images_info])
+            recognized_text = self.image_similarity_service.preprocess_text(recognized_text)
+            similar_images_info = self.find_similar_stored_images(
+                [image_hashes], [recognized_text],
+                [self.image_similarity_service.get_term_frequencies(recognized_text)])[0]
+            is_result_changed = True
 
         # Use a map for id to similarity linking to prevent any mix-up
-        similarity_map = {info['id']: info['similarity'] for info in similar_images_info}
-        for image in similar_images_data:
-            image['similarity'] = similarity_map[image["_id"]]
+        similarity_map = {info.id: info.similarity for info in similar_images_info}
+        similar_images_data = self.db_connection.get_images_by_ids(list(similarity_map))
 
-        current_image_id = self.insert_image_to_db(task, image_hashes, recognized_text)
-
-        if not similar_images_info:
-            self.logger.info("No similar images found.")
-            return 'Comparison completed'
+        # Identical content is always similar, so its stored copies are among the similar images
+        cached_similar_images_info = similar_images_info
+        if self.deduplicate_images and any(image.xxhash == image_hashes.xxhash for image in similar_images_data):
+            self.logger.info("Image with the same content already saved, not saving a duplicate")
+        else:
+            current_image_id = self.insert_image_to_db(task, image_hashes, recognized_text)
+            if similar_images_info:
+                self.db_connection.insert_similar_images(current_image_id, list(similarity_map))
+            else:
+                self.logger.info("No similar images found.")
+            # Later compares of the same content find the new image as well
+            cached_similar_images_info = similar_images_info + [SimilarImage(current_image_id, 100.0)]
+            is_result_changed = True
 
-        self.db_connection.insert_similar_images(current_image_id, [info['id'] for info in similar_images_info])
+        if self.enable_compare_cache and is_result_changed and generation is not None:
+            self.db_connection.save_compare_cache({
+                "_id": cache_key,
+                "xxhash": image_hashes.xxhash,
+                "settings": self.compare_settings_key,
+                "generation": generation,
+                "recognized_text": recognized_text,
+                "similar_images": [info.to_document() for info in cached_similar_images_info]
+            })
 
         similar_images = []
         for image in similar_images_data:
             similar_images.append({
-                "image_id": image.get('image_id'),
-                "image_path": image.get('image_path'),
-                "similarity": image.get('similarity'),
-                "recognized_text": image.get('recognized_text')
+                "image_id": image.image_id,
+                "image_path": image.image_path,
+                "similarity": similarity_map[image.id],
+                "recognized_text": image.recognized_text
             })
 
         result_message = {
@@ -298,6 +787,299 @@ class ImageService(EnvironmentManager):
             "recognized_text": recognized_text,
             "similar_images": similar_images
         }
-        self.messaging_connection.send_message(RESPONSE_QUEUE, result_message)
         self.logger.info(f"Comparison task completed successfully. Founded {len(similar_images_info)} similar images")
-        return 'Comparison completed'
+        return 'Comparison completed', result_message
+
+    def find_similar_images(self, image_hashes, recognized_text, images):
+        """
+            Score an image against stored images.
+
+            Args:
+                image_hashes (ImageHashes): The hashes of the image.
+                recognized_text (str): The preprocessed text recognized from the image.
+                images (list[StoredImage]): Stored images to compare with.
+
+            Returns:
+                list[SimilarImage]: IDs and similarities of the similar images.
+        """
+        return self.find_similar_images_batch(
+            [image_hashes], [recognized_text], [self.image_similarity_service.get_term_frequencies(recognized_text)],
+            images, self.get_stored_term_frequencies(images))[0]
+
+    def find_similar_images_batch(self, target_hashes_list, target_texts, target_frequencies, images, frequencies):
+        """
+            Score a batch of images against stored images in one matrix pass.
+
+            Texts are scored as a targets x images matrix. Pairs below the text threshold are compared by their
+            hashes in matrix form, and is_similar only runs on the similar pairs to get their similarity value.
+
+            Args:
+                target_hashes_list (list[ImageHashes]): The hashes of the images.
+                target_texts (list[str]): The preprocessed texts recognized from the images.
+                target_frequencies (list[dict]): Term frequencies of the texts.
+                images (list[StoredImage]): Stored images to compare with.
+                frequencies (list[dict]): Term frequencies of the stored images.
+
+            Returns:
+                list[list[SimilarImage]]: IDs and similarities of the similar images of every image.
+        """
+        similar_images_info = [[] for _ in target_texts]
+        if not images:
+            return similar_images_info
+        text_similarities = self.image_similarity_service.score_texts_batch(
+            target_texts, target_frequencies, [image.recognized_text for image in images], frequencies)
+        is_text_similar = text_similarities >= self.image_similarity_service.similarity_percentage
+        is_hash_similar = ~is_text_similar & self.image_hash_service.find_similar_hashes(target_hashes_list, images)
+
+        for row, column in zip(*np.nonzero(is_text_similar | is_hash_similar)):
+            if is_text_similar[row, column]:
+                similarity_percentage = float(text_similarities[row, column])
+            else:
+                _, similarity_percentage = self.image_hash_service.is_similar(target_hashes_list[row], images[column])
+            similar_images_info[row].append(SimilarImage(images[column].id, similarity_percentage))
+        return similar_images_info
+
+    def find_similar_stored_images(self, target_hashes_list, target_texts, target_frequencies):
+        """
+            Score a batch of images against all stored images without loading them all as documents.
+
+            With the image columns cache the columns are refreshed and scored in chunks, otherwise the collection is
+            streamed in batches of documents. Either way memory holds one chunk of scoring temporaries at a time.
+
+            Args:
+                target_hashes_list (list[ImageHashes]): The hashes of the images.
+                target_texts (list[str]): The preprocessed texts recognized from the images.
+                target_frequencies (list[dict]): Term frequencies of the texts.
+
+            Returns:
+                list[list[SimilarImage]]: IDs and similarities of the similar images of every image.
+        """
+        if self.image_columns_cache is not None:
+            return self.find_similar_cached_images(target_hashes_list, target_texts, target_frequencies)
+
+        similar_images_info = [[] for _ in target_texts]
+        for images in self.db_connection.iterate_images(COMPARE_PROJECTION, self.compare_stream_batch_size):
+            batch_similar_images_info = self.find_similar_images_batch(
+                target_hashes_list, target_texts, target_frequencies, images, self.get_stored_term_frequencies(images))
+            for image_similar_images_info, batch_info in zip(similar_images_info, batch_similar_images_info):
+                image_similar_images_info.extend(batch_info)
+        return similar_images_info
+
+    def find_similar_cached_images(self, target_hashes_list, target_texts, target_frequencies):
+        """
+            Score a batch of images against the image columns cache, like find_similar_images_batch.
+
+            Args:
+                target_hashes_list (list[ImageHashes]): The hashes of the images.
+                target_texts (list[str]): The preprocessed texts recognized from the images.
+                target_frequencies (list[dict]): Term frequencies of the texts.
+
+            Returns:
+                list[list[SimilarImage]]: IDs and similarities of the similar images of every image.
+        """
+        pending_images = self.image_columns_cache.refresh(self.compare_stream_batch_size)
+        similar_images_info = self.find_similar_images_batch(
+            target_hashes_list, target_texts, target_frequencies, pending_images,
+            self.get_stored_term_frequencies(pending_images))
+
+        metric = self.image_similarity_service.text_similarity_metric
+        threshold = self.image_similarity_service.similarity_percentage
+        targets = self.image_columns_cache.get_term_matrix(target_frequencies)
+        target_hash_arrays = self.image_hash_service.get_hash_arrays(target_hashes_list,
+                                                                    self.image_hash_service.hash_types)
+        hash_similar_pairs = []
+        for start, image_ids, hash_arrays, term_counts, texts in self.image_columns_cache.iterate_chunks(
+                self.compare_stream_batch_size, targets.shape[1]):
+            text_similarities = metric.score_matrix(target_texts, targets, texts, term_counts, score_cutoff=threshold)
+            # Rows of images whose compare fields were recomputed are removed, their new rows are scored instead
+            is_live = image_ids != b''
+            is_text_similar = (text_similarities >= threshold) & is_live
+            is_hash_similar = ~is_text_similar & is_live & self.image_hash_service.find_similar_hash_arrays(
+                target_hash_arrays, hash_arrays)
+            for row, column in zip(*np.nonzero(is_text_similar)):
+                similar_images_info[row].append(SimilarImage(image_ids[column].decode(),
+                                                              float(text_similarities[row, column])))
+            hash_similar_pairs.extend((row, image_ids[column].decode()) for row, column in
+                                      zip(*np.nonzero(is_hash_similar)))
+
+        # The similarity value of hash matches is the label of is_similar, which needs the stored hashes
+        if hash_similar_pairs:
+            images = {image.id: image for image in self.db_connection.get_images_by_ids(
+                list({image_id for _, image_id in hash_similar_pairs}))}
+            for row, image_id in hash_similar_pairs:
+                if image_id in images:
+                    _, similarity_percentage = self.image_hash_service.is_similar(target_hashes_list[row],
+                                                                                  images[image_id])
+                    similar_images_info[row].append(SimilarImage(image_id, similarity_percentage))
+        return similar_images_info
+
+    def get_stored_term_frequencies(self, images):
+        """
+            Get the term frequencies of stored images.
+
+            Images stored before term frequencies were saved with the image are tokenized once and saved.
+
+            Args:
+                images (list[StoredImage]): Stored images.
+
+            Returns:
+                list[dict]: Term frequencies of every image.
+        """
+        missing_term_frequencies = {}
+        all_term_frequencies = []
+        for image in images:
+            image_term_frequencies = image.term_frequencies
+            if image_term_frequencies is None:
+                image_term_frequencies = self.image_similarity_service.get_term_frequencies(image.recognized_text)
+                missing_term_frequencies[image.id] = image_term_frequencies
+            all_term_frequencies.append(image_term_frequencies)
+
+        if missing_term_frequencies:
+            self.db_connection.update_term_frequencies(missing_term_frequencies)
+        return all_term_frequencies
+
+    def merge_new_similar_images(self, image_hashes, recognized_text, similar_images_info, generation):
+        """
+            Score the images saved after a cached result and merge the similar ones into it.
+
+            Args:
+                image_hashes (ImageHashes): The hashes of the image.
+                recognized_text (str): The preprocessed text recognized from the image.
+                similar_images_info (list[SimilarImage]): IDs and similarities of the cached similar images.
+                generation (int): Collection generation of the cached result.
+
+            Returns:
+                list[SimilarImage]: IDs and similarities of the cached and the new similar images.
+        """
+        new_images = self.db_connection.get_images_since(generation)
+        # Images whose compare fields were recomputed since are scored again
+        updated_image_ids = {image.id for image in new_images if image.updated}
+        similar_images_info = [info for info in similar_images_info if info.id not in updated_image_ids]
+        known_image_ids = {info.id for info in similar_images_info}
+        new_similar_images_info = [info for info in self.find_similar_images(image_hashes, recognized_text, new_images)
+                                   if info.id not in known_image_ids]
+        self.logger.info(f"Using cached comparison result, {len(new_images)} images saved or updated since, "
+                         f"{len(new_similar_images_info)} of them similar")
+        return similar_images_info + new_similar_images_info
+
+    def handle_batch_compare_task(self, task, properties=None):
+        """
+            Handles batch comparison tasks and sends the results of all images in one reply.
+
+            Args:
+                task (dict): The task dictionary with an images list of image tasks and an optional batch_id.
+                properties: Properties of the request message.
+
+            Returns:
+                str: A message indicating the outcome of the operation.
+        """
+        message, results = self.compare_images_batch(task['images'])
+        self.reply(properties, {"batch_id": task.get('batch_id'), "status": message, "results": results},
+                   private_only=not any(result.get('similar_images') for result in results))
+        return message
+
+    def compare_images_batch(self, tasks):
+        """
+            Compare a batch of images against all stored images and each other, and save them to the database.
+
+            The images are hashed in a thread pool while the OCR of the earlier images runs, the OCR models are
+            not shared between threads. The batch is then scored against one scan of the collection in a matrix
+            pass. Images of the batch are similar images of each other like stored images are.
+
+            Args:
+                tasks (list[dict]): Image tasks with image path and id.
+
+            Returns:
+                tuple: A message indicating the outcome of the operation and the result of every image, a result
+                message like compare_image returns or the status of images that could not be compared.
+        """
+        self.logger.info(f"Start batch comparison task of {len(tasks)} images")
+        results = [None] * len(tasks)
+        valid_indexes = []
+        for index, task in enumerate(tasks):
+            image_path = task['image_path']
+            if not os.path.exists(image_path):
+                self.logger.warning(f"No image found at path: {image_path}")
+                results[index] = {"image_id": task.get('image_id'), "image_path": image_path, "status": 'No image'}
+            elif not any(image_path.lower().endswith(ext) for ext in ALLOWED_IMAGE_EXTENSIONS):
+                self.logger.warning(f"Incorrect file extension for image at path: {image_path}")
+                results[index] = {"image_id": task.get('image_id'), "image_path": image_path,
+                                  "status": 'Incorrect file extension'}
+            else:
+                valid_indexes.append(index)
+
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.batch_hash_workers) as executor:
+            hash_futures = [executor.submit(self.image_hash_service.generate_image_hashes, tasks[index]['image_path'])
+                            for index in valid_indexes]
+            for index, hash_future in zip(valid_indexes, hash_futures):
+                image_hashes = hash_future.result()
+                message, recognized_text = self.get_recognized_text_or_none(tasks[index], image_hashes.xxhash)
+                if not recognized_text:
+                    self.logger.warning(f"Image not recognized: {message}")
+                    results[index] = {"image_id": tasks[index].get('image_id'),
+                                      "image_path": tasks[index]['image_path'], "status": message}
+                    continue
+                batch.append((index, image_hashes, self.image_similarity_service.preprocess_text(recognized_text)))
+        if not batch:
+            return 'No images compared', results
+
+        batch_hashes = [image_hashes for _, image_hashes, _ in batch]
+        batch_texts = [recognized_text for _, _, recognized_text in batch]
+        batch_term_frequencies = [self.image_similarity_service.get_term_frequencies(text) for text in batch_texts]
+
+        stored_similar_images_info = self.find_similar_stored_images(batch_hashes, batch_texts, batch_term_frequencies)
+        # Batch positions stand in for the IDs of the batch images, which are only known once they are saved
+        batch_images = [StoredImage(position, recognized_text=recognized_text, **image_hashes.to_document())
+                        for position, (_, image_hashes, recognized_text) in enumerate(batch)]
+        batch_similar_images_info = self.find_similar_images_batch(
+            batch_hashes, batch_texts, batch_term_frequencies, batch_images, batch_term_frequencies)
+
+        stored_images = {image.id: image for image in self.db_connection.get_images_by_ids(
+            list({info.id for infos in stored_similar_images_info for info in infos}))}
+
+        # Save the batch images, identical content is saved once if duplicates are not saved
+        image_ids = []
+        saved_xxhashes = set()
+        for position, (index, image_hashes, recognized_text) in enumerate(batch):
+            if self.deduplicate_images and (image_hashes.xxhash in saved_xxhashes or any(
+                    stored_images[info.id].xxhash == image_hashes.xxhash
+                    for info in stored_similar_images_info[position] if info.id in stored_images)):
+                self.logger.info("Image with the same content already saved, not saving a duplicate")
+                image_ids.append(None)
+                continue
+            image_ids.append(self.insert_image_to_db(tasks[index], image_hashes, recognized_text))
+            saved_xxhashes.add(image_hashes.xxhash)
+
+        similar_images_count = 0
+        for position, (index, _, recognized_text) in enumerate(batch):
+            similar_images = []
+            for info in stored_similar_images_info[position]:
+                image = stored_images.get(info.id)
+                if image is not None:
+                    similar_images.append({"id": info.id, "image_id": image.image_id,
+                                           "image_path": image.image_path, "similarity": info.similarity,
+                                           "recognized_text": image.recognized_text})
+            for info in batch_similar_images_info[position]:
+                other_position = info.id
+                if other_position != position:
+                    other_task = tasks[batch[other_position][0]]
+                    similar_images.append({"id": image_ids[other_position], "image_id": other_task.get('image_id'),
+                                           "image_path": other_task['image_path'],
+                                           "similarity": info.similarity,
+                                           "recognized_text": batch[other_position][2]})
+
+            similar_image_ids = [image.pop('id') for image in similar_images]
+            similar_image_ids = [image_id for image_id in similar_image_ids if image_id is not None]
+            if image_ids[position] is not None and similar_image_ids:
+                self.db_connection.insert_similar_images(image_ids[position], similar_image_ids)
+            similar_images_count += len(similar_images)
+            results[index] = {
+                "image_id": tasks[index]['image_id'],
+                "image_path": tasks[index]['image_path'],
+                "recognized_text": recognized_text,
+                "similar_images": similar_images
+            }
+        self.logger.info(f"Batch comparison task completed successfully. Compared {len(batch)} images, "
+                         f"founded {similar_images_count} similar images")
+        return 'Comparison completed', results
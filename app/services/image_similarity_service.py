@@ -1,9 +1,21 @@
 import re
 import logging
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from collections import Counter
 
 from app.config.environment_manager import EnvironmentManager
+from app.services.text_similarity_metrics import calculate_bow_tfidf_similarities, get_text_similarity_metric
+
+# Characters removed by preprocess_text
+PREPROCESS_TEXT_PATTERN = re.compile(r'[^a-z0-9 ]')
+
+# Replacement rules for uppercase
+REPLACE_RULES_UPPER = str.maketrans('TDCLUEZOBSY', '70GIVF20857')
+
+# Replacement rules for lowercase
+REPLACE_RULES_LOWER = str.maketrans('ucibogqzsy', 've16099257')
+
+# Default tokenization of sklearn CountVectorizer and TfidfVectorizer
+TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b')
 
 
 class ImageSimilarityService(EnvironmentManager):
@@ -15,12 +27,18 @@ class ImageSimilarityService(EnvironmentManager):
         """
             Initialize the ImageSimilarityService.
         """
-        super().__init__(['SIMILARITY_PERCENTAGE', 'ENABLE_PREPROCESS_TEXT'])
+        super().__init__(['SIMILARITY_PERCENTAGE', 'ENABLE_PREPROCESS_TEXT'], {
+            'TEXT_SIMILARITY_METRIC': 'bow_tfidf',
+            'TEXT_SIMILARITY_WORKERS': '-1'
+        })
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing Image Similarity service...')
         self.similarity_percentage = float(self.env_vars['SIMILARITY_PERCENTAGE'])
         self.enable_preprocess_text = self.env_vars['ENABLE_PREPROCESS_TEXT'].lower() == "true"
+        self.text_similarity_metric = get_text_similarity_metric(self.env_vars['TEXT_SIMILARITY_METRIC'],
+                                                                 int(self.env_vars['TEXT_SIMILARITY_WORKERS']))
+        self.logger.info(f'Text similarity metric: {self.text_similarity_metric.name}')
 
     def preprocess_text(self, text):
         """
@@ -36,36 +54,51 @@ class ImageSimilarityService(EnvironmentManager):
             return text
 
         # Retain only letters, numbers, and spaces
-        text = re.sub(r'[^a-z0-9 ]', '', text)
-
-        # Replacement rules for uppercase
-        replace_rules_upper = str.maketrans('TDCLUEZOBSY', '70GIVF20857')
-
-        # Replacement rules for lowercase
-        replace_rules_lower = str.maketrans('ucibogqzsy', 've16099257')
+        text = PREPROCESS_TEXT_PATTERN.sub('', text)
 
         # Convert to uppercase and apply the first replacement rule
-        text = text.upper().translate(replace_rules_upper)
+        text = text.upper().translate(REPLACE_RULES_UPPER)
 
         # Convert to lowercase and apply the second replacement rule
-        text = text.lower().translate(replace_rules_lower)
+        text = text.lower().translate(REPLACE_RULES_LOWER)
 
         self.logger.debug("Text preprocessing completed")
         return text
 
     @staticmethod
-    def calculate_cosine_similarity(vec1, vec2):
+    def get_term_frequencies(text):
+        """
+            Tokenize text once into term frequencies.
+
+            Tokenization matches the default of sklearn CountVectorizer: lowercase words of two or more characters.
+            The result is stored with each image so that stored texts are never tokenized again.
+
+            Parameters:
+                text (str): Text string.
+
+            Returns:
+                dict: Terms mapped to their counts.
+        """
+        if not text:
+            return {}
+        return dict(Counter(TOKEN_PATTERN.findall(text.lower())))
+
+    @staticmethod
+    def calculate_similarities(frequencies1, frequencies2):
         """
-            Calculate cosine similarity between two vectors.
+            Calculate Bag-of-Words (BoW) and TF-IDF cosine similarities of two term frequency vectors.
+
+            The TF-IDF weights are those of a TfidfVectorizer fitted on just the two documents: smoothed IDF is 1 for
+            terms found in both documents and ln(1.5) + 1 for the others, followed by L2 normalization.
 
             Parameters:
-                vec1 (array-like): First vector.
-                vec2 (array-like): Second vector.
+                frequencies1 (dict): Term frequencies of the first text.
+                frequencies2 (dict): Term frequencies of the second text.
 
             Returns:
-                float: Cosine similarity value.
+                tuple: BoW similarity and TF-IDF similarity values.
         """
-        return cosine_similarity(vec1, vec2)[0][0]
+        return calculate_bow_tfidf_similarities(frequencies1, frequencies2)
 
     def calculate_bow_similarity(self, text1, text2):
         """
@@ -78,15 +111,7 @@ class ImageSimilarityService(EnvironmentManager):
             Returns:
                 float: BoW similarity value.
         """
-        if not text1 or not text2:
-            return 0
-        try:
-            vectorizer = CountVectorizer().fit_transform([text1, text2])
-            vectors = vectorizer.toarray()
-            return self.calculate_cosine_similarity(vectors[0].reshape(1, -1), vectors[1].reshape(1, -1))
-        except Exception as e:
-            self.logger.exception("Exception occurred in calculate_bow_similarity", exc_info=e)
-            return 0
+        return self.calculate_similarities(self.get_term_frequencies(text1), self.get_term_frequencies(text2))[0]
 
     def calculate_tfidf_similarity(self, text1, text2):
         """
@@ -99,16 +124,28 @@ class ImageSimilarityService(EnvironmentManager):
             Returns:
                 float: TF-IDF similarity value.
         """
-        if not text1 or not text2:
-            return 0
-        try:
-            vectorizer = TfidfVectorizer().fit_transform([text1, text2])
-            vectors = vectorizer.toarray()
-            return self.calculate_cosine_similarity(vectors[0].reshape(1, -1), vectors[1].reshape(1, -1))
-        except Exception as e:
-            self.logger.exception("Exception occurred in calculate_tfidf_similarity", exc_info=e)
+        return self.calculate_similarities(self.get_term_frequencies(text1), self.get_term_frequencies(text2))[1]
+
+    def compare_term_frequencies(self, target_frequencies, frequencies_to_compare):
+        """
+            Compare two precomputed term frequency vectors using both BoW and TF-IDF.
+
+            Parameters:
+                target_frequencies (dict): Term frequencies of the target text.
+                frequencies_to_compare (dict): Term frequencies of the text to compare against target.
+
+            Returns:
+                float: Averaged similarity value.
+        """
+        if not target_frequencies or not frequencies_to_compare:
+            self.logger.debug("One or both texts are empty, skipping comparison")
             return 0
 
+        bow_similarity, tfidf_similarity = self.calculate_similarities(target_frequencies, frequencies_to_compare)
+
+        self.logger.debug(f"Similarity scores calculated: BOW={bow_similarity}, TFIDF={tfidf_similarity}")
+        return (bow_similarity + tfidf_similarity) / 2 * 100
+
     def compare_texts(self, target, text_to_compare):
         """
             Compare two text strings using both BoW and TF-IDF.
@@ -124,11 +161,22 @@ class ImageSimilarityService(EnvironmentManager):
             self.logger.warning("One or both texts are empty, skipping comparison")
             return 0
 
-        bow_similarity = self.calculate_bow_similarity(target, text_to_compare)
-        tfidf_similarity = self.calculate_tfidf_similarity(target, text_to_compare)
+        return self.compare_term_frequencies(self.get_term_frequencies(target),
+                                             self.get_term_frequencies(text_to_compare))
 
-        self.logger.debug(f"Similarity scores calculated: BOW={bow_similarity}, TFIDF={tfidf_similarity}")
-        return (bow_similarity + tfidf_similarity) / 2 * 100
+    def is_similar_term_frequencies(self, target_frequencies, frequencies_to_compare):
+        """
+            Determine if two precomputed term frequency vectors are similar based on a predefined threshold.
+
+            Parameters:
+                target_frequencies (dict): Term frequencies of the target text.
+                frequencies_to_compare (dict): Term frequencies of the text to compare.
+
+            Returns:
+                tuple: (True if similar, False otherwise, similarity value).
+        """
+        result = self.compare_term_frequencies(target_frequencies, frequencies_to_compare)
+        return (True, result) if result >= self.similarity_percentage else (False, result)
 
     def is_similar(self, target_text, text_to_compare):
         """
@@ -144,3 +192,38 @@ class ImageSimilarityService(EnvironmentManager):
         result = self.compare_texts(target_text, text_to_compare)
         self.logger.debug(f"Calculated similarity score: {result}, Threshold: {self.similarity_percentage}")
         return (True, result) if result >= self.similarity_percentage else (False, result)
+
+    def score_texts(self, target_text, target_frequencies, texts, frequencies):
+        """
+            Score a target text against many stored texts with the configured text similarity metric.
+
+            Parameters:
+                target_text (str): Target text string.
+                target_frequencies (dict): Term frequencies of the target text.
+                texts (list[str]): Stored text strings.
+                frequencies (list[dict]): Term frequencies of the stored texts.
+
+            Returns:
+                list[float]: Similarity value for every stored text. Values below the threshold may be reported as 0.
+        """
+        if not texts:
+            return []
+        return self.text_similarity_metric.score_many(target_text, target_frequencies, texts, frequencies,
+                                                      score_cutoff=self.similarity_percentage)
+
+    def score_texts_batch(self, target_texts, target_frequencies, texts, frequencies):
+        """
+            Score several target texts against many stored texts with the configured text similarity metric.
+
+            Parameters:
+                target_texts (list[str]): Target text strings.
+                target_frequencies (list[dict]): Term frequencies of the target texts.
+                texts (list[str]): Stored text strings.
+                frequencies (list[dict]): Term frequencies of the stored texts.
+
+            Returns:
+                ndarray: Similarity values shaped targets x stored texts. Values below the threshold may be reported
+                as 0.
+        """
+        return self.text_similarity_metric.score_batch(target_texts, target_frequencies, texts, frequencies,
+                                                       score_cutoff=self.similarity_percentage)
@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+
+import xxhash
+from paddleocr import PaddleOCR
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+# Model directories under the models dir, by OCR stage
+MODEL_DIRS = {
+    'det': 'en_PP-OCRv3_det_infer',
+    'rec': 'en_PP-OCRv3_rec_infer',
+    'cls': 'ch_ppocr_mobile_v2.0_cls_infer',
+}
+
+
+class OCRBackend:
+    """
+        Base class for OCR inference backends.
+
+        A backend runs the three OCR stages: text detection, angle classification of the detected text lines and
+        text recognition.
+    """
+    name = None
+
+    def detect(self, image):
+        """
+            Detect text lines.
+
+            Args:
+                image: Image data.
+
+            Returns:
+                list: Boxes of the detected text lines as 4x2 point arrays.
+        """
+        raise NotImplementedError
+
+    def classify(self, crops):
+        """
+            Classify the orientation of text line crops.
+
+            Args:
+                crops (list): Image data of text lines.
+
+            Returns:
+                list[str]: Angle label of every crop, '0' or '180'.
+        """
+        raise NotImplementedError
+
+    def recognize(self, image, cls=True):
+        """
+            Detect, optionally classify, and recognize the text lines of an image.
+
+            Args:
+                image: Image data.
+                cls (bool): Run the angle classifier on the text lines.
+
+            Returns:
+                tuple: Recognized texts in reading order and the det, cls and rec stage times in seconds.
+        """
+        raise NotImplementedError
+
+
+class PaddleBackend(OCRBackend):
+    """
+        PaddleOCR on the Paddle Inference engine.
+
+        Paddle only applies the thread count together with MKLDNN, so cpu_threads has no effect without it.
+    """
+    name = 'paddle'
+
+    def __init__(self, models_dir, use_angle_cls=True, enable_mkldnn=False, cpu_threads=10):
+        """
+            Load the Paddle inference models.
+
+            Args:
+                models_dir (str): Directory with the Paddle inference model directories.
+                use_angle_cls (bool): Load the angle classifier.
+                enable_mkldnn (bool): Run on oneDNN (MKLDNN) kernels.
+                cpu_threads (int): Number of threads of every model.
+        """
+        self.infer = PaddleOCR(use_angle_cls=use_angle_cls, lang='en', show_log=False,
+                               enable_mkldnn=enable_mkldnn, cpu_threads=cpu_threads,
+                               **self.get_model_paths(models_dir))
+
+    @staticmethod
+    def get_model_paths(models_dir):
+        """
+            Get the PaddleOCR arguments of the model paths.
+
+            Args:
+                models_dir (str): Directory with the Paddle inference model directories.
+
+            Returns:
+                dict: det_model_dir, rec_model_dir and cls_model_dir arguments.
+        """
+        return {f'{stage}_model_dir': os.path.join(models_dir, model_dir) for stage, model_dir in MODEL_DIRS.items()}
+
+    def detect(self, image):
+        dt_boxes, _ = self.infer.text_detector(image)
+        return [] if dt_boxes is None else list(dt_boxes)
+
+    def classify(self, crops):
+        _, cls_res, _ = self.infer.text_classifier(crops)
+        return [label for label, score in cls_res]
+
+    def recognize(self, image, cls=True):
+        dt_boxes, rec_res, time_dict = self.infer(image, cls)
+        return [text for text, score in rec_res or []], time_dict
+
+
+class OnnxBackend(PaddleBackend):
+    """
+        PaddleOCR pre- and postprocessing on ONNX Runtime sessions.
+
+        The ONNX models are the Paddle models converted with export_onnx_models, optionally with int8 weights.
+    """
+    name = 'onnx'
+
+    def __init__(self, onnx_models_dir, use_angle_cls=True, quantized=False, cpu_threads=0):
+        """
+            Load the ONNX models.
+
+            Args:
+                onnx_models_dir (str): Directory with the det, rec and cls ONNX models.
+                use_angle_cls (bool): Load the angle classifier.
+                quantized (bool): Load the int8 quantized models.
+                cpu_threads (int): Intra-op threads of every session, 0 lets ONNX Runtime decide.
+        """
+        if onnxruntime is None:
+            raise ImportError('onnxruntime is required for the onnx OCR backend')
+        model_paths = {stage: get_onnx_model_path(onnx_models_dir, stage, quantized) for stage in MODEL_DIRS}
+        for model_path in model_paths.values():
+            if not os.path.exists(model_path):
+                raise FileNotFoundError(f'ONNX model not found: {model_path}, convert the models with '
+                                        f'export_onnx_models first')
+        self.infer = PaddleOCR(use_angle_cls=use_angle_cls, lang='en', show_log=False, use_onnx=True,
+                               **{f'{stage}_model_dir': model_path for stage, model_path in model_paths.items()})
+
+        # PaddleOCR creates the sessions with default options, recreate them with the configured thread count
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = cpu_threads
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        predictors = {'det': self.infer.text_detector, 'rec': self.infer.text_recognizer}
+        if use_angle_cls:
+            predictors['cls'] = self.infer.text_classifier
+        for stage, predictor in predictors.items():
+            predictor.predictor = onnxruntime.InferenceSession(model_paths[stage], session_options,
+                                                               providers=['CPUExecutionProvider'])
+            predictor.input_tensor = predictor.predictor.get_inputs()[0]
+
+
+OCR_BACKENDS = {backend.name: backend for backend in (PaddleBackend, OnnxBackend)}
+
+
+def get_onnx_model_path(onnx_models_dir, stage, quantized=False):
+    """
+        Get the path of the ONNX model of an OCR stage.
+
+        Args:
+            onnx_models_dir (str): Directory with the ONNX models.
+            stage (str): 'det', 'rec' or 'cls'.
+            quantized (bool): Path of the int8 quantized model.
+
+        Returns:
+            str: Path of the model file.
+    """
+    return os.path.join(onnx_models_dir, f'{MODEL_DIRS[stage]}{".int8" if quantized else ""}.onnx')
+
+
+def export_onnx_models(models_dir, onnx_models_dir, quantize=True, opset_version=11):
+    """
+        Convert the Paddle inference models to ONNX with paddle2onnx, optionally with int8 weights.
+
+        Requires the paddle2onnx package. Weights are quantized dynamically, activations stay float, so no
+        calibration images are needed.
+
+        Args:
+            models_dir (str): Directory with the Paddle inference model directories.
+            onnx_models_dir (str): Directory the ONNX models are written to.
+            quantize (bool): Also write int8 quantized models.
+            opset_version (int): ONNX opset version.
+    """
+    logger = logging.getLogger(__name__)
+    os.makedirs(onnx_models_dir, exist_ok=True)
+    for stage, model_dir in MODEL_DIRS.items():
+        onnx_model_path = get_onnx_model_path(onnx_models_dir, stage)
+        logger.info(f'Converting {model_dir} to {onnx_model_path}')
+        subprocess.run([sys.executable, '-m', 'paddle2onnx.command',
+                        '--model_dir', os.path.join(models_dir, model_dir),
+                        '--model_filename', 'inference.pdmodel', '--params_filename', 'inference.pdiparams',
+                        '--save_file', onnx_model_path, '--opset_version', str(opset_version),
+                        '--enable_onnx_checker', 'True'], check=True)
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+            quantized_model_path = get_onnx_model_path(onnx_models_dir, stage, quantized=True)
+            logger.info(f'Quantizing {onnx_model_path} to {quantized_model_path}')
+            quantize_dynamic(onnx_model_path, quantized_model_path, weight_type=QuantType.QUInt8)
+
+
+def get_models_version(models_dir, quantized=False):
+    """
+        Fingerprint of the OCR models, it changes when a model directory or the content of a model file changes.
+
+        The ONNX models are converted from the Paddle models, so both backends have the version of the Paddle models,
+        with a different version for the int8 quantized models.
+
+        Args:
+            models_dir (str): Directory with the Paddle inference model directories.
+            quantized (bool): Whether the int8 quantized ONNX models are used.
+
+        Returns:
+            str: Hex hash of the model files.
+    """
+    hasher = xxhash.xxh3_64()
+    hasher.update(json.dumps({'models': MODEL_DIRS, 'quantized': quantized}, sort_keys=True).encode())
+    for stage, model_dir in sorted(MODEL_DIRS.items()):
+        model_path = os.path.join(models_dir, model_dir)
+        if not os.path.isdir(model_path):
+            continue
+        for file_name in sorted(os.listdir(model_path)):
+            file_path = os.path.join(model_path, file_name)
+            if not os.path.isfile(file_path):
+                continue
+            hasher.update(f'{stage}/{file_name}'.encode())
+            with open(file_path, 'rb') as model_file:
+                hasher.update(model_file.read())
+    return hasher.hexdigest()
+
+
+def create_ocr_backend(name, models_dir, onnx_models_dir, use_angle_cls=True, enable_mkldnn=False, cpu_threads=10,
+                       quantized=False):
+    """
+        Create an OCR backend by name.
+
+        Args:
+            name (str): 'paddle' or 'onnx'.
+            models_dir (str): Directory with the Paddle inference model directories.
+            onnx_models_dir (str): Directory with the ONNX models.
+            use_angle_cls (bool): Load the angle classifier.
+            enable_mkldnn (bool): Run the Paddle backend on MKLDNN kernels.
+            cpu_threads (int): Number of threads of every model.
+            quantized (bool): Use the int8 ONNX models.
+
+        Returns:
+            OCRBackend: The backend.
+    """
+    if name == PaddleBackend.name:
+        return PaddleBackend(models_dir, use_angle_cls, enable_mkldnn, cpu_threads)
+    if name == OnnxBackend.name:
+        return OnnxBackend(onnx_models_dir, use_angle_cls, quantized, cpu_threads)
+    raise ValueError(f'Unknown OCR backend: {name}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    export_onnx_models('model', os.path.join('model', 'onnx'))
@@ -0,0 +1,385 @@
+import math
+
+import numpy as np
+from rapidfuzz import fuzz, process
+from scipy.sparse import csr_matrix
+from rapidfuzz.distance import Levenshtein
+
+# Smoothed IDF of a term found in only one of two documents: ln((1 + 2) / (1 + 1)) + 1
+SINGLE_DOCUMENT_IDF = math.log(1.5) + 1
+
+
+def calculate_bow_tfidf_similarities(frequencies1, frequencies2):
+    """
+        Calculate Bag-of-Words (BoW) and TF-IDF cosine similarities of two term frequency vectors.
+
+        The TF-IDF weights are those of a TfidfVectorizer fitted on just the two documents: smoothed IDF is 1 for
+        terms found in both documents and ln(1.5) + 1 for the others, followed by L2 normalization.
+
+        Parameters:
+            frequencies1 (dict): Term frequencies of the first text.
+            frequencies2 (dict): Term frequencies of the second text.
+
+        Returns:
+            tuple: BoW similarity and TF-IDF similarity values.
+    """
+    if not frequencies1 or not frequencies2:
+        return 0, 0
+    if len(frequencies1) > len(frequencies2):
+        frequencies1, frequencies2 = frequencies2, frequencies1
+
+    dot = shared_squares1 = shared_squares2 = 0
+    for term, count1 in frequencies1.items():
+        count2 = frequencies2.get(term)
+        if count2:
+            dot += count1 * count2
+            shared_squares1 += count1 * count1
+            shared_squares2 += count2 * count2
+    if not dot:
+        return 0, 0
+
+    squares1 = sum(count * count for count in frequencies1.values())
+    squares2 = sum(count * count for count in frequencies2.values())
+    bow_similarity = dot / math.sqrt(squares1 * squares2)
+
+    idf_square = SINGLE_DOCUMENT_IDF * SINGLE_DOCUMENT_IDF
+    tfidf_squares1 = idf_square * squares1 - (idf_square - 1) * shared_squares1
+    tfidf_squares2 = idf_square * squares2 - (idf_square - 1) * shared_squares2
+    tfidf_similarity = dot / math.sqrt(tfidf_squares1 * tfidf_squares2)
+    return bow_similarity, tfidf_similarity
+
+
+def build_term_matrices(target_frequencies, frequencies):
+    """
+        Build sparse term count matrices of target texts and stored texts over the terms of the targets.
+
+        Terms found in no target cannot contribute to any shared term sum, so stored terms outside the target
+        vocabulary are left out.
+
+        Parameters:
+            target_frequencies (list[dict]): Term frequencies of the target texts.
+            frequencies (list[dict]): Term frequencies of the stored texts.
+
+        Returns:
+            tuple: Target and stored count matrices, shaped targets x terms and stored texts x terms.
+    """
+    vocabulary = {}
+    for target in target_frequencies:
+        for term in target:
+            vocabulary.setdefault(term, len(vocabulary))
+
+    def build_matrix(frequencies_list):
+        indptr, indices, counts = [0], [], []
+        for image_frequencies in frequencies_list:
+            for term, count in (image_frequencies or {}).items():
+                index = vocabulary.get(term)
+                if index is not None:
+                    indices.append(index)
+                    counts.append(count)
+            indptr.append(len(indices))
+        return csr_matrix((np.array(counts, dtype=np.float64), np.array(indices, dtype=np.int64), indptr),
+                          shape=(len(frequencies_list), len(vocabulary)))
+
+    return build_matrix(target_frequencies), build_matrix(frequencies)
+
+
+def combine_bow_tfidf_sums(dot, squares1, squares2, shared_squares1, shared_squares2):
+    """
+        Combine the sums of calculate_bow_tfidf_similarities computed for many pairs at once into scores.
+
+        Parameters:
+            dot (ndarray): Dot products of the count vectors.
+            squares1 (ndarray): Sums of squared counts of the first texts.
+            squares2 (ndarray): Sums of squared counts of the second texts.
+            shared_squares1 (ndarray): Sums of squared counts of the first texts over the shared terms.
+            shared_squares2 (ndarray): Sums of squared counts of the second texts over the shared terms.
+
+        Returns:
+            ndarray: Averaged similarity values, 0 for pairs without shared terms.
+    """
+    idf_square = SINGLE_DOCUMENT_IDF * SINGLE_DOCUMENT_IDF
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bow_similarity = dot / np.sqrt(squares1 * squares2)
+        tfidf_similarity = dot / np.sqrt((idf_square * squares1 - (idf_square - 1) * shared_squares1) *
+                                         (idf_square * squares2 - (idf_square - 1) * shared_squares2))
+        scores = (bow_similarity + tfidf_similarity) / 2 * 100
+    scores[dot == 0] = 0
+    return scores
+
+
+class TextSimilarityMetric:
+    """
+        Base class for text similarity metrics.
+
+        A metric scores one target text against many stored texts at once, so that backends able to work in
+        batches are not called once per pair. Scores are percentages from 0 to 100.
+    """
+    name = None
+    # Whether score_pairs needs the texts, or only their term counts
+    uses_texts = False
+
+    def score_many(self, target_text, target_frequencies, texts, frequencies, score_cutoff=0):
+        """
+            Score a target text against stored texts.
+
+            Parameters:
+                target_text (str): Target text string.
+                target_frequencies (dict): Term frequencies of the target text.
+                texts (list[str]): Stored text strings.
+                frequencies (list[dict]): Term frequencies of the stored texts.
+                score_cutoff (float): Scores below the cutoff may be reported as 0.
+
+            Returns:
+                list[float]: Similarity value for every stored text.
+        """
+        raise NotImplementedError
+
+    def score_batch(self, target_texts, target_frequencies, texts, frequencies, score_cutoff=0):
+        """
+            Score several target texts against stored texts.
+
+            Parameters:
+                target_texts (list[str]): Target text strings.
+                target_frequencies (list[dict]): Term frequencies of the target texts.
+                texts (list[str]): Stored text strings.
+                frequencies (list[dict]): Term frequencies of the stored texts.
+                score_cutoff (float): Scores below the cutoff may be reported as 0.
+
+            Returns:
+                ndarray: Similarity values shaped targets x stored texts.
+        """
+        scores = np.zeros((len(target_texts), len(texts)))
+        for index, (target_text, frequencies_of_target) in enumerate(zip(target_texts, target_frequencies)):
+            scores[index] = self.score_many(target_text, frequencies_of_target, texts, frequencies, score_cutoff)
+        return scores
+
+    def score_matrix(self, target_texts, targets, texts, stored, score_cutoff=0):
+        """
+            Score target texts against stored texts given as term count matrices over one vocabulary.
+
+            Parameters:
+                target_texts (list[str]): Target text strings, only used by metrics that need the texts.
+                targets (csr_matrix): Term counts of the target texts, targets x terms.
+                texts (list[str]): Stored text strings, None for metrics that only use term counts.
+                stored (csr_matrix): Term counts of the stored texts over the same terms.
+                score_cutoff (float): Scores below the cutoff may be reported as 0.
+
+            Returns:
+                ndarray: Similarity values shaped targets x stored texts.
+        """
+        raise NotImplementedError
+
+    def score_pairs(self, texts1, texts2, counts1, counts2, score_cutoff=0):
+        """
+            Score listed text pairs.
+
+            Parameters:
+                texts1 (list[str]): First text of every pair, None for metrics that only use term counts.
+                texts2 (list[str]): Second text of every pair, None for metrics that only use term counts.
+                counts1 (csr_matrix): Term counts of the first texts, pairs x terms.
+                counts2 (csr_matrix): Term counts of the second texts over the same terms.
+                score_cutoff (float): Scores below the cutoff may be reported as 0.
+
+            Returns:
+                ndarray: Similarity value of every pair.
+        """
+        raise NotImplementedError
+
+
+class BowTfidfMetric(TextSimilarityMetric):
+    """
+        Average of Bag-of-Words and TF-IDF cosine similarities over precomputed term frequencies.
+    """
+    name = 'bow_tfidf'
+
+    def score_many(self, target_text, target_frequencies, texts, frequencies, score_cutoff=0):
+        scores = []
+        for image_frequencies in frequencies:
+            bow_similarity, tfidf_similarity = calculate_bow_tfidf_similarities(target_frequencies, image_frequencies)
+            scores.append((bow_similarity + tfidf_similarity) / 2 * 100)
+        return scores
+
+    def score_batch(self, target_texts, target_frequencies, texts, frequencies, score_cutoff=0):
+        # The sums of calculate_bow_tfidf_similarities for all pairs as sparse matrix products
+        targets, stored = build_term_matrices(target_frequencies, frequencies)
+        squares1 = np.array([sum(count * count for count in (image_frequencies or {}).values())
+                             for image_frequencies in target_frequencies], dtype=np.float64)[:, None]
+        squares2 = np.array([sum(count * count for count in (image_frequencies or {}).values())
+                             for image_frequencies in frequencies], dtype=np.float64)[None, :]
+        dot = (targets @ stored.T).toarray()
+        shared_squares1 = (targets.multiply(targets) @ (stored > 0).T).toarray()
+        shared_squares2 = ((targets > 0) @ stored.multiply(stored).T).toarray()
+
+        return combine_bow_tfidf_sums(dot, squares1, squares2, shared_squares1, shared_squares2)
+
+    def score_matrix(self, target_texts, targets, texts, stored, score_cutoff=0):
+        squares1 = np.asarray(targets.multiply(targets).sum(axis=1))
+        squares2 = np.asarray(stored.multiply(stored).sum(axis=1)).T
+        dot = (targets @ stored.T).toarray()
+        shared_squares1 = (targets.multiply(targets) @ (stored > 0).T).toarray()
+        shared_squares2 = ((targets > 0) @ stored.multiply(stored).T).toarray()
+        return combine_bow_tfidf_sums(dot, squares1, squares2, shared_squares1, shared_squares2)
+
+    def score_pairs(self, texts1, texts2, counts1, counts2, score_cutoff=0):
+        dot = np.asarray(counts1.multiply(counts2).sum(axis=1)).ravel()
+        squares1 = counts1.multiply(counts1)
+        squares2 = counts2.multiply(counts2)
+        shared_squares1 = np.asarray(squares1.multiply(counts2 > 0).sum(axis=1)).ravel()
+        shared_squares2 = np.asarray(squares2.multiply(counts1 > 0).sum(axis=1)).ravel()
+        squares1 = np.asarray(squares1.sum(axis=1)).ravel()
+        squares2 = np.asarray(squares2.sum(axis=1)).ravel()
+
+        return combine_bow_tfidf_sums(dot, squares1, squares2, shared_squares1, shared_squares2)
+
+
+class TokenSetMetric(TextSimilarityMetric):
+    """
+        Set similarity coefficient over the distinct terms of the texts.
+    """
+
+    @staticmethod
+    def coefficient(intersection_size, size1, size2):
+        raise NotImplementedError
+
+    def score_many(self, target_text, target_frequencies, texts, frequencies, score_cutoff=0):
+        target_terms = target_frequencies.keys()
+        scores = []
+        for image_frequencies in frequencies:
+            if not target_terms or not image_frequencies:
+                scores.append(0)
+                continue
+            intersection_size = len(target_terms & image_frequencies.keys())
+            scores.append(self.coefficient(intersection_size, len(target_terms), len(image_frequencies)) * 100)
+        return scores
+
+    def score_batch(self, target_texts, target_frequencies, texts, frequencies, score_cutoff=0):
+        targets, stored = build_term_matrices(target_frequencies, frequencies)
+        intersection_sizes = ((targets > 0).astype(np.float64) @ (stored > 0).T).toarray()
+        sizes1 = np.array([len(image_frequencies or {}) for image_frequencies in target_frequencies])[:, None]
+        sizes2 = np.array([len(image_frequencies or {}) for image_frequencies in frequencies])[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self.coefficient(intersection_sizes, sizes1, sizes2) * 100
+        scores[(sizes1 == 0) | (sizes2 == 0)] = 0
+        return scores
+
+    def score_matrix(self, target_texts, targets, texts, stored, score_cutoff=0):
+        intersection_sizes = ((targets > 0).astype(np.float64) @ (stored > 0).T).toarray()
+        sizes1 = np.diff(targets.indptr)[:, None]
+        sizes2 = np.diff(stored.indptr)[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self.coefficient(intersection_sizes, sizes1, sizes2) * 100
+        scores[(sizes1 == 0) | (sizes2 == 0)] = 0
+        return scores
+
+    def score_pairs(self, texts1, texts2, counts1, counts2, score_cutoff=0):
+        terms1 = counts1 > 0
+        terms2 = counts2 > 0
+        intersection_sizes = np.asarray(terms1.multiply(terms2).sum(axis=1)).ravel()
+        sizes1 = np.asarray(terms1.sum(axis=1)).ravel()
+        sizes2 = np.asarray(terms2.sum(axis=1)).ravel()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self.coefficient(intersection_sizes, sizes1, sizes2) * 100
+        scores[(sizes1 == 0) | (sizes2 == 0)] = 0
+        return scores
+
+
+class JaccardMetric(TokenSetMetric):
+    name = 'jaccard'
+
+    @staticmethod
+    def coefficient(intersection_size, size1, size2):
+        return intersection_size / (size1 + size2 - intersection_size)
+
+
+class SorensenDiceMetric(TokenSetMetric):
+    name = 'sorensen_dice'
+
+    @staticmethod
+    def coefficient(intersection_size, size1, size2):
+        return 2 * intersection_size / (size1 + size2)
+
+
+class OverlapMetric(TokenSetMetric):
+    name = 'overlap'
+
+    @staticmethod
+    def coefficient(intersection_size, size1, size2):
+        return intersection_size / np.minimum(size1, size2)
+
+
+class RapidfuzzMetric(TextSimilarityMetric):
+    """
+        Edit-distance metrics scored with rapidfuzz process.cdist.
+
+        The target is scored against all stored texts in one call running in parallel C++ threads, and the score
+        cutoff lets rapidfuzz stop early on texts that cannot reach the threshold.
+    """
+
+    uses_texts = True
+
+    # Metric name: (scorer, factor to convert the scorer result into a percentage)
+    SCORERS = {
+        'levenshtein': (Levenshtein.normalized_similarity, 100),
+        'ratio': (fuzz.ratio, 1),
+        'token_sort_ratio': (fuzz.token_sort_ratio, 1),
+        'token_set_ratio': (fuzz.token_set_ratio, 1),
+    }
+
+    def __init__(self, name, workers=-1):
+        """
+            Initialize the metric.
+
+            Parameters:
+                name (str): Name of the rapidfuzz scorer.
+                workers (int): Number of threads used by cdist, -1 uses all cores.
+        """
+        self.name = name
+        self.scorer, self.factor = self.SCORERS[name]
+        self.workers = workers
+
+    def score_many(self, target_text, target_frequencies, texts, frequencies, score_cutoff=0):
+        if not target_text or not texts:
+            return [0] * len(texts)
+        scores = process.cdist([target_text], [text or '' for text in texts], scorer=self.scorer,
+                               score_cutoff=score_cutoff / self.factor, workers=self.workers)
+        return [float(score) * self.factor for score in scores[0]]
+
+    def score_batch(self, target_texts, target_frequencies, texts, frequencies, score_cutoff=0):
+        if not texts:
+            return np.zeros((len(target_texts), 0))
+        scores = process.cdist([text or '' for text in target_texts], [text or '' for text in texts],
+                               scorer=self.scorer, score_cutoff=score_cutoff / self.factor, workers=self.workers)
+        scores = scores.astype(np.float64) * self.factor
+        # Like score_many, an empty target scores 0 against everything
+        scores[[not text for text in target_texts]] = 0
+        return scores
+
+    def score_matrix(self, target_texts, targets, texts, stored, score_cutoff=0):
+        return self.score_batch(target_texts, None, texts, None, score_cutoff)
+
+    def score_pairs(self, texts1, texts2, counts1, counts2, score_cutoff=0):
+        cutoff = score_cutoff / self.factor
+        return np.array([self.scorer(text1, text2, score_cutoff=cutoff) * self.factor if text1 and text2 else 0
+                         for text1, text2 in zip(texts1, texts2)], dtype=np.float64)
+
+
+TEXT_SIMILARITY_METRICS = {metric.name: metric for metric in (BowTfidfMetric, JaccardMetric, SorensenDiceMetric,
+                                                               OverlapMetric)}
+
+
+def get_text_similarity_metric(name, workers=-1):
+    """
+        Create a text similarity metric by name.
+
+        Parameters:
+            name (str): Name of the metric, one of TEXT_SIMILARITY_METRICS or RapidfuzzMetric.SCORERS.
+            workers (int): Number of threads for metrics that run in parallel.
+
+        Returns:
+            TextSimilarityMetric: The metric.
+    """
+    if name in TEXT_SIMILARITY_METRICS:
+        return TEXT_SIMILARITY_METRICS[name]()
+    if name in RapidfuzzMetric.SCORERS:
+        return RapidfuzzMetric(name, workers)
+    raise ValueError(f'Unknown text similarity metric: {name}')
@@ -0,0 +1,159 @@
+import gc
+import os
+import signal
+import time
+import logging
+import threading
+
+import psutil
+
+
+class TaskRequeueRequested(Exception):
+    """
+        Raised to abandon an in-flight task and return its message to the queue.
+    """
+
+
+class GracefulShutdown:
+    """
+        Tracks a shutdown request and the deadline for in-flight work.
+
+        The first SIGTERM or SIGINT stops consumption of new messages and starts the grace period. In-flight tasks
+        can finish until the deadline; tasks that reach a checkpoint after it are requeued.
+    """
+
+    def __init__(self, grace_period, logger_level=logging.INFO):
+        """
+            Initialize without a pending shutdown.
+
+            Args:
+                grace_period (float): Seconds in-flight work may take after a shutdown was requested.
+                logger_level (int): Logger level.
+        """
+        self.grace_period = grace_period
+        self.stop_event = threading.Event()
+        self.deadline = None
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+
+    def install_signal_handlers(self):
+        """
+            Request a shutdown on SIGTERM and SIGINT. Must be called from the main thread.
+        """
+        signal.signal(signal.SIGTERM, self.request)
+        signal.signal(signal.SIGINT, self.request)
+
+    def request(self, signum=None, frame=None):
+        """
+            Request a shutdown. Usable as a signal handler.
+
+            Args:
+                signum (int): The received signal, if any.
+                frame: The interrupted stack frame, if any.
+        """
+        if self.stop_event.is_set():
+            self.logger.warning('Shutdown already in progress')
+            return
+        self.deadline = time.monotonic() + self.grace_period
+        self.stop_event.set()
+        self.logger.info(f'Shutdown requested (signal {signum}), draining in-flight work for up to '
+                         f'{self.grace_period} seconds')
+
+    @property
+    def is_requested(self):
+        """
+            Check whether a shutdown was requested.
+
+            Returns:
+                bool: True if a shutdown was requested.
+        """
+        return self.stop_event.is_set()
+
+    def remaining(self):
+        """
+            Seconds left until the shutdown deadline.
+
+            Returns:
+                float: Remaining seconds, or None if no shutdown was requested.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check_deadline(self):
+        """
+            Checkpoint for in-flight tasks.
+
+            Raises:
+                TaskRequeueRequested: If the shutdown deadline has passed.
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise TaskRequeueRequested('Shutdown deadline passed')
+
+
+class WorkerBackpressure:
+    """
+        Pauses consumption while the worker is saturated.
+
+        The worker is saturated when the resident memory of the process exceeds the memory limit. It is checked
+        between tasks, as the consumer takes one message at a time, so a saturated worker only recovers when other
+        threads free memory; a pause longer than the pause limit is reported as expired so that the worker can exit
+        and be restarted by its supervisor.
+    """
+
+    def __init__(self, max_memory_mb=0, max_pause_seconds=300, logger_level=logging.INFO):
+        """
+            Initialize the backpressure limits.
+
+            Args:
+                max_memory_mb (int): Memory limit of the worker process in MB. 0 disables the memory check.
+                max_pause_seconds (float): Longest pause before it is reported as expired. 0 pauses indefinitely.
+                logger_level (int): Logger level.
+        """
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.max_pause_seconds = max_pause_seconds
+        self.paused_at = None
+        self.process = psutil.Process(os.getpid())
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+
+    def get_memory_usage(self):
+        """
+            Get the resident memory of the worker process.
+
+            Returns:
+                int: Resident memory of the worker process in bytes.
+        """
+        return self.process.memory_info().rss
+
+    def is_saturated(self):
+        """
+            Check whether the worker should stop taking new messages.
+
+            Garbage is collected once when the limit is first reached, not on every check of a pause.
+
+            Returns:
+                bool: True if the memory limit is reached.
+        """
+        if not self.max_memory_bytes:
+            return False
+        if self.get_memory_usage() < self.max_memory_bytes:
+            self.paused_at = None
+            return False
+        if self.paused_at is None:
+            # Give freed image buffers back before pausing
+            gc.collect()
+            if self.get_memory_usage() < self.max_memory_bytes:
+                return False
+            self.paused_at = time.monotonic()
+        return True
+
+    def is_pause_expired(self):
+        """
+            Check whether the current pause has lasted longer than the pause limit.
+
+            Returns:
+                bool: True if consumption has been paused for more than max_pause_seconds.
+        """
+        return bool(self.max_pause_seconds) and self.paused_at is not None and \
+            time.monotonic() - self.paused_at >= self.max_pause_seconds
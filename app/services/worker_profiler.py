@@ -0,0 +1,225 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# Profiling modes
+PROFILE_SAMPLING = 'sampling'
+PROFILE_DETERMINISTIC = 'cprofile'
+
+
+class WorkerProfiler:
+    """
+        On-demand profiling of a live worker for a number of seconds or tasks.
+
+        The sampling mode walks the stack of the profiled threads every sample interval from a background thread,
+        which costs the worker almost nothing, and writes the stacks in the collapsed format of flame graph tools.
+        The cprofile mode traces every call of the thread that started it, which is exact but slows it down, and
+        writes a pstats file. Only one profile runs at a time, the summary of the last finished one is kept.
+    """
+
+    def __init__(self, output_dir, sample_interval, max_seconds, logger_level=logging.INFO):
+        """
+            Initialize without a running profile.
+
+            Args:
+                output_dir (str): Directory the profiles are written to.
+                sample_interval (float): Seconds between two stack samples of the sampling mode.
+                max_seconds (float): Longest a profile runs, also when it was started for a number of tasks.
+                logger_level: Logger level.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logger_level)
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.mode = None
+        self.profile = None
+        self.sampler = None
+        self.stop_event = threading.Event()
+        self.stack_counts = Counter()
+        self.samples_count = 0
+        self.thread_ids = None
+        self.started_at = None
+        self.deadline = None
+        self.max_tasks = None
+        self.tasks_count = 0
+        self.top = 20
+        self.last_summary = None
+
+    def is_running(self):
+        """
+            Returns:
+                bool: True while a profile runs.
+        """
+        return self.mode is not None
+
+    def start(self, mode=PROFILE_SAMPLING, seconds=None, tasks=None, all_threads=False, top=20):
+        """
+            Start profiling the calling thread, the consumer thread of the worker.
+
+            Args:
+                mode (str): PROFILE_SAMPLING or PROFILE_DETERMINISTIC.
+                seconds (float): Seconds to profile, capped by max_seconds.
+                tasks (int): Tasks to profile, None to profile for the seconds only.
+                all_threads (bool): Sample all threads of the worker instead of the calling thread, sampling mode only.
+                top (int): Number of functions in the summary.
+
+            Returns:
+                dict: The profile settings.
+        """
+        if mode not in (PROFILE_SAMPLING, PROFILE_DETERMINISTIC):
+            raise ValueError(f'Unknown profiling mode: {mode}')
+        if self.is_running():
+            raise RuntimeError('A profile is already running')
+        seconds = min(float(seconds), self.max_seconds) if seconds else self.max_seconds
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + seconds
+        self.max_tasks = int(tasks) if tasks else None
+        self.tasks_count = 0
+        self.top = int(top)
+        self.mode = mode
+        if mode == PROFILE_DETERMINISTIC:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.stack_counts = Counter()
+            self.samples_count = 0
+            self.thread_ids = None if all_threads else {threading.get_ident()}
+            self.stop_event.clear()
+            self.sampler = threading.Thread(target=self.sample, name='worker-profiler', daemon=True)
+            self.sampler.start()
+        self.logger.info(f'Profiling started: {mode} for {seconds:g} seconds'
+                         f'{f" or {self.max_tasks} tasks" if self.max_tasks else ""}')
+        return {"mode": mode, "seconds": seconds, "tasks": self.max_tasks}
+
+    def sample(self):
+        """
+            Count the stacks of the profiled threads until the profile is stopped or its deadline passes.
+        """
+        own_thread_id = threading.get_ident()
+        thread_names = {}
+        while not self.stop_event.wait(self.sample_interval) and time.monotonic() < self.deadline:
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples_count += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == own_thread_id or (self.thread_ids is not None and thread_id not in self.thread_ids):
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    if self.thread_ids is None:
+                        if thread_id not in thread_names:
+                            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                        stack.append(thread_names.get(thread_id, str(thread_id)))
+                    self.stack_counts[';'.join(reversed(stack))] += 1
+
+    def on_task_done(self):
+        """
+            Count a task processed while profiling.
+        """
+        if self.is_running():
+            self.tasks_count += 1
+
+    def poll(self):
+        """
+            Finish the running profile when its seconds or tasks are reached. Must be called from the thread that
+            started it, the trace of the cprofile mode belongs to that thread.
+
+            Returns:
+                dict: The summary if the profile finished now, None otherwise.
+        """
+        if not self.is_running():
+            return None
+        if time.monotonic() < self.deadline and (self.max_tasks is None or self.tasks_count < self.max_tasks):
+            return None
+        return self.stop()
+
+    def stop(self):
+        """
+            Stop the running profile, write it to the output directory and summarize it.
+
+            Returns:
+                dict: Mode, duration, tasks, path of the written profile and the top functions. None if no profile
+                runs.
+        """
+        if not self.is_running():
+            return None
+        elapsed = time.monotonic() - self.started_at
+        os.makedirs(self.output_dir, exist_ok=True)
+        file_name = f'profile_{os.getpid()}_{time.strftime("%Y%m%d-%H%M%S")}'
+        if self.mode == PROFILE_DETERMINISTIC:
+            self.profile.disable()
+            path = os.path.join(self.output_dir, f'{file_name}.prof')
+            self.profile.dump_stats(path)
+            top_functions = self.summarize_stats(self.profile)
+            self.profile = None
+        else:
+            self.stop_event.set()
+            self.sampler.join()
+            self.sampler = None
+            path = os.path.join(self.output_dir, f'{file_name}.collapsed')
+            with open(path, 'w') as profile_file:
+                for stack, count in self.stack_counts.most_common():
+                    profile_file.write(f'{stack} {count}\n')
+            top_functions = self.summarize_samples()
+        summary = {
+            "mode": self.mode,
+            "seconds": round(elapsed, 3),
+            "tasks": self.tasks_count,
+            "path": path,
+            "top_functions": top_functions,
+        }
+        if self.mode == PROFILE_SAMPLING:
+            summary["samples"] = self.samples_count
+        self.mode = None
+        self.last_summary = summary
+        self.logger.info(f'Profiling finished: {summary}')
+        return summary
+
+    def summarize_stats(self, profile):
+        """
+            Args:
+                profile (Profile): The stopped cProfile profile.
+
+            Returns:
+                list[dict]: The functions with the highest own time, with their calls and cumulative time.
+        """
+        stats = pstats.Stats(profile, stream=io.StringIO())
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        return [{
+            "function": f'{function_name} ({os.path.basename(file_name)}:{line_number})',
+            "calls": calls,
+            "own_seconds": round(own_time, 6),
+            "cumulative_seconds": round(cumulative_time, 6),
+        } for (file_name, line_number, function_name), (_, calls, own_time, cumulative_time, _) in entries]
+
+    def summarize_samples(self):
+        """
+            Returns:
+                list[dict]: The functions running in the most samples themselves, with the share of samples they
+                were running in and were anywhere on the stack in.
+        """
+        own_counts = Counter()
+        total_counts = Counter()
+        for stack, count in self.stack_counts.items():
+            functions = stack.split(';')
+            own_counts[functions[-1]] += count
+            # A recursive function counts once per sample
+            for function in set(functions):
+                total_counts[function] += count
+        stacks_count = max(1, sum(self.stack_counts.values()))
+        return [{
+            "function": function,
+            "own_percent": round(own_count * 100 / stacks_count, 2),
+            "total_percent": round(total_counts[function] * 100 / stacks_count, 2),
+        } for function, own_count in own_counts.most_common(self.top)]
@@ -0,0 +1,197 @@
+import logging
+import multiprocessing
+import os
+import time
+
+# Environment variables read by the OpenMP, MKL and OpenBLAS thread pools when they are loaded
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+# Default of OCR_CPU_THREADS, the threads of every OCR worker
+DEFAULT_OCR_CPU_THREADS = 10
+
+
+def get_available_cpus():
+    """
+        Get the CPUs the current process may run on.
+
+        Returns:
+            list[int]: CPU ids, sorted.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpu_list(cpu_list):
+    """
+        Parse a CPU list like '0-3,8'.
+
+        Args:
+            cpu_list (str): Comma separated CPU ids and ranges.
+
+        Returns:
+            list[int]: CPU ids.
+    """
+    cpus = []
+    for part in cpu_list.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_worker_cpus(cpu_affinity, worker_count, available_cpus=None):
+    """
+        Assign CPUs to worker processes.
+
+        Args:
+            cpu_affinity (str): Empty to not pin workers, 'auto' to split the available CPUs into equal contiguous
+                blocks, or CPU lists of the workers separated by ';', e.g. '0-3;4-7'.
+            worker_count (int): Number of worker processes.
+            available_cpus (list[int]): CPUs to split with 'auto'. Defaults to the CPUs of this process.
+
+        Returns:
+            list: CPU ids of every worker, None for workers that are not pinned.
+    """
+    if not cpu_affinity:
+        return [None] * worker_count
+    if cpu_affinity.lower() == 'auto':
+        available_cpus = available_cpus or get_available_cpus()
+        if worker_count > len(available_cpus):
+            raise ValueError(f'Cannot pin {worker_count} workers to {len(available_cpus)} CPUs')
+        block_size = len(available_cpus) // worker_count
+        return [available_cpus[index * block_size:(index + 1) * block_size] for index in range(worker_count)]
+    worker_cpus = [parse_cpu_list(cpu_list) for cpu_list in cpu_affinity.split(';')]
+    if len(worker_cpus) != worker_count:
+        raise ValueError(f'OCR_CPU_AFFINITY has {len(worker_cpus)} CPU lists for {worker_count} workers')
+    return worker_cpus
+
+
+def set_thread_env(threads):
+    """
+        Limit the native thread pools of processes started after the call.
+
+        The pools read their size when the libraries are loaded, so the variables are set in the parent before
+        worker processes are started.
+
+        Args:
+            threads (int): Threads per pool, 0 keeps the library defaults.
+    """
+    if threads > 0:
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(threads)
+
+
+def configure_worker_process(cpus, threads):
+    """
+        Pin the current process to CPUs and limit the OpenCV thread pool.
+
+        Args:
+            cpus (list[int]): CPU ids, None to not pin the process.
+            threads (int): OpenCV threads, 0 keeps the default.
+    """
+    import cv2
+    if cpus is not None:
+        if not hasattr(os, 'sched_setaffinity'):
+            raise OSError('CPU affinity is not supported on this platform')
+        os.sched_setaffinity(0, cpus)
+    if threads > 0:
+        cv2.setNumThreads(threads)
+
+
+def _benchmark_worker(cpus, threads, warmup_image_path, tasks, results):
+    """
+        Recognize images from the task queue until it is empty. Runs in a worker process of benchmark_ocr_workers.
+    """
+    configure_worker_process(cpus, threads)
+    os.environ['OCR_CPU_THREADS'] = str(threads)
+    from app.services.image_ocr_service import ImageOCRService
+    image_ocr_service = ImageOCRService()
+    # Warm up the models before the measured images
+    image_ocr_service.get_text_from_image(warmup_image_path)
+    results.put(('ready', None))
+    while True:
+        image_path = tasks.get()
+        if image_path is None:
+            break
+        start_time = time.perf_counter()
+        image_ocr_service.get_text_from_image(image_path)
+        results.put(('done', time.perf_counter() - start_time))
+
+
+def benchmark_ocr_workers(image_paths, worker_count, threads, cpu_affinity='auto', rounds=1):
+    """
+        Measure the OCR throughput of a number of worker processes with a number of threads each.
+
+        Args:
+            image_paths (list[str]): Images to recognize.
+            worker_count (int): Number of worker processes.
+            threads (int): Threads per worker.
+            cpu_affinity (str): CPU affinity of the workers, see get_worker_cpus.
+            rounds (int): Number of times every image is recognized.
+
+        Returns:
+            dict: Workers, threads, throughput in images per second and average latency in seconds.
+    """
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    set_thread_env(threads)
+    workers = [context.Process(target=_benchmark_worker, args=(cpus, threads, image_paths[0], tasks, results),
+                               daemon=True)
+               for cpus in get_worker_cpus(cpu_affinity, worker_count)]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        results.get()
+
+    image_count = len(image_paths) * rounds
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        for image_path in image_paths:
+            tasks.put(image_path)
+    for _ in workers:
+        tasks.put(None)
+    latencies = [results.get()[1] for _ in range(image_count)]
+    total_time = time.perf_counter() - start_time
+    for worker in workers:
+        worker.join()
+    return {
+        'workers': worker_count,
+        'threads': threads,
+        'throughput': image_count / total_time,
+        'latency_avg': sum(latencies) / len(latencies),
+    }
+
+
+def tune_ocr_workers(image_paths, worker_counts=None, thread_counts=None, cpu_affinity='auto', rounds=1):
+    """
+        Sweep worker and thread combinations that fit the available CPUs and find the fastest.
+
+        Args:
+            image_paths (list[str]): Images to recognize.
+            worker_counts (list[int]): Worker counts to try. Defaults to powers of two up to the CPU count.
+            thread_counts (list[int]): Threads per worker to try. Defaults to powers of two up to the CPU count.
+            cpu_affinity (str): CPU affinity of the workers, see get_worker_cpus.
+            rounds (int): Number of times every image is recognized per combination.
+
+        Returns:
+            tuple: Results of all combinations and the result with the highest throughput.
+    """
+    logger = logging.getLogger(__name__)
+    cpu_count = len(get_available_cpus())
+    powers_of_two = [2 ** power for power in range(cpu_count.bit_length()) if 2 ** power <= cpu_count]
+    results = []
+    for worker_count in worker_counts or powers_of_two:
+        for threads in thread_counts or powers_of_two:
+            if worker_count * threads > cpu_count:
+                continue
+            result = benchmark_ocr_workers(image_paths, worker_count, threads, cpu_affinity, rounds)
+            logger.info(f'{worker_count} workers x {threads} threads: {result["throughput"]:.2f} images/s, '
+                        f'average latency {result["latency_avg"]:.2f} s')
+            results.append(result)
+    return results, max(results, key=lambda result: result['throughput'], default=None)
@@ -1,8 +1,11 @@
 import logging
+import multiprocessing
+import signal
+import threading
 
 from app.config.environment_manager import EnvironmentManager
-from app.messaging.rabbitmq_connection import RabbitMQConnection
-from app.services.image_service import ImageService
+from app.services.worker_topology import DEFAULT_OCR_CPU_THREADS, configure_worker_process, get_worker_cpus, \
+    set_thread_env
 
 
 class Main(EnvironmentManager):
@@ -10,31 +13,123 @@ class Main(EnvironmentManager):
         Main class to initialize and start services.
     """
     def __init__(self):
-        super().__init__([])
+        super().__init__([], {
+            'OCR_WORKER_PROCESSES': '1',
+            'OCR_CPU_AFFINITY': '',
+            'OCR_CPU_THREADS': str(DEFAULT_OCR_CPU_THREADS)
+        })
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(self.logger_level)
         self.logger.info('Initializing main...')
+        self.worker_processes = max(1, int(self.env_vars['OCR_WORKER_PROCESSES']))
+        self.worker_cpus = get_worker_cpus(self.env_vars['OCR_CPU_AFFINITY'], self.worker_processes)
+        self.cpu_threads = int(self.env_vars['OCR_CPU_THREADS'])
+        self.shutdown_event = threading.Event()
 
     def run(self):
         """
             Main function to initialize and start services.
+            Starts the image processing service in this process, or in OCR_WORKER_PROCESSES worker processes
+            pinned to the CPUs of OCR_CPU_AFFINITY.
+        """
+        # The native thread pools are sized when the OCR libraries are loaded, so limit them first
+        set_thread_env(self.cpu_threads)
+        if self.worker_processes == 1:
+            self.run_worker(self.worker_cpus[0])
+        else:
+            self.run_workers()
+
+    def run_worker(self, cpus):
+        """
+            Run the image processing service in the current process.
             Establishes a RabbitMQ connection and initializes an ImageService object,
             then starts consuming messages from the RabbitMQ queue.
+
+            Args:
+                cpus (list[int]): CPUs to pin the process to, None to not pin it.
         """
+        configure_worker_process(cpus, self.cpu_threads)
+        # Imported after the thread limits are set, loading them starts the OCR libraries
+        from app.messaging.rabbitmq_connection import RabbitMQConnection
+        from app.services.image_service import ImageService
         try:
             # Initialize the RabbitMQ connection
             rabbitmq_connection = RabbitMQConnection()
 
             # Initialize the ImageService with the RabbitMQ connection
             image_service = ImageService(rabbitmq_connection)
-            self.logger.info('Starting image processing service...')
+            self.logger.info(f'Starting image processing service on CPUs {cpus or "all"}...')
 
             # Start the message consumption process for ImageService
             image_service.start_consuming()
+            if image_service.restart_requested:
+                # Exit with an error so that the supervisor or container runtime restarts the worker
+                raise SystemExit(1)
         except Exception as e:
             self.logger.error('Error occurred while running image processing service', exc_info=e)
             raise e
 
+    def run_workers(self):
+        """
+            Start the worker processes and supervise them.
+
+            Workers that exit while the service is running are restarted. SIGTERM is forwarded to the workers,
+            which drain their in-flight tasks before exiting.
+        """
+        context = multiprocessing.get_context('spawn')
+        workers = [self.start_worker_process(context, cpus) for cpus in self.worker_cpus]
+        signal.signal(signal.SIGTERM, self.request_shutdown)
+        signal.signal(signal.SIGINT, self.request_shutdown)
+        while not self.shutdown_event.wait(1):
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    self.logger.error(f'Worker {worker.pid} exited with code {worker.exitcode}, restarting')
+                    workers[index] = self.start_worker_process(context, self.worker_cpus[index])
+
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
+        self.logger.info('All workers stopped')
+
+    def start_worker_process(self, context, cpus):
+        """
+            Start a worker process.
+
+            Args:
+                context: Multiprocessing context.
+                cpus (list[int]): CPUs to pin the worker to, None to not pin it.
+
+            Returns:
+                Process: The started worker process.
+        """
+        worker = context.Process(target=run_worker_process, args=(cpus,))
+        worker.start()
+        self.logger.info(f'Started worker {worker.pid} on CPUs {cpus or "all"}')
+        return worker
+
+    def request_shutdown(self, signum=None, frame=None):
+        """
+            Stop supervising the workers and shut them down. Usable as a signal handler.
+
+            Args:
+                signum (int): The received signal, if any.
+                frame: The interrupted stack frame, if any.
+        """
+        self.logger.info(f'Shutdown requested (signal {signum}), stopping workers')
+        self.shutdown_event.set()
+
+
+def run_worker_process(cpus):
+    """
+        Entry point of a worker process.
+
+        Args:
+            cpus (list[int]): CPUs to pin the worker to, None to not pin it.
+    """
+    Main().run_worker(cpus)
+
 
 if __name__ == "__main__":
     main = Main()
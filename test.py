@@ -1,17 +1,42 @@
+import builtins
+import json
 import os
+import queue
 import random
+import tempfile
+import threading
 import time
+import tracemalloc
 import uuid
+from collections import deque
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pika
 
 from rapidfuzz.distance.metrics_cpp import levenshtein_distance
 from scipy.spatial.distance import euclidean, cityblock
 from tqdm import tqdm
 from sklearn.feature_extraction.text import CountVectorizer
+from app.db.image_columns_cache import ImageColumnsCache
+from app.db.image_records import ImageHashes
 from app.db.recognized_images_repository import RecognizedImagesRepository
+from app.messaging.message_codec import MessageCodec, decode_message
+from app.messaging.queue_scheduler import get_percentile
 from app.messaging.rabbitmq_connection import RabbitMQConnection
+from app.messaging.rabbitmq_publisher import RabbitMQPublisher
+from app.messaging.rabbitmq_rpc_client import RabbitMQRpcClient
+from app.services.duplicate_clustering_service import DuplicateClusteringService
+from app.services.feature_migration_service import FeatureMigrationService
+from app.services.image_hash_service import ImageHashService, HASH_VERSION, FILTER_HASH_TYPES
 from app.services.image_ocr_service import ImageOCRService
-from app.services.image_service import OCR_IMAGE_QUEUE, COMPARE_IMAGES_QUEUE, RESPONSE_QUEUE
+from app.services.image_service import ImageService, OCR_IMAGE_QUEUE, COMPARE_IMAGES_QUEUE, RESPONSE_QUEUE, \
+    MAINTENANCE_QUEUE
 from app.services.image_similarity_service import ImageSimilarityService
+from app.services.worker_control import GracefulShutdown, WorkerBackpressure
+from app.services.worker_topology import tune_ocr_workers
+from app.services.text_similarity_metrics import TEXT_SIMILARITY_METRICS, RapidfuzzMetric, get_text_similarity_metric
 
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
@@ -251,6 +276,581 @@ def test_text_compare():
         my_file.write(text)
 
 
+def text_similarity_metrics_benchmark_test(similarity_percentage=60, stored_texts_count=10000):
+    # Images with the same name in orig and fake are the same document, all other pairs are different documents
+    results_file_path = 'metrics_results.txt'
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).items()) + list(get_images_paths(fake_images_dir).items())
+
+    image_ocr_service = ImageOCRService()
+    image_similarity_service = ImageSimilarityService()
+    texts = []
+    for image_name, image_path in tqdm(image_paths, desc="Recognizing"):
+        text = image_similarity_service.preprocess_text(image_ocr_service.get_text_from_image(image_path) or '')
+        texts.append((image_name, text, image_similarity_service.get_term_frequencies(text)))
+
+    # Stored texts for the throughput measure, repeated from the recognized ones
+    stored_texts = [texts[i % len(texts)] for i in range(stored_texts_count)]
+
+    metric_names = list(TEXT_SIMILARITY_METRICS) + list(RapidfuzzMetric.SCORERS)
+    for metric_name in metric_names:
+        metric = get_text_similarity_metric(metric_name)
+        true_positives = false_positives = false_negatives = true_negatives = 0
+        for i, (image_name, text, frequencies) in enumerate(texts):
+            others = texts[:i] + texts[i + 1:]
+            scores = metric.score_many(text, frequencies, [other[1] for other in others],
+                                       [other[2] for other in others], score_cutoff=similarity_percentage)
+            for (other_name, _, _), score in zip(others, scores):
+                is_similar = score >= similarity_percentage
+                is_same_document = other_name == image_name
+                true_positives += is_similar and is_same_document
+                false_positives += is_similar and not is_same_document
+                false_negatives += not is_similar and is_same_document
+                true_negatives += not is_similar and not is_same_document
+
+        image_name, text, frequencies = texts[0]
+        start_time = time.perf_counter()
+        metric.score_many(text, frequencies, [stored[1] for stored in stored_texts],
+                          [stored[2] for stored in stored_texts], score_cutoff=similarity_percentage)
+        query_time = time.perf_counter() - start_time
+
+        precision = true_positives / max(1, true_positives + false_positives)
+        recall = true_positives / max(1, true_positives + false_negatives)
+        accuracy = (true_positives + true_negatives) / max(1, true_positives + false_positives + false_negatives +
+                                                           true_negatives)
+        text = (f'{metric_name}: precision {precision:.2f}, recall {recall:.2f}, accuracy {accuracy:.3f}, '
+                f'one query against {stored_texts_count} texts: {query_time * 1000:.1f} ms\n')
+        print(text, end='')
+        with open(results_file_path, "a") as my_file:
+            my_file.write(text)
+
+
+def ocr_angle_cls_benchmark_test(modes=('always', 'adaptive', 'never')):
+    # Per-stage OCR time of every angle classifier mode, and whether the text matches the always mode
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = get_images_paths(orig_images_dir) | get_images_paths(fake_images_dir)
+    reference_texts = {}
+    for mode in modes:
+        os.environ['OCR_ANGLE_CLS_MODE'] = mode
+        image_ocr_service = ImageOCRService()
+        total_timings = {}
+        same_text_count = 0
+        for image_name, image_path in image_paths.items():
+            text = image_ocr_service.get_text_from_image(image_path)
+            for stage, elapsed in image_ocr_service.last_timings.items():
+                total_timings[stage] = total_timings.get(stage, 0) + elapsed
+            same_text_count += reference_texts.setdefault(image_name, text) == text
+        print(f'{mode}: ' + ', '.join(f'{stage} {elapsed:.2f}s' for stage, elapsed in total_timings.items()) +
+              f', same text as {modes[0]}: {same_text_count}/{len(image_paths)}')
+
+
+def ocr_backends_benchmark_test(backends=None, rounds=3):
+    # Latency, throughput and text agreement of OCR backends, compared to the first (reference) backend
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = get_images_paths(orig_images_dir) | get_images_paths(fake_images_dir)
+    if backends is None:
+        backends = [
+            ('paddle', {'OCR_BACKEND': 'paddle', 'OCR_ENABLE_MKLDNN': 'False'}),
+            ('paddle-mkldnn', {'OCR_BACKEND': 'paddle', 'OCR_ENABLE_MKLDNN': 'True'}),
+            ('onnx', {'OCR_BACKEND': 'onnx', 'OCR_ONNX_QUANTIZED': 'False'}),
+            ('onnx-int8', {'OCR_BACKEND': 'onnx', 'OCR_ONNX_QUANTIZED': 'True'}),
+        ]
+    reference_texts = {}
+    image_similarity_service = ImageSimilarityService()
+    for backend_name, backend_env in backends:
+        os.environ.update(backend_env)
+        image_ocr_service = ImageOCRService()
+        latencies = []
+        similarities = []
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            for image_name, image_path in image_paths.items():
+                image_start_time = time.perf_counter()
+                text = image_ocr_service.get_text_from_image(image_path)
+                latencies.append(time.perf_counter() - image_start_time)
+                reference_text = reference_texts.setdefault(image_name, text)
+                similarities.append(100 if text == reference_text else
+                                    image_similarity_service.compare_texts(reference_text, text))
+        total_time = time.perf_counter() - start_time
+        latencies.sort()
+        print(f'{backend_name}: p50 {latencies[len(latencies) // 2] * 1000:.0f} ms, '
+              f'p95 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000:.0f} ms, '
+              f'throughput {len(latencies) / total_time:.2f} images/s, '
+              f'text agreement with {backends[0][0]} {sum(similarities) / len(similarities):.1f}%')
+
+
+def ocr_worker_tuning_test(worker_counts=None, thread_counts=None, rounds=2):
+    # Sweep OCR worker processes x threads per worker and report the fastest combination for this machine
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list((get_images_paths(orig_images_dir) | get_images_paths(fake_images_dir)).values())
+    results, best = tune_ocr_workers(image_paths, worker_counts, thread_counts, rounds=rounds)
+    for result in results:
+        print(f'{result["workers"]} workers x {result["threads"]} threads: {result["throughput"]:.2f} images/s, '
+              f'average latency {result["latency_avg"]:.2f} s')
+    if best:
+        print(f'Best: OCR_WORKER_PROCESSES={best["workers"]} OCR_CPU_THREADS={best["threads"]} '
+              f'OCR_CPU_AFFINITY=auto')
+
+
+def tiered_hash_benchmark_test():
+    # Precision, recall and cost of the 64-bit hash filter alone and followed by the 16x16 hash verification
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    images = list(get_images_paths(orig_images_dir).items()) + list(get_images_paths(fake_images_dir).items())
+    image_hash_service = ImageHashService()
+
+    hashes = []
+    start_time = time.perf_counter()
+    for image_name, image_path in images:
+        hashes.append((image_name, image_hash_service.generate_image_hashes(image_path)))
+    print(f'Hash generation: {(time.perf_counter() - start_time) / len(images) * 1000:.1f} ms per image')
+    start_time = time.perf_counter()
+    for image_name, image_path in images:
+        image_hash_service._generate_verification_hashes(Image.open(image_path))
+    print(f'Of which 16x16 hashes: {(time.perf_counter() - start_time) / len(images) * 1000:.1f} ms per image')
+    start_time = time.perf_counter()
+    for image_name, image_path in images:
+        image_hash_service._generate_hash_variants(Image.open(image_path))
+    print(f'Of which variants: {(time.perf_counter() - start_time) / len(images) * 1000:.1f} ms per image')
+
+    tiers = (
+        ('64-bit filter', False, False),
+        ('64-bit filter + 16x16 verification', True, False),
+        ('64-bit filter + 16x16 verification + rotated and flipped variants', True, True),
+    )
+    for tier, enable_verification, enable_variants in tiers:
+        image_hash_service.ENABLE_HASH_VERIFICATION = enable_verification
+        image_hash_service.ENABLE_HASH_VARIANTS = enable_variants
+        true_positives = false_positives = false_negatives = 0
+        start_time = time.perf_counter()
+        for i, (image_name, image_hashes) in enumerate(hashes):
+            for other_name, other_hashes in hashes[i + 1:]:
+                is_similar, _ = image_hash_service.is_similar(image_hashes, other_hashes)
+                is_same_document = image_name == other_name
+                true_positives += is_similar and is_same_document
+                false_positives += is_similar and not is_same_document
+                false_negatives += not is_similar and is_same_document
+        pairs_count = len(hashes) * (len(hashes) - 1) // 2
+        compare_time = (time.perf_counter() - start_time) / max(1, pairs_count)
+        print(f'{tier}: precision {true_positives / max(1, true_positives + false_positives):.2f}, '
+              f'recall {true_positives / max(1, true_positives + false_negatives):.2f}, '
+              f'false positives {false_positives}, {compare_time * 1e6:.1f} us per pair')
+
+
+def hash_types_benchmark_test():
+    # Cost and discrimination of every 64-bit hash type alone, to choose HASH_TYPES. Pairs of the same document are
+    # the orig and fake images of one name, a good hash type keeps them within its threshold and the others above it.
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    images = list(get_images_paths(orig_images_dir).items()) + list(get_images_paths(fake_images_dir).items())
+    image_hash_service = ImageHashService()
+    decoded_images = [(image_name, Image.open(image_path).copy()) for image_name, image_path in images]
+
+    for hash_type in FILTER_HASH_TYPES:
+        start_time = time.perf_counter()
+        hashes = [(image_name, image_hash_service._generate_hash(hash_type, img)) for image_name, img in decoded_images]
+        hash_time = (time.perf_counter() - start_time) / len(decoded_images)
+        max_distance = getattr(image_hash_service, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT')
+        hash_arrays = ImageHashService.get_hash_arrays(
+            [ImageHashes(**{hash_type: image_hash}) for _, image_hash in hashes], [hash_type])[hash_type]
+        distances = ImageHashService.hamming_distances(hash_arrays[:, None], hash_arrays[None, :])
+        names = np.array([image_name for image_name, _ in hashes])
+        rows, columns = np.triu_indices(len(hashes), 1)
+        is_same_document = names[rows] == names[columns]
+        pair_distances = distances[rows, columns]
+        true_positives = int(np.count_nonzero(is_same_document & (pair_distances <= max_distance)))
+        false_positives = int(np.count_nonzero(~is_same_document & (pair_distances <= max_distance)))
+        same_distances, other_distances = pair_distances[is_same_document], pair_distances[~is_same_document]
+        print(f'{hash_type}: {hash_time * 1000:.2f} ms per image, threshold {max_distance:g}: '
+              f'recall {true_positives / max(1, len(same_distances)):.2f}, false positives {false_positives}, '
+              f'mean distance same document {same_distances.mean() if len(same_distances) else 0:.1f}, '
+              f'other documents {other_distances.mean() if len(other_distances) else 0:.1f}')
+
+
+def batch_hash_matrix_benchmark_test(batch_size=50, stored_images_count=20000):
+    # Hash comparison of a batch against stored images, pair by pair with is_similar and in one matrix pass
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    image_hash_service = ImageHashService()
+    hashes = [image_hash_service.generate_image_hashes(image_path) for image_path in image_paths]
+    batch = [hashes[i % len(hashes)] for i in range(batch_size)]
+    stored = [hashes[i % len(hashes)] for i in range(stored_images_count)]
+
+    start_time = time.perf_counter()
+    pairwise = [[image_hash_service.is_similar(target, image)[0] for image in stored] for target in batch]
+    pairwise_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    matrix = image_hash_service.find_similar_hashes(batch, stored)
+    matrix_time = time.perf_counter() - start_time
+    print(f'Pairwise: {pairwise_time:.2f} s, matrix: {matrix_time:.2f} s, '
+          f'same result: {bool((matrix == pairwise).all())}')
+
+
+def duplicate_clustering_test(sample_size=300):
+    # Cluster the stored images and check the links against a pairwise comparison of a sample
+    db_connection = RecognizedImagesRepository()
+    image_hash_service = ImageHashService()
+    image_similarity_service = ImageSimilarityService()
+    summary = DuplicateClusteringService(db_connection, image_hash_service, image_similarity_service).run()
+    print(summary)
+
+    images = db_connection.get_all_images()
+    sample = random.sample(images, min(sample_size, len(images)))
+    sample_ids = [image.id for image in sample]
+    linked_pairs = {frozenset((link['source_image_id'], link['similar_image_id']))
+                    for link in db_connection.similar_images_collection.find(
+                        {'source_image_id': {'$in': sample_ids}, 'similar_image_id': {'$in': sample_ids}})}
+    texts = [image.recognized_text for image in sample]
+    frequencies = [image_similarity_service.get_term_frequencies(text) for text in texts]
+    similar_pairs = 0
+    for i, image in enumerate(sample):
+        text_similarities = image_similarity_service.score_texts(texts[i], frequencies[i], texts[:i], frequencies[:i])
+        for j, other in enumerate(sample[:i]):
+            is_hash_similar, _ = image_hash_service.is_similar(image, other)
+            similar_pairs += text_similarities[j] >= image_similarity_service.similarity_percentage or is_hash_similar
+    found_pairs = len(linked_pairs)
+    print(f'Sample of {len(sample)} images: {similar_pairs} similar pairs, {found_pairs} linked, '
+          f'recall {found_pairs / max(1, similar_pairs):.2f}')
+
+
+def dedup_hash_band_recall_test(images_count=4000, hash_bands=(0, 4), chunk_size=500):
+    # Recall of the hash band blocking of the duplicate clustering against an exhaustive scan of all pairs, per hash
+    # type, on synthetic hashes where every second image is a copy of the previous one with up to threshold flipped bits
+    image_hash_service = ImageHashService()
+    hash_types = image_hash_service.hash_types
+    service = DuplicateClusteringService(SimpleNamespace(), image_hash_service, SimpleNamespace())
+    service.images_count = images_count
+    rng = np.random.default_rng(0)
+    images = {
+        'has_terms': np.zeros(images_count, dtype=bool),
+        'minhash_band_keys': np.zeros((images_count, service.minhash_bands), dtype=np.uint64),
+    }
+    try:
+        for hash_type in hash_types:
+            max_distance = int(getattr(image_hash_service, f'{hash_type.upper()}_MAX_SIMILARITY_PERCENT'))
+            hashes = rng.integers(0, 2 ** 63, images_count, dtype=np.int64).astype(np.uint64) << np.uint64(1)
+            for index in range(1, images_count, 2):
+                flipped_bits = rng.choice(64, rng.integers(0, max_distance + 1), replace=False)
+                hashes[index] = hashes[index - 1] ^ np.uint64(sum(1 << int(bit) for bit in flipped_bits))
+            exhaustive_pairs = set()
+            for start in range(0, images_count, chunk_size):
+                distances = image_hash_service.hamming_distances(hashes[start:start + chunk_size, None],
+                                                                 hashes[None, :])
+                first, second = np.nonzero(distances <= max_distance)
+                first += start
+                exhaustive_pairs.update((first[first < second] * images_count + second[first < second]).tolist())
+
+            image_hash_service.hash_types = [hash_type]
+            images['hash_arrays'] = {hash_type: hashes, f'has_{hash_type}': np.ones(images_count, dtype=bool)}
+            for bands in hash_bands:
+                service.hash_bands = bands
+                candidate_pairs = set(service.get_candidate_pairs(images).tolist())
+                found_pairs = len(exhaustive_pairs & candidate_pairs)
+                print(f'{hash_type} (threshold {max_distance}), DEDUP_HASH_BANDS={bands}: {len(candidate_pairs)} '
+                      f'candidate pairs, {found_pairs} of {len(exhaustive_pairs)} pairs within the threshold, '
+                      f'recall {found_pairs / max(1, len(exhaustive_pairs)):.3f}')
+    finally:
+        image_hash_service.hash_types = hash_types
+
+
+def compare_memory_benchmark_test(images_counts=(100000, 1000000), text_words=300):
+    # Peak memory of one compare scan: all documents at once, streamed in batches and from the image columns cache.
+    # Synthetic images are written to separate collections that are dropped afterwards.
+    os.environ['MONGODB_COLLECTION'] = 'memory_benchmark_images'
+    os.environ['MONGODB_SIMILAR_IMAGES_COLLECTION'] = 'memory_benchmark_similar_images'
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    image_service = ImageService(None)
+    hashes = [image_service.image_hash_service.generate_image_hashes(image_path) for image_path in image_paths]
+    words = [f'word{index}' for index in range(50000)]
+
+    def random_image(index):
+        # Random hashes, so that only a few stored images are similar to the target like in a real collection
+        text = ' '.join(random.choices(words, k=text_words))
+        image_hashes = hashes[index % len(hashes)]
+        return {"_id": str(uuid.uuid4()), "sequence": index, "recognized_text": text,
+                "term_frequencies": ImageSimilarityService.get_term_frequencies(text),
+                "ahash": f'{random.getrandbits(64):016x}', "dhash": f'{random.getrandbits(64):016x}',
+                "whash_haar": f'{random.getrandbits(64):016x}', "colorhash": image_hashes.colorhash,
+                "phash16": random.randbytes(32), "dhash16": random.randbytes(32),
+                "hash_variants": image_hashes.hash_variants}
+
+    db_connection = image_service.db_connection
+    target_text = ' '.join(random.choices(words, k=text_words))
+    target = ([hashes[0]], [target_text], [ImageSimilarityService.get_term_frequencies(target_text)])
+    for images_count in images_counts:
+        db_connection.collection.drop()
+        for start in tqdm(range(0, images_count, 10000), desc=f"Saving {images_count} images"):
+            db_connection.collection.insert_many([random_image(index) for index in
+                                                  range(start, min(start + 10000, images_count))])
+
+        def measure(compare):
+            tracemalloc.start()
+            start_time = time.perf_counter()
+            compare()
+            compare_time = time.perf_counter() - start_time
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return peak / 2 ** 20, compare_time
+
+        def compare_all_documents():
+            images = db_connection.get_all_images()
+            image_service.find_similar_images_batch(*target, images, image_service.get_stored_term_frequencies(images))
+
+        image_columns_cache = image_service.image_columns_cache = ImageColumnsCache(
+            db_connection, image_service.image_similarity_service.text_similarity_metric.uses_texts,
+            hash_types=image_service.image_hash_service.hash_types)
+        tracemalloc.start()
+        image_columns_cache.refresh()
+        cache_size = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+        results = {'cached': measure(lambda: image_service.find_similar_stored_images(*target))}
+        image_service.image_columns_cache = None
+        results['streamed'] = measure(lambda: image_service.find_similar_stored_images(*target))
+        results['all documents'] = measure(compare_all_documents)
+        print(f'{images_count} images, columns cache {cache_size:.0f} MB: ' + ', '.join(
+            f'{mode} peak {peak:.0f} MB in {compare_time:.2f} s' for mode, (peak, compare_time) in results.items()))
+    db_connection.collection.drop()
+    db_connection.similar_images_collection.drop()
+
+
+def image_records_benchmark_test(rounds=3):
+    # Memory held by the stored images as MongoDB documents and as slotted records, and the time of a compare scan
+    db_connection = RecognizedImagesRepository()
+    image_service = ImageService(None)
+    image_paths = list(get_images_paths('images\\orig').values())
+    target_hashes = image_service.image_hash_service.generate_image_hashes(image_paths[0])
+    target_text = image_service.image_ocr_service.get_text_from_image(image_paths[0])
+    target = ([target_hashes], [target_text], [ImageSimilarityService.get_term_frequencies(target_text)])
+
+    for name, load in (('documents', lambda: list(db_connection.collection.find())),
+                       ('records', db_connection.get_all_images)):
+        tracemalloc.start()
+        images = load()
+        held = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+        print(f'{len(images)} images as {name}: {held:.1f} MB')
+
+    images = db_connection.get_all_images()
+    frequencies = image_service.get_stored_term_frequencies(images)
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        image_service.find_similar_images_batch(*target, images, frequencies)
+    print(f'Compare scan of {len(images)} records: {(time.perf_counter() - start_time) / rounds:.2f} s')
+
+
+def thumbnail_store_benchmark_test(rounds=3):
+    # Hashing from the original images and from the thumbnail store, and how far the thumbnail hashes are off
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    os.environ['ENABLE_THUMBNAIL_STORE'] = 'False'
+    image_hash_service = ImageHashService()
+    os.environ['ENABLE_THUMBNAIL_STORE'] = 'True'
+    os.environ['THUMBNAIL_STORE_PATH'] = tempfile.mkdtemp()
+    thumbnail_hash_service = ImageHashService()
+
+    original_hashes = [image_hash_service.generate_image_hashes(image_path) for image_path in image_paths]
+    thumbnail_hashes = [thumbnail_hash_service.generate_image_hashes(image_path) for image_path in image_paths]
+    for name, generate_hashes in (
+            ('originals', lambda: [image_hash_service.generate_image_hashes(image_path, hashes.xxhash)
+                                   for image_path, hashes in zip(image_paths, original_hashes)]),
+            ('thumbnails', lambda: [thumbnail_hash_service.generate_image_hashes(image_path, hashes.xxhash)
+                                    for image_path, hashes in zip(image_paths, thumbnail_hashes)])):
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            generate_hashes()
+        print(f'Hashes from {name}: {(time.perf_counter() - start_time) / rounds / len(image_paths) * 1000:.1f} ms '
+              f'per image')
+
+    def to_bytes(image_hash):
+        return image_hash if isinstance(image_hash, bytes) else bytes.fromhex(image_hash)
+
+    for hash_type in ['ahash', 'dhash', 'whash_haar', 'colorhash', 'phash16', 'dhash16']:
+        distances = [ImageHashService.bytes_distance(to_bytes(getattr(original, hash_type)),
+                                                     to_bytes(getattr(thumbnail, hash_type)))
+                     for original, thumbnail in zip(original_hashes, thumbnail_hashes)]
+        print(f'{hash_type} of thumbnails: mean distance {sum(distances) / len(distances):.2f}, max {max(distances)}')
+    print(f'Hash versions: originals {image_hash_service.hash_version}, '
+          f'thumbnails {thumbnail_hash_service.hash_version}')
+    # Compared as if they were the same version, which they are not so that the store never mixes them
+    for thumbnail in thumbnail_hashes:
+        thumbnail.hash_version = image_hash_service.hash_version
+    similar = [image_hash_service.is_similar(original, thumbnail)[0]
+               for original, thumbnail in zip(original_hashes, thumbnail_hashes)]
+    print(f'Thumbnail hashes similar to the original hashes: {sum(similar)} of {len(similar)}')
+
+
+class ThrottledStorage:
+    """Slow network storage stand-in: every read of an image file waits one round trip plus its size at a bandwidth."""
+
+    def __init__(self, latency=0.02, bandwidth_mb=20):
+        self.latency = latency
+        self.bandwidth = bandwidth_mb * 1024 * 1024
+        self.patched = {}
+
+    @staticmethod
+    def is_image_path(path):
+        return isinstance(path, str) and path.lower().endswith(('.jpg', '.jpeg', '.png'))
+
+    def wait(self, path, read=True):
+        if self.is_image_path(path):
+            time.sleep(self.latency + (os.path.getsize(path) / self.bandwidth if read and os.path.isfile(path) else 0))
+
+    def throttle(self, module, name, read=True):
+        function = getattr(module, name)
+        self.patched[module, name] = function
+
+        def throttled(path, *args, **kwargs):
+            self.wait(path, read)
+            return function(path, *args, **kwargs)
+
+        setattr(module, name, throttled)
+
+    def __enter__(self):
+        self.throttle(builtins, 'open')
+        self.throttle(Image, 'open')
+        self.throttle(cv2, 'imread')
+        self.throttle(os.path, 'exists', read=False)
+        return self
+
+    def __exit__(self, *exc_info):
+        for (module, name), function in self.patched.items():
+            setattr(module, name, function)
+        self.patched.clear()
+
+
+class LocalQueueChannel:
+    """Channel stand-in serving basic_get from local queues."""
+
+    def __init__(self, queues):
+        self.queues = {queue_name: deque(bodies) for queue_name, bodies in queues.items()}
+        self.delivery_tag = 0
+        self.acked = []
+
+    def basic_get(self, queue):
+        if not self.queues.get(queue):
+            return None, None, None
+        self.delivery_tag += 1
+        return SimpleNamespace(delivery_tag=self.delivery_tag), pika.BasicProperties(), self.queues[queue].popleft()
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        if not requeue:
+            self.acked.append(delivery_tag)
+
+
+def image_prefetch_throughput_test(windows=(0, 1, 2, 4), latency=0.02, bandwidth_mb=20, rounds=2):
+    # OCR task throughput of one worker reading the images from throttled storage, without and with read-ahead.
+    # The first round recognizes every image, the next rounds find them saved and only hash them.
+    os.environ['MONGODB_COLLECTION'] = 'prefetch_benchmark_images'
+    os.environ['MONGODB_SIMILAR_IMAGES_COLLECTION'] = 'prefetch_benchmark_similar_images'
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    bodies = [json.dumps({"image_id": f'{round_index}-{index}', "image_path": image_path}).encode()
+              for round_index in range(rounds) for index, image_path in enumerate(image_paths)]
+    for window in windows:
+        os.environ['IMAGE_PREFETCH_WINDOW'] = str(window)
+        image_service = ImageService(None)
+        image_service.db_connection.collection.drop()
+        channel = LocalQueueChannel({OCR_IMAGE_QUEUE: bodies})
+        image_service.messaging_connection = SimpleNamespace(channel=channel,
+                                                             parse_message=RabbitMQConnection.parse_message,
+                                                             send_reply=lambda properties, message: None)
+        start_time = time.perf_counter()
+        with ThrottledStorage(latency, bandwidth_mb):
+            while image_service.consume_single_message(OCR_IMAGE_QUEUE):
+                pass
+        elapsed = time.perf_counter() - start_time
+        print(f'Read-ahead window {window}: {len(channel.acked) / elapsed:.2f} tasks/s, '
+              f'{image_service.db_connection.collection.count_documents({})} images saved')
+        if image_service.image_prefetcher is not None:
+            image_service.image_prefetcher.close()
+        image_service.db_connection.collection.drop()
+        image_service.db_connection.similar_images_collection.drop()
+        image_service.db_connection.close()
+
+
+def feature_migration_test(max_images_per_second=(2, 10)):
+    # Migrate images stored by other OCR models and hash versions at throttled rates. Compares during the migration
+    # serve the mixed versions, and after it they match the compares of the freshly stored images.
+    os.environ['MONGODB_COLLECTION'] = 'migration_benchmark_images'
+    os.environ['MONGODB_SIMILAR_IMAGES_COLLECTION'] = 'migration_benchmark_similar_images'
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    image_service = ImageService(None)
+    collection = image_service.db_connection.collection
+    collection.drop()
+    for index, image_path in enumerate(image_paths):
+        image_service.handle_ocr_task({"image_id": str(index), "image_path": image_path})
+    similarity_service = image_service.image_similarity_service
+    targets = [(image_service.image_hash_service.generate_image_hashes(image_path),
+                similarity_service.preprocess_text(image_service.image_ocr_service.get_text_from_image(image_path)))
+               for image_path in image_paths]
+
+    def compare_all():
+        results = image_service.find_similar_stored_images(
+            [image_hashes for image_hashes, _ in targets], [text for _, text in targets],
+            [similarity_service.get_term_frequencies(text) for _, text in targets])
+        return [sorted(str((info.id, info.similarity)) for info in similar_images_info)
+                for similar_images_info in results]
+
+    reference = compare_all()
+    for rate in max_images_per_second:
+        # Half of the texts by other OCR models, a third of the hashes of another version and a third without one
+        for index, document in enumerate(collection.find({}, {'_id': 1})):
+            fields = {}
+            if index % 2 == 0:
+                fields.update(ocr_version='old', recognized_text='text of the old models', term_frequencies=None)
+            if index % 3 == 0:
+                fields.update(hash_version=HASH_VERSION + 1, ahash='0' * 16, dhash='0' * 16, whash_haar='0' * 16)
+            elif index % 3 == 1:
+                fields.update(hash_version=None)
+            image_service.db_connection.update_image_features({document['_id']: fields})
+        mixed = compare_all()
+        os.environ['MIGRATION_MAX_IMAGES_PER_SECOND'] = str(rate)
+        migration = FeatureMigrationService(image_service.db_connection, image_service.image_hash_service,
+                                            image_service.image_ocr_service, similarity_service)
+        status = migration.run()
+        migrated = compare_all()
+        print(f'Max {rate} images/s: migrated {status["migrated"]}, failed {status["failed"]}, '
+              f'{status["images_per_second"]:.2f} images/s, {status["stale_images"]} stale images left, '
+              f'mixed compares {sum(a == b for a, b in zip(mixed, reference))} of {len(reference)} unchanged, '
+              f'migrated compares {sum(a == b for a, b in zip(migrated, reference))} of {len(reference)} unchanged')
+    collection.drop()
+    image_service.db_connection.similar_images_collection.drop()
+    image_service.db_connection.close()
+
+
+def xxhash_throughput_test(file_sizes_mb=(5, 50, 500), rounds=3):
+    # Content hash throughput of the version 1 (xxh64 over 4 KB chunks) and current (mmap + xxh3_128) xxhash
+    image_hash_service = ImageHashService()
+    for file_size_mb in file_sizes_mb:
+        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as file:
+            for _ in range(file_size_mb):
+                file.write(os.urandom(1024 * 1024))
+        try:
+            for name, hash_func in (('legacy', image_hash_service.generate_legacy_image_xxhash),
+                                    ('xxh3_128', image_hash_service._generate_image_xxhash)):
+                start_time = time.perf_counter()
+                for _ in range(rounds):
+                    hash_func(file.name)
+                elapsed = (time.perf_counter() - start_time) / rounds
+                print(f'{file_size_mb} MB {name}: {elapsed * 1000:.1f} ms, {file_size_mb / elapsed:.0f} MB/s')
+        finally:
+            os.remove(file.name)
+
+
 def send_task(image_name, image_path, queue_name):
     rabbitmq_connection = RabbitMQConnection()
     message = {
@@ -261,6 +861,512 @@ def send_task(image_name, image_path, queue_name):
     print(f'Message {image_name} sent to {queue_name}')
 
 
+def rpc_compare_images_test():
+    fake_images_dir = 'images\\fake'
+    rpc_client = RabbitMQRpcClient(RabbitMQConnection())
+
+    # Pipeline all requests over one connection, then wait for the replies
+    start_time = time.time()
+    futures = {}
+    for compare_image_name, compare_image_path in get_images_paths(fake_images_dir).items():
+        message = {
+            'image_id': compare_image_name,
+            'image_path': compare_image_path,
+        }
+        futures[compare_image_name] = rpc_client.call_async(COMPARE_IMAGES_QUEUE, message)
+    rpc_client.wait_all(list(futures.values()))
+
+    for compare_image_name, future in futures.items():
+        if future.exception():
+            print(f'{compare_image_name}: {future.exception()}')
+        else:
+            response = future.result()
+            print(f'{compare_image_name}: {len(response.get("similar_images", []))} similar images')
+    print(f'Total Execution Time: {time.time() - start_time:.2f} seconds')
+    rpc_client.close()
+
+
+def rpc_repeat_compare_test(rounds=3):
+    # Compare the same images several times, the first round scans the collection, later rounds hit the compare cache
+    fake_images_dir = 'images\\fake'
+    rpc_client = RabbitMQRpcClient(RabbitMQConnection())
+    for round_number in range(rounds):
+        start_time = time.time()
+        futures = [rpc_client.call_async(COMPARE_IMAGES_QUEUE, {'image_id': image_name, 'image_path': image_path})
+                   for image_name, image_path in get_images_paths(fake_images_dir).items()]
+        rpc_client.wait_all(futures)
+        similar_images_counts = [len(future.result().get('similar_images', [])) for future in futures
+                                 if not future.exception()]
+        print(f'Round {round_number + 1}: {time.time() - start_time:.2f} seconds, '
+              f'similar images per image: {similar_images_counts}')
+    rpc_client.close()
+
+
+def rpc_profiling_test(mode='sampling', tasks=20):
+    # Profile a worker for a number of compare tasks and print the functions it spent its time in
+    fake_images_dir = 'images\\fake'
+    rpc_client = RabbitMQRpcClient(RabbitMQConnection())
+    # The reply to start_profiling is the profile summary, sent once the worker finished the profile
+    profile_future = rpc_client.call_async(MAINTENANCE_QUEUE,
+                                           {'action': 'start_profiling', 'mode': mode, 'tasks': tasks})
+    images = list(get_images_paths(fake_images_dir).items())
+    futures = [rpc_client.call_async(COMPARE_IMAGES_QUEUE, {'image_id': image_name, 'image_path': image_path})
+               for image_name, image_path in (images[index % len(images)] for index in range(tasks))]
+    rpc_client.wait_all(futures)
+    status = rpc_client.wait(profile_future).get('status')
+    if isinstance(status, dict):
+        print(f'Profile written to {status["path"]}, {status["tasks"]} tasks in {status["seconds"]} s:')
+        for function in status['top_functions']:
+            print(f'-{function}')
+    else:
+        print(status)
+    rpc_client.close()
+
+
+def rpc_batch_compare_test():
+    # Compare all images as one batch message and as one message per image
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    images = [{'image_id': image_name, 'image_path': image_path} for image_name, image_path in
+              list(get_images_paths(orig_images_dir).items()) + list(get_images_paths(fake_images_dir).items())]
+    rpc_client = RabbitMQRpcClient(RabbitMQConnection())
+
+    start_time = time.time()
+    response = rpc_client.wait(rpc_client.call_async(COMPARE_IMAGES_QUEUE,
+                                                     {'batch_id': str(uuid.uuid4()), 'images': images}))
+    print(f'Batch: {time.time() - start_time:.2f} seconds, status: {response["status"]}')
+    for result in response['results']:
+        print(f'{result["image_id"]}: {result.get("status") or len(result["similar_images"])} similar images')
+
+    start_time = time.time()
+    futures = [rpc_client.call_async(COMPARE_IMAGES_QUEUE, image) for image in images]
+    rpc_client.wait_all(futures)
+    print(f'One message per image: {time.time() - start_time:.2f} seconds')
+    rpc_client.close()
+
+
+class LocalIOLoop:
+    """Thread-based stand-in for the pika IOLoop used by RabbitMQPublisher."""
+
+    def __init__(self):
+        self.callbacks = queue.Queue()
+        self.running = False
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def call_later(self, delay, callback):
+        threading.Timer(delay, self.add_callback_threadsafe, [callback]).start()
+
+    def start(self):
+        self.running = True
+        while self.running:
+            self.callbacks.get()()
+
+    def stop(self):
+        self.running = False
+        self.callbacks.put(lambda: None)
+
+
+class LocalBrokerStandIn:
+    """Confirm-mode broker stand-in that acks everything received within one confirm round trip at once."""
+
+    def __init__(self, confirm_latency):
+        self.confirm_latency = confirm_latency
+        self.ioloop = None
+        self.is_open = True
+        self.on_close_callback = None
+        self.ack_nack_callback = None
+        self.delivery_tag = 0
+        self.confirm_scheduled = False
+        self.lock = threading.Lock()
+
+    def connect(self, parameters, on_open_callback, on_open_error_callback, on_close_callback, custom_ioloop):
+        self.ioloop = custom_ioloop
+        self.on_close_callback = on_close_callback
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+        return self
+
+    def channel(self, on_open_callback):
+        self.ioloop.add_callback_threadsafe(lambda: on_open_callback(self))
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self.ack_nack_callback = ack_nack_callback
+        callback(None)
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        with self.lock:
+            self.delivery_tag += 1
+            if not self.confirm_scheduled:
+                self.confirm_scheduled = True
+                threading.Timer(self.confirm_latency, self._confirm).start()
+
+    def _confirm(self):
+        with self.lock:
+            self.confirm_scheduled = False
+            frame = SimpleNamespace(method=pika.spec.Basic.Ack(delivery_tag=self.delivery_tag, multiple=True))
+        self.ioloop.add_callback_threadsafe(lambda: self.ack_nack_callback(frame))
+
+    def close(self):
+        self.is_open = False
+        self.ioloop.add_callback_threadsafe(lambda: self.on_close_callback(self, 'closed'))
+
+
+def publisher_confirms_throughput_test(message_count=1000, confirm_latency=0.005, window_sizes=(1, 8, 64, 256, 1024)):
+    body = json.dumps({
+        "image_id": "fake1",
+        "image_path": "images/fake1.jpg",
+        "recognized_text": "lorem ipsum " * 200,
+        "similar_images": []
+    })
+    for window_size in window_sizes:
+        broker = LocalBrokerStandIn(confirm_latency)
+        publisher = RabbitMQPublisher(None, window_size, connection_factory=broker.connect, ioloop=LocalIOLoop())
+        publisher.start(timeout=5)
+
+        start_time = time.time()
+        for _ in range(message_count):
+            publisher.publish('', RESPONSE_QUEUE, body)
+        publisher.flush()
+        total_time = time.time() - start_time
+        publisher.stop(timeout=5)
+
+        print(f'Window {window_size}: {message_count / total_time:.0f} messages/s '
+              f'({publisher.confirm_window.confirmed_count} confirmed)')
+
+
+def backpressure_pause_test(max_memory_mb=100, max_pause_seconds=0.5, poll_interval=0.05):
+    # Drive the consumer loop of ImageService with a fake resident memory: a task raises it above the limit,
+    # memory freed during the pause resumes consumption, and a pause nothing recovers from stops the worker
+    megabyte = 1024 * 1024
+    memory_usage = [max_memory_mb // 2 * megabyte]
+    backpressure = WorkerBackpressure(max_memory_mb, max_pause_seconds)
+    backpressure.get_memory_usage = lambda: memory_usage[0]
+    events = []
+
+    def consume_single_message(queue_name):
+        events.append('task')
+        memory_usage[0] = max_memory_mb * 2 * megabyte
+        return True
+
+    def sleep(seconds):
+        events.append('pause')
+        time.sleep(seconds)
+        # Memory is freed during the first pause only
+        if events.count('pause') == 1:
+            memory_usage[0] = max_memory_mb // 2 * megabyte
+
+    service = SimpleNamespace(
+        shutdown=GracefulShutdown(0),
+        backpressure=backpressure,
+        backpressure_poll_interval=poll_interval,
+        queue_idle_poll_interval=poll_interval,
+        restart_requested=False,
+        messaging_connection=SimpleNamespace(connection=SimpleNamespace(sleep=sleep)),
+        queue_scheduler=SimpleNamespace(queue_order=lambda: [OCR_IMAGE_QUEUE]),
+        consume_single_message=consume_single_message,
+        log_backpressure=lambda: None,
+        log_queue_metrics=lambda: None,
+        worker_profiler=SimpleNamespace(poll=lambda: None),
+        reply_profile=lambda summary: None,
+        release_read_ahead_messages=lambda: None,
+        logger=SimpleNamespace(info=print, error=print, exception=print),
+    )
+    start_time = time.monotonic()
+    ImageService.consume_queues(service)
+    elapsed = time.monotonic() - start_time
+
+    assert events[:3] == ['task', 'pause', 'task'], events
+    assert set(events[3:]) == {'pause'}, events
+    assert service.restart_requested and service.shutdown.is_requested
+    assert elapsed >= max_pause_seconds
+    print(f'Paused and resumed once, then stopped after {len(events) - 3} polls ({elapsed:.2f} seconds)')
+
+
+def build_compare_response(similar_images_count, text_len=2000):
+    words = ['invoice', 'total', 'amount', 'date', 'number', 'customer', 'address', 'payment', 'due', 'tax',
+             'subtotal', 'qty', 'price', 'description', 'bank', 'account', 'iban', 'swift', '2023', '100.00']
+
+    def random_text():
+        text = ''
+        while len(text) < text_len:
+            text += f' {random.choice(words)}'
+        return text
+
+    return {
+        "image_id": "fake1",
+        "image_path": "images/fake1.jpg",
+        "recognized_text": random_text(),
+        "similar_images": [{
+            "image_id": f'orig{index}',
+            "image_path": f'images/orig{index}.jpg',
+            "similarity": random.uniform(60, 100),
+            "recognized_text": random_text()
+        } for index in range(similar_images_count)]
+    }
+
+
+def message_codec_benchmark_test(iterations=200, similar_images_counts=(1, 10, 100)):
+    codecs = [
+        ('json', MessageCodec('json')),
+        ('msgpack', MessageCodec('msgpack')),
+        ('msgpack+zstd', MessageCodec('msgpack', compression_threshold=1)),
+    ]
+    for similar_images_count in similar_images_counts:
+        message = build_compare_response(similar_images_count)
+        print(f'Compare response with {similar_images_count} similar images:')
+        for codec_name, codec in codecs:
+            start_time = time.time()
+            for _ in range(iterations):
+                body, content_type, content_encoding = codec.encode(message)
+            encode_time = (time.time() - start_time) / iterations
+
+            start_time = time.time()
+            for _ in range(iterations):
+                decoded = decode_message(body, content_type, content_encoding)
+            decode_time = (time.time() - start_time) / iterations
+
+            assert decoded == message
+            print(f'-{codec_name}: Size: {len(body)} bytes Encode: {encode_time * 1000:.3f} ms '
+                  f'Decode: {decode_time * 1000:.3f} ms')
+
+
+class LoadTestBroker:
+    """Broker stand-in for load tests: thread-safe local queues that timestamp every message until its ack or nack."""
+
+    def __init__(self, on_done):
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.queues = {OCR_IMAGE_QUEUE: deque(), COMPARE_IMAGES_QUEUE: deque(), MAINTENANCE_QUEUE: deque()}
+        self.delivered = {}
+        self.delivery_tag = 0
+
+    def publish(self, queue_name, task):
+        properties = pika.BasicProperties(timestamp=int(time.time()), correlation_id=str(uuid.uuid4()))
+        with self.lock:
+            self.queues[queue_name].append((json.dumps(task).encode(), properties, time.monotonic()))
+
+    def basic_get(self, queue):
+        with self.lock:
+            if not self.queues.get(queue):
+                return None, None, None
+            body, properties, published_at = self.queues[queue].popleft()
+            self.delivery_tag += 1
+            self.delivered[self.delivery_tag] = (queue, body, properties, published_at)
+            return SimpleNamespace(delivery_tag=self.delivery_tag), properties, body
+
+    def basic_ack(self, delivery_tag):
+        queue_name, _, _, published_at = self.delivered.pop(delivery_tag)
+        self.on_done(queue_name, time.monotonic() - published_at, False)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        queue_name, body, properties, published_at = self.delivered.pop(delivery_tag)
+        if requeue:
+            with self.lock:
+                self.queues[queue_name].appendleft((body, properties, published_at))
+        else:
+            self.on_done(queue_name, time.monotonic() - published_at, True)
+
+    @staticmethod
+    def sleep(seconds):
+        time.sleep(seconds)
+
+    def get_depths(self):
+        with self.lock:
+            return {queue_name: len(messages) for queue_name, messages in self.queues.items()}
+
+
+class LoadTestRecorder:
+    """End-to-end latencies, failures and queue depth samples of a load test run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.sent = {}
+        self.latencies = {}
+        self.failed = {}
+        self.timeline = []
+        self.last_done_at = None
+
+    def on_sent(self, queue_name):
+        with self.lock:
+            self.sent[queue_name] = self.sent.get(queue_name, 0) + 1
+
+    def on_done(self, queue_name, latency, failed):
+        with self.lock:
+            if failed:
+                self.failed[queue_name] = self.failed.get(queue_name, 0) + 1
+            else:
+                self.latencies.setdefault(queue_name, []).append(latency)
+            self.last_done_at = time.monotonic()
+
+    def done_count(self):
+        with self.lock:
+            return sum(map(len, self.latencies.values())) + sum(self.failed.values())
+
+    def sample(self, depths):
+        self.timeline.append({"time": round(time.monotonic() - self.start_time, 3), "depths": depths,
+                              "done": self.done_count()})
+
+    def summarize(self, latencies, sent, failed, elapsed):
+        return {
+            "sent": sent,
+            "completed": len(latencies),
+            "failed": failed,
+            "unfinished": sent - len(latencies) - failed,
+            "throughput": len(latencies) / elapsed if elapsed else 0,
+            "latency_p50": get_percentile(latencies, 50),
+            "latency_p95": get_percentile(latencies, 95),
+            "latency_p99": get_percentile(latencies, 99),
+            "latency_max": max(latencies) if latencies else None,
+        }
+
+    def report(self, run):
+        elapsed = (self.last_done_at or time.monotonic()) - self.start_time
+        queues = {queue_name: self.summarize(self.latencies.get(queue_name, []), sent,
+                                             self.failed.get(queue_name, 0), elapsed)
+                  for queue_name, sent in self.sent.items()}
+        total = self.summarize([latency for latencies in self.latencies.values() for latency in latencies],
+                               sum(self.sent.values()), sum(self.failed.values()), elapsed)
+        return {"run": run, "elapsed": elapsed, "total": total, "queues": queues, "timeline": self.timeline}
+
+
+def generate_load_tasks(rate, duration, task_mix, maintenance_action):
+    # Poisson arrivals at the given rate, the queue of every task drawn from the task mix
+    orig_images_dir = 'images\\orig'
+    fake_images_dir = 'images\\fake'
+    image_paths = list(get_images_paths(orig_images_dir).values()) + list(get_images_paths(fake_images_dir).values())
+    queue_names = {'ocr': OCR_IMAGE_QUEUE, 'compare': COMPARE_IMAGES_QUEUE, 'maintenance': MAINTENANCE_QUEUE}
+    kinds, weights = list(task_mix), list(task_mix.values())
+    offset, index = random.expovariate(rate), 0
+    while offset < duration:
+        kind = random.choices(kinds, weights)[0]
+        if kind == 'maintenance':
+            task = {"action": maintenance_action}
+        else:
+            task = {"image_id": f'load-{index}', "image_path": random.choice(image_paths)}
+        yield offset, queue_names[kind], task
+        offset += random.expovariate(rate)
+        index += 1
+
+
+def drive_load(arrivals, send, process_events, get_depths, recorder, duration, sample_interval, drain_timeout):
+    # Send the tasks at their arrival offsets and sample the queue depths, then wait until all tasks are done
+    next_sample_at = 0
+    drain_deadline = duration + drain_timeout
+    arrival = next(arrivals, None)
+    while True:
+        now = time.monotonic() - recorder.start_time
+        while arrival is not None and arrival[0] <= now:
+            send(arrival[1], arrival[2])
+            recorder.on_sent(arrival[1])
+            arrival = next(arrivals, None)
+        if now >= next_sample_at:
+            recorder.sample(get_depths())
+            next_sample_at += sample_interval
+        if arrival is None and (recorder.done_count() >= sum(recorder.sent.values()) or now >= drain_deadline):
+            recorder.sample(get_depths())
+            return
+        process_events(max(0.001, min(next_sample_at, arrival[0] if arrival is not None else next_sample_at) - now))
+
+
+def load_test(rate=2.0, duration=60, task_mix=None, mode='local', sample_interval=1.0, drain_timeout=300,
+              maintenance_action='get_migration_status', report_dir='load_test_reports'):
+    # Drive ImageService at a fixed rate and task mix and write a report with the end-to-end latency percentiles,
+    # throughput and queue depths over time. Mode 'local' runs the service in this process against a broker stand-in
+    # and a benchmark collection of the local MongoDB, mode 'broker' sends RPC requests to the local RabbitMQ and the
+    # workers consuming it.
+    task_mix = task_mix or {'ocr': 0.5, 'compare': 0.45, 'maintenance': 0.05}
+    queue_names = [OCR_IMAGE_QUEUE, COMPARE_IMAGES_QUEUE, MAINTENANCE_QUEUE]
+    arrivals = generate_load_tasks(rate, duration, task_mix, maintenance_action)
+    if mode == 'local':
+        # Compare results and generations of the load test must not be cached for the real collection
+        os.environ['MONGODB_COLLECTION'] = 'load_test_images'
+        os.environ['MONGODB_SIMILAR_IMAGES_COLLECTION'] = 'load_test_similar_images'
+        os.environ['MONGODB_COMPARE_CACHE_COLLECTION'] = 'load_test_compare_cache'
+        os.environ['MONGODB_COUNTERS_COLLECTION'] = 'load_test_counters'
+        image_service = ImageService(None)
+        db_connection = image_service.db_connection
+        load_test_collections = [db_connection.collection, db_connection.similar_images_collection,
+                                 db_connection.compare_cache_collection, db_connection.counters_collection]
+        for collection in load_test_collections:
+            collection.drop()
+        recorder = LoadTestRecorder()
+        broker = LoadTestBroker(recorder.on_done)
+        image_service.messaging_connection = SimpleNamespace(
+            channel=broker, connection=broker, parse_message=RabbitMQConnection.parse_message,
+            send_reply=lambda properties, message: None, publish_dead_letter=lambda body: None)
+        consume_thread = threading.Thread(target=image_service.consume_queues, daemon=True)
+        consume_thread.start()
+        drive_load(arrivals, broker.publish, time.sleep, broker.get_depths, recorder, duration, sample_interval,
+                   drain_timeout)
+        image_service.shutdown.request()
+        consume_thread.join()
+        if image_service.image_prefetcher is not None:
+            image_service.image_prefetcher.close()
+        for collection in load_test_collections:
+            collection.drop()
+        db_connection.close()
+    elif mode == 'broker':
+        messaging_connection = RabbitMQConnection()
+        rpc_client = RabbitMQRpcClient(messaging_connection)
+        recorder = LoadTestRecorder()
+
+        def send(queue_name, task):
+            sent_at = time.monotonic()
+            future = rpc_client.call_async(queue_name, task)
+            future.add_done_callback(lambda done: recorder.on_done(
+                queue_name, time.monotonic() - sent_at, done.exception() is not None))
+
+        def get_depths():
+            return {queue_name: messaging_connection.channel.queue_declare(
+                queue=queue_name, passive=True).method.message_count for queue_name in queue_names}
+
+        drive_load(arrivals, send, lambda seconds: messaging_connection.connection.process_data_events(
+            time_limit=seconds), get_depths, recorder, duration, sample_interval, drain_timeout)
+        # Requests still unanswered are reported as unfinished, not as failed
+        recorder.on_done = lambda *args: None
+        rpc_client.close()
+        messaging_connection.close()
+    else:
+        raise ValueError(f'Unknown load test mode: {mode}')
+
+    run = {
+        "mode": mode, "started_at": time.strftime('%Y-%m-%dT%H:%M:%S'), "rate": rate, "duration": duration,
+        "task_mix": task_mix, "maintenance_action": maintenance_action,
+        "settings": {name: os.getenv(name) for name in (
+            'QUEUE_WEIGHTS', 'IMAGE_PREFETCH_WINDOW', 'OCR_BACKEND', 'OCR_ANGLE_CLS_MODE', 'TEXT_SIMILARITY_METRIC',
+            'HASH_TYPES', 'ENABLE_IMAGE_COLUMNS_CACHE', 'ENABLE_COMPARE_CACHE', 'MESSAGE_CODEC')}
+    }
+    report = recorder.report(run)
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = os.path.join(report_dir, f'load_test_{mode}_{time.strftime("%Y%m%d-%H%M%S")}.json')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    print_load_test_reports([report_path])
+    return report_path
+
+
+def print_load_test_reports(report_paths):
+    # One row per run and queue, to compare reports of runs with different settings
+    print(f'{"report":<45} {"queue":<22} {"sent":>6} {"failed":>6} {"left":>5} {"tasks/s":>8} '
+          f'{"p50 s":>7} {"p95 s":>7} {"p99 s":>7} {"max depth":>9}')
+    for report_path in report_paths:
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+        for queue_name, summary in [*report['queues'].items(), ('total', report['total'])]:
+            depths = [sum(sample['depths'].values()) if queue_name == 'total' else sample['depths'].get(queue_name, 0)
+                      for sample in report['timeline']]
+            latencies = [f'{summary[key]:>7.2f}' if summary[key] is not None else f'{"-":>7}'
+                         for key in ('latency_p50', 'latency_p95', 'latency_p99')]
+            print(f'{os.path.basename(report_path):<45} {queue_name:<22} {summary["sent"]:>6} {summary["failed"]:>6} '
+                  f'{summary["unfinished"]:>5} {summary["throughput"]:>8.2f} {" ".join(latencies)} '
+                  f'{max(depths, default=0):>9}')
+
+
 def get_images_paths(images_dir):
     image_paths = {}
     for filename in os.listdir(images_dir):
@@ -388,8 +1494,8 @@ def random_compare_images_test():
 
         similar_image_ids = []
         for image in all_images:
-            if image_similarity_service.is_similar(recognized_text, image.get('recognized_text')):
-                similar_image_ids.append(image["_id"])
+            if image_similarity_service.is_similar(recognized_text, image.recognized_text):
+                similar_image_ids.append(image.id)
 
         similar_images_data = db_connection.get_images_by_ids(similar_image_ids)
 
@@ -397,12 +1503,12 @@ def random_compare_images_test():
         similar_images_ids = []
         for image in similar_images_data:
             similar_images.append({
-                "_id": image.get('_id'),
-                "image_id": image.get('image_id'),
-                "image_path": image.get('image_path'),
-                "recognized_text": image.get('recognized_text')
+                "_id": image.id,
+                "image_id": image.image_id,
+                "image_path": image.image_path,
+                "recognized_text": image.recognized_text
             })
-            similar_images_ids.append(image.get('_id'))
+            similar_images_ids.append(image.id)
 
         image_id = random.randint(0, 100000)
         image_uuid = str(uuid.uuid4())
@@ -427,7 +1533,31 @@ def random_compare_images_test():
 if __name__ == "__main__":
     ocr_and_compare_all_images_test()
     # random_task_test(compare_tasks_count=2, ocr_tasks_count=2)
+    # rpc_compare_images_test()
+    # rpc_repeat_compare_test()
+    # rpc_batch_compare_test()
+    # publisher_confirms_throughput_test()
+    # backpressure_pause_test()
+    # message_codec_benchmark_test()
+    # rpc_profiling_test()
+    # load_test(rate=2.0, duration=60)
+    # print_load_test_reports(['load_test_reports/...json', 'load_test_reports/...json'])
     # random_ocr_image_test()
     # random_compare_images_test()
     # test_dhash()
     # test_text_compare()
+    # text_similarity_metrics_benchmark_test()
+    # ocr_angle_cls_benchmark_test()
+    # ocr_backends_benchmark_test()
+    # ocr_worker_tuning_test()
+    # tiered_hash_benchmark_test()
+    # hash_types_benchmark_test()
+    # xxhash_throughput_test()
+    # batch_hash_matrix_benchmark_test()
+    # duplicate_clustering_test()
+    # dedup_hash_band_recall_test()
+    # compare_memory_benchmark_test()
+    # image_records_benchmark_test()
+    # thumbnail_store_benchmark_test()
+    # image_prefetch_throughput_test()
+    # feature_migration_test()